@@ -0,0 +1,32 @@
+import os
+import uuid
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_path(path: str | os.PathLike):
+  """A fresh temp path next to `path`, moved over `path` when the block succeeds.
+
+  The temp name is unique per call, so concurrent writers of one path (threads,
+  tasks, or Streamlit sessions sharing a process) never share a temp file and
+  the last one to finish wins. Readers only ever see complete files, and a
+  hardlinked copy of the old file is never rewritten in place.
+  """
+  path = os.fspath(path)
+  os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+  tmp = f"{path}.tmp{uuid.uuid4().hex}"
+  try:
+    yield tmp
+    os.replace(tmp, path)
+  finally:
+    # Left behind by a failed block, or by a rename between two links to one file, which does nothing
+    if os.path.lexists(tmp):
+      os.unlink(tmp)
+
+def atomic_write(path: str | os.PathLike, data: bytes | str):
+  with atomic_path(path) as tmp:
+    if isinstance(data, bytes):
+      with open(tmp, "wb") as f:
+        f.write(data)
+    else:
+      with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
@@ -0,0 +1,156 @@
+"""Generate mangas from a JSONL file of MainRequest objects, without the UI.
+
+  python batch.py requests.jsonl --out runs/overnight --jobs 2
+
+Each line is one MainRequest as JSON. Jobs run concurrently up to --jobs and
+share the process-wide rate limiter, so together they stay within the
+per-model request, token and concurrency limits. A result file is written per
+job under <out>/jobs/ and a run summary to <out>/summary.json. Rerunning with
+the same --out skips jobs that already completed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from pydantic import ValidationError
+from models import MainRequest, Manga, MangaChapterScript
+from pipeline import PipelineHooks, generate_manga
+from scheduler import PanelKey
+from ratelimit import rate_limiter
+from cache import image_cache
+from tracing import METRICS_PORT, serve_metrics, tracer
+from atomic import atomic_write
+from stats import percentile
+
+class BatchHooks(PipelineHooks):
+  """Logs progress of one job and times its first panel."""
+
+  def __init__(self, index: int):
+    self.index = index
+    self.started = time.monotonic()
+    self.first_panel: float | None = None
+    self.panels = 0
+    self.title: str | None = None
+
+  def log(self, message: str):
+    print(f"[job {self.index}{f' {self.title}' if self.title else ''}] {message}", flush=True)
+
+  def on_stage(self, stage: str):
+    self.log(stage)
+
+  def on_outline(self, manga: Manga):
+    self.title = manga.title
+    self.log(f"outline ready, {len(manga.chapters)} chapters")
+
+  def on_chapter(self, chapter_idx: int, script: MangaChapterScript, panels: int):
+    self.log(f"chapter {chapter_idx + 1} scripted, {panels} panels")
+
+  def on_panel(self, key: PanelKey, req, path: str):
+    self.panels += 1
+    if self.first_panel is None:
+      self.first_panel = time.monotonic() - self.started
+
+def read_requests(path: Path) -> list[MainRequest | str]:
+  """Requests in file order; lines that don't validate become their error message."""
+  requests = []
+  with open(path, "r", encoding="utf-8") as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith("#"):
+        continue
+      try:
+        requests.append(MainRequest.model_validate_json(line))
+      except ValidationError as e:
+        requests.append(f"Invalid request: {e}")
+  return requests
+
+async def run_job(index: int, request: MainRequest | str, out: Path, limit: asyncio.Semaphore) -> dict:
+  result_path = out / "jobs" / f"{index:04d}.json"
+  if result_path.exists():
+    with open(result_path, "r", encoding="utf-8") as f:
+      previous = json.load(f)
+    if previous.get("status") == "complete":
+      print(f"[job {index}] already complete, skipping", flush=True)
+      return {**previous, "skipped": True}
+
+  record = {"index": index, "status": "failed", "title": None, "error": None}
+  if isinstance(request, str):
+    record["error"] = request
+  else:
+    async with limit:
+      hooks = BatchHooks(index)
+      record["started"] = time.time()
+      try:
+        result = await generate_manga(request, hooks)
+        record.update(
+          status="complete",
+          title=result.manga.title,
+          chapters=len(result.manga.chapters),
+          images=result.images,
+          pages=result.pages,
+          pdf=result.pdf,
+        )
+      except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        hooks.log(f"failed: {record['error']}")
+      record.update(
+        title=record["title"] or hooks.title,
+        panels=hooks.panels,
+        seconds=round(time.monotonic() - hooks.started, 2),
+        first_panel_seconds=round(hooks.first_panel, 2) if hooks.first_panel is not None else None,
+      )
+  atomic_write(result_path, json.dumps(record, indent=2))
+  return record
+
+def summarize(records: list[dict], wall: float) -> dict:
+  ran = [record for record in records if not record.get("skipped")]
+  complete = [record for record in ran if record["status"] == "complete"]
+  panels = sum(record.get("panels", 0) for record in ran)
+  return {
+    "jobs": len(records),
+    "complete": len(complete),
+    "failed": sum(record["status"] != "complete" for record in ran),
+    "skipped": len(records) - len(ran),
+    "panels": panels,
+    "wall_seconds": round(wall, 2),
+    "panels_per_minute": round(panels * 60 / wall, 2) if wall else None,
+    "mangas_per_hour": round(len(complete) * 3600 / wall, 2) if wall else None,
+    "job_seconds_p50": percentile([record["seconds"] for record in complete], 0.5, 2),
+    "job_seconds_p95": percentile([record["seconds"] for record in complete], 0.95, 2),
+    "first_panel_seconds_p50": percentile([record["first_panel_seconds"] for record in ran if record.get("first_panel_seconds") is not None], 0.5, 2),
+    "rate_limits": rate_limiter.snapshot(),
+    "image_cache": image_cache.stats(),
+    "failures": {record["index"]: record["error"] for record in ran if record["status"] != "complete"},
+  }
+
+async def run_batch(path: Path, out: Path, jobs: int, max_in_flight: int | None = None) -> dict:
+  requests = read_requests(path)
+  if max_in_flight:
+    requests = [request.model_copy(update={"max_in_flight": max_in_flight}) if isinstance(request, MainRequest) else request for request in requests]
+  out.mkdir(parents=True, exist_ok=True)
+  limit = asyncio.Semaphore(jobs)
+  started = time.monotonic()
+  records = await asyncio.gather(*[run_job(index, request, out, limit) for index, request in enumerate(requests)])
+  summary = summarize(list(records), time.monotonic() - started)
+  with open(out / "summary.json", "w", encoding="utf-8") as f:
+    json.dump(summary, f, indent=2)
+  return summary
+
+def main():
+  parser = argparse.ArgumentParser(description="Generate mangas from a JSONL file of MainRequest objects.")
+  parser.add_argument("requests", type=Path, help="JSONL file, one MainRequest per line")
+  parser.add_argument("--out", type=Path, default=Path("runs") / time.strftime("%Y%m%d-%H%M%S"), help="directory for per-job results and the summary")
+  parser.add_argument("--jobs", type=int, default=int(os.getenv("BATCH_JOBS", "2")), help="mangas generated at the same time")
+  parser.add_argument("--max-in-flight", type=int, default=None, help="override each request's concurrent panel limit")
+  parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="serve Prometheus metrics on this port while the batch runs (0: off)")
+  args = parser.parse_args()
+
+  serve_metrics(args.metrics_port, tracer.metrics)
+  summary = asyncio.run(run_batch(args.requests, args.out, args.jobs, args.max_in_flight))
+  print(json.dumps({key: value for key, value in summary.items() if key not in ("rate_limits", "image_cache")}, indent=2))
+  raise SystemExit(1 if summary["failed"] else 0)
+
+if __name__ == "__main__":
+  main()
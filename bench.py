@@ -0,0 +1,233 @@
+"""Offline end-to-end benchmark of the manga pipeline.
+
+  python bench.py --mangas 2 --chapters 3 --out bench/latest.json
+  python bench.py --image-latency 2.0,0.8 --error-rate 0.05 --baseline bench/latest.json
+
+Runs pipeline.generate_manga against the fake Gemini backend (fakegenai.py)
+in a scratch directory and writes a JSON report: panels/sec, time to first
+panel, wall time and p50/p95/p99 per stage. With --baseline the run is
+compared to an earlier report and exits non-zero if throughput regressed by
+more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from stats import percentile
+
+def summarize(values: list[float]) -> dict:
+  if not values:
+    return {"count": 0}
+  ordered = sorted(values)
+  pick = lambda q: percentile(ordered, q, 4)
+  return {
+    "count": len(ordered),
+    "mean": round(sum(ordered) / len(ordered), 4),
+    "p50": pick(0.5),
+    "p95": pick(0.95),
+    "p99": pick(0.99),
+    "max": round(ordered[-1], 4),
+  }
+
+def git_commit() -> str | None:
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+def configure(args):
+  """Point the app at the fake backend and a scratch directory. Must run before
+  the app modules are imported, since they read their settings at import."""
+  os.environ["GEMINI_BACKEND"] = "fake"
+  os.environ["FAKE_STRUCTURED_LATENCY"] = args.structured_latency
+  os.environ["FAKE_IMAGE_LATENCY"] = args.image_latency
+  os.environ["FAKE_ERROR_RATE"] = str(args.error_rate)
+  os.environ["FAKE_NO_IMAGE_RATE"] = str(args.no_image_rate)
+  os.environ["FAKE_BLANK_IMAGE_RATE"] = str(args.blank_image_rate)
+  os.environ["FAKE_IMAGE_SIZE"] = str(args.image_size)
+  os.environ["FAKE_PAGES"] = str(args.pages)
+  os.environ["FAKE_PANELS"] = str(args.panels)
+  os.environ["FAKE_SEED"] = str(args.seed)
+  os.environ["HEDGE_REQUESTS"] = "true" if args.hedge else "false"
+  # Measure the pipeline, not a quota: keep the rate limiter out of the way unless asked
+  os.environ.setdefault("RATE_LIMIT_RPM", "1000000")
+  os.environ.setdefault("RATE_LIMIT_TPM", "1000000000")
+  os.environ.setdefault("RATE_MAX_CONCURRENCY", "256")
+  workdir = Path(args.workdir or tempfile.mkdtemp(prefix="manga-bench-"))
+  workdir.mkdir(parents=True, exist_ok=True)
+  os.chdir(workdir)
+  sys.path.insert(0, str(Path(__file__).resolve().parent))
+  return workdir
+
+async def run(args) -> dict:
+  import services
+  from gemini import client
+  from models import EncodingOptions, MainRequest
+  from pipeline import PipelineHooks, generate_manga
+  from ratelimit import rate_limiter
+  from cache import image_cache
+  from tracing import load_traces
+
+  samples: dict[str, list[float]] = defaultdict(list)
+  first_panels: list[float] = []
+
+  def timed(name, fn):
+    async def wrapper(*a, **kw):
+      start = time.monotonic()
+      try:
+        return await fn(*a, **kw)
+      finally:
+        samples[name].append(time.monotonic() - start)
+    return wrapper
+
+  # Time every API-backed call the pipeline makes, as the pipeline sees it (limits, retries, caches included)
+  services.structured = timed("call.structured", services.structured)
+  services.generate_image = timed("call.image", services.generate_image)
+
+  class BenchHooks(PipelineHooks):
+    def __init__(self):
+      self.start = time.monotonic()
+      self.stages: dict[str, float] = {}
+      self.first_panel: float | None = None
+
+    def on_stage(self, stage):
+      now = time.monotonic()
+      self.stages[stage] = now
+      if stage == 'done':
+        samples["stage.pdf"].append(now - self.stages.get('pdf', now))
+        samples["manga"].append(now - self.start)
+
+    def on_outline(self, manga):
+      samples["stage.outline"].append(time.monotonic() - self.start)
+
+    def on_character(self, character, path):
+      samples["stage.character"].append(time.monotonic() - self.stages['characters'])
+
+    def on_chapter(self, chapter_idx, script, panels):
+      samples["stage.chapter_script"].append(time.monotonic() - self.stages['chapters'])
+
+    def on_panel(self, key, req, path):
+      now = time.monotonic()
+      if self.first_panel is None:
+        self.first_panel = now - self.start
+        first_panels.append(self.first_panel)
+
+  requests = [
+    MainRequest(
+      prompt=f"Benchmark manga {i}",
+      context="",
+      instructions="",
+      num_chapters=args.chapters,
+      max_in_flight=args.max_in_flight,
+      chapter_lookahead=args.lookahead,
+      compose_pages=not args.no_compose,
+      encoding=EncodingOptions(format=args.format),
+    )
+    for i in range(args.mangas)
+  ]
+  started = time.monotonic()
+  results = await asyncio.gather(*[generate_manga(request, BenchHooks()) for request in requests], return_exceptions=True)
+  wall = time.monotonic() - started
+
+  # Per-panel timings come from the run's traces: with streamed scripts a panel can finish before its chapter's script
+  traces = load_traces(limit=args.mangas)
+  quality = defaultdict(int)
+  hedging = {"hedges": 0, "wins": 0}
+  for trace in traces:
+    for span in trace:
+      if span['name'] == 'manga':
+        for name, count in span['attrs'].get('quality', {}).items():
+          quality[name] += count
+      if span['attrs'].get('hedged'):
+        hedging["hedges"] += 1
+        hedging["wins"] += bool(span['attrs'].get('hedge_won'))
+    scripted = {span['attrs']['chapter']: span['start'] for span in trace if span['name'] == 'chapter_script'}
+    rendered = defaultdict(list)
+    for span in trace:
+      if span['name'] == 'panel' and span['status'] == 'ok':
+        samples["stage.panel"].append(span['duration'])
+        rendered[span['attrs']['key'][0]].append(span['start'] + span['duration'])
+    for chapter, start in scripted.items():
+      if rendered[chapter]:
+        samples["chapter.first_panel"].append(min(rendered[chapter]) - start)
+
+  failures = [f"{type(result).__name__}: {result}" for result in results if isinstance(result, BaseException)]
+  panels = sum(len(result.images) for result in results if not isinstance(result, BaseException))
+  return {
+    "timestamp": time.time(),
+    "commit": git_commit(),
+    "config": {key: value for key, value in vars(args).items() if key not in ("out", "baseline")},
+    "wall_seconds": round(wall, 3),
+    "mangas": args.mangas,
+    "failed_mangas": len(failures),
+    "failures": failures,
+    "panels": panels,
+    "panels_per_second": round(panels / wall, 4) if wall else None,
+    "time_to_first_panel": summarize(first_panels),
+    "stages": {name: summarize(values) for name, values in sorted(samples.items())},
+    "backend": {"calls": client.calls, "errors": client.errors, "no_images": client.no_images, "blank_images": client.blank_images, "context_caches": client.aio.caches.created},
+    "rate_limits": rate_limiter.snapshot(),
+    "image_cache": image_cache.stats(),
+    "quality": dict(quality),
+    "hedging": hedging,
+  }
+
+def compare(report: dict, baseline: dict, tolerance: float) -> bool:
+  """Print the change against a baseline report. Returns False on a throughput regression."""
+  ok = True
+  before, after = baseline.get("panels_per_second"), report.get("panels_per_second")
+  if before and after is not None:
+    change = (after - before) / before
+    print(f"panels/sec: {before} -> {after} ({change:+.1%})")
+    ok = change >= -tolerance
+  for name, stats in report["stages"].items():
+    old = baseline.get("stages", {}).get(name, {})
+    if stats.get("p95") is not None and old.get("p95"):
+      print(f"{name} p95: {old['p95']}s -> {stats['p95']}s ({(stats['p95'] - old['p95']) / old['p95']:+.1%})")
+  return ok
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the manga pipeline offline against a fake Gemini backend.")
+  parser.add_argument("--mangas", type=int, default=1, help="mangas generated concurrently")
+  parser.add_argument("--chapters", type=int, default=3)
+  parser.add_argument("--pages", type=int, default=2, help="pages per chapter")
+  parser.add_argument("--panels", type=int, default=4, help="panels per page")
+  parser.add_argument("--max-in-flight", type=int, default=4, help="panels rendered at once per manga")
+  parser.add_argument("--lookahead", type=int, default=2, help="chapters scripted ahead of rendering")
+  parser.add_argument("--format", default="jpeg", help="panel image format")
+  parser.add_argument("--no-compose", action="store_true", help="one panel per PDF page instead of composed pages")
+  parser.add_argument("--structured-latency", default="2.0,0.4", help="median seconds,sigma of the log-normal script latency")
+  parser.add_argument("--image-latency", default="1.0,0.5", help="median seconds,sigma of the log-normal image latency")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with 429/503")
+  parser.add_argument("--no-image-rate", type=float, default=0.0, help="fraction of image calls returning no image")
+  parser.add_argument("--blank-image-rate", type=float, default=0.0, help="fraction of image calls returning a blank image")
+  parser.add_argument("--image-size", type=int, default=1024, help="longest side of the synthetic images")
+  parser.add_argument("--hedge", action="store_true", help="send duplicates of straggling image requests (HEDGE_REQUESTS)")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--workdir", help="directory for generated files and caches (default: a fresh temp dir)")
+  parser.add_argument("--out", type=Path, default=Path("bench") / "latest.json", help="where to write the JSON report")
+  parser.add_argument("--baseline", type=Path, help="earlier report to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="allowed drop in panels/sec against the baseline")
+  args = parser.parse_args()
+
+  out = args.out.resolve()
+  baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+  workdir = configure(args)
+  report = asyncio.run(run(args))
+  report["workdir"] = str(workdir)
+
+  out.parent.mkdir(parents=True, exist_ok=True)
+  out.write_text(json.dumps(report, indent=2))
+  print(json.dumps({key: report[key] for key in ("wall_seconds", "panels", "panels_per_second", "time_to_first_panel", "failed_mangas")}, indent=2))
+  print(f"Report written to {out}")
+  if baseline and not compare(report, baseline, args.tolerance):
+    raise SystemExit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from pydantic import TypeAdapter, ValidationError
+from atomic import atomic_path, atomic_write
+
+CACHE_DIR = Path(os.getenv("CACHE_DIR", "nanobanana_data/.cache"))
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "2048"))
+RESPONSE_CACHE_TTL_HOURS = float(os.getenv("RESPONSE_CACHE_TTL_HOURS", "168"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+def file_sha256(path: str) -> str:
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def content_key(*parts: str) -> str:
+  digest = hashlib.sha256()
+  for part in parts:
+    data = part.encode("utf-8")
+    # Length-prefix every part so ("ab", "c") and ("a", "bc") never collide
+    digest.update(len(data).to_bytes(8, "big"))
+    digest.update(data)
+  return digest.hexdigest()
+
+def materialise(src: str, dst: str):
+  """Place a copy of `src` at `dst`, preferring a hardlink over a byte copy."""
+  with atomic_path(dst) as tmp:
+    try:
+      os.link(src, tmp)
+    except OSError:
+      shutil.copyfile(src, tmp)
+
+class ImageCache:
+  """Content-addressed on-disk store of rendered images with LRU eviction.
+
+  Entries are files named by their key. Every hit touches an empty `.used`
+  marker beside the entry, and when the store grows past `max_bytes` the least
+  recently used entries are deleted first. The entry itself is never touched:
+  it shares its inode, and so its mtime, with the panels hardlinked from it.
+  Files are only ever replaced, never rewritten in place, so a hardlinked copy
+  cannot corrupt the entry it came from.
+  """
+
+  def __init__(self, root: Path = CACHE_DIR / "images", max_bytes: int = IMAGE_CACHE_MAX_MB * 1024 * 1024):
+    self.root = Path(root)
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._size: int | None = None
+
+  def digest_key(self, prompt: str, model: str, digests: list[str], variant: str = "") -> str:
+    """Key of a render from its references' SHA-256 digests. `variant`
+    distinguishes encodings of the same render (format, quality, size)."""
+    return content_key(prompt, model, variant, *digests)
+
+  def _entry(self, key: str) -> Path:
+    return self.root / key[:2] / f"{key}.img"
+
+  @staticmethod
+  def _marker(entry: Path) -> Path:
+    return entry.with_suffix(".used")
+
+  def get(self, key: str, path: str) -> bool:
+    """Materialise the cached image for `key` at `path`. Returns False on a miss."""
+    entry = self._entry(key)
+    try:
+      materialise(str(entry), path)
+    except FileNotFoundError:
+      self.misses += 1
+      return False
+    self._marker(entry).touch()
+    self.hits += 1
+    return True
+
+  def put(self, key: str, path: str):
+    entry = self._entry(key)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    existed = entry.exists()
+    materialise(path, str(entry))
+    if not existed and self._size is not None:
+      self._size += entry.stat().st_size
+    self.evict()
+
+  def evict(self):
+    entries = None
+    if self._size is None:
+      entries = self._entries()
+      self._size = sum(size for _, _, size in entries)
+    if self._size <= self.max_bytes:
+      return
+    entries = sorted(entries if entries is not None else self._entries())
+    for _, entry, size in entries:
+      if self._size <= self.max_bytes:
+        break
+      entry.unlink(missing_ok=True)
+      self._marker(entry).unlink(missing_ok=True)
+      self._size -= size
+      self.evictions += 1
+
+  def _entries(self) -> list[tuple[float, Path, int]]:
+    entries = []
+    for entry in self.root.glob("*/*.img"):
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        continue
+      try:
+        used = self._marker(entry).stat().st_mtime
+      except FileNotFoundError:
+        used = 0.0
+      entries.append((max(stat.st_mtime, used), entry, stat.st_size))
+    return entries
+
+  def stats(self) -> dict:
+    total = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / total if total else 0.0,
+      "evictions": self.evictions,
+      "bytes": self._size,
+      "max_bytes": self.max_bytes,
+    }
+
+class ResponseCache:
+  """Persistent cache of parsed structured() responses.
+
+  The key covers the prompt, the JSON schema of the response type, the model
+  and the content of every context file. Entries expire `ttl` seconds after
+  they were written, the oldest are dropped past `max_entries`, and every hit
+  is revalidated through the response type, so a schema change or a corrupt
+  file is just a miss.
+  """
+
+  def __init__(self, root: Path = CACHE_DIR / "responses", ttl: float = RESPONSE_CACHE_TTL_HOURS * 3600, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+    self.root = Path(root)
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, prompt: str, schema, model: str, files: list[str]) -> str:
+    schema_json = json.dumps(TypeAdapter(schema).json_schema(), sort_keys=True)
+    return content_key(prompt, schema_json, model, *(file_sha256(file) for file in files))
+
+  def _entry(self, key: str) -> Path:
+    return self.root / f"{key}.json"
+
+  def get(self, key: str, schema):
+    entry = self._entry(key)
+    try:
+      if time.time() - entry.stat().st_mtime > self.ttl:
+        entry.unlink(missing_ok=True)
+        raise FileNotFoundError(entry)
+      value = TypeAdapter(schema).validate_json(entry.read_bytes())
+    except (FileNotFoundError, ValidationError):
+      entry.unlink(missing_ok=True)
+      self.misses += 1
+      return None
+    self.hits += 1
+    return value
+
+  def put(self, key: str, schema, value):
+    self.root.mkdir(parents=True, exist_ok=True)
+    entry = self._entry(key)
+    atomic_write(entry, TypeAdapter(schema).dump_json(value))
+    self.evict()
+
+  def evict(self):
+    entries = sorted(self.root.glob("*.json"), key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:max(0, len(entries) - self.max_entries)]:
+      entry.unlink(missing_ok=True)
+
+  def stats(self) -> dict:
+    total = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / total if total else 0.0,
+      "max_entries": self.max_entries,
+    }
+
+image_cache = ImageCache()
+response_cache = ResponseCache()
@@ -0,0 +1,132 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from models import PageLayout
+
+PAGE_WIDTH = int(os.getenv("PAGE_WIDTH", "1400"))
+PAGE_HEIGHT = int(os.getenv("PAGE_HEIGHT", "2000"))
+PAGE_MARGIN = int(os.getenv("PAGE_MARGIN", "48"))
+PAGE_GUTTER = int(os.getenv("PAGE_GUTTER", "20"))
+PANEL_BORDER = int(os.getenv("PANEL_BORDER", "4"))
+# 'cover' crops a panel to fill its cell, 'contain' letterboxes it inside the cell
+PANEL_FIT = os.getenv("PANEL_FIT", "cover")
+
+Box = tuple[int, int, int, int]
+
+class PageCompositor:
+  """Tiles a page's panel images into one manga page following its PageLayout.
+
+  Panels are decoded and resampled in a thread pool (Pillow releases the GIL
+  while resizing), with JPEG draft mode and reducing_gap doing most of the
+  downscale cheaply. The page itself is assembled as a single numpy array,
+  so gutters and borders are a handful of slice assignments.
+  """
+
+  def __init__(self, size: tuple[int, int] = (PAGE_WIDTH, PAGE_HEIGHT), margin: int = PAGE_MARGIN, gutter: int = PAGE_GUTTER, border: int = PANEL_BORDER, fit: str = PANEL_FIT, workers: int | None = None):
+    if fit not in ('cover', 'contain'):
+      raise ValueError(f"Unknown panel fit '{fit}', expected 'cover' or 'contain'")
+    self.size = size
+    self.margin = margin
+    self.gutter = gutter
+    self.border = border
+    self.fit = fit
+    self.workers = workers or min(8, (os.cpu_count() or 1) + 4)
+
+  def cells(self, layout: PageLayout, panel_numbers: list[int]) -> dict[int, Box]:
+    """Pixel box of every panel. Placements from the script are clamped to the
+    grid, and panels without a usable placement flow into the first free cells."""
+    rows, cols = max(1, layout.grid_rows), max(1, layout.grid_columns)
+    placements = [p for p in layout.placements if p.panel_number in panel_numbers]
+    # Scripts use both 0- and 1-based grid coordinates; a 0-based layout always has something at 0
+    offset = 0 if not placements or min(min(p.grid_row, p.grid_col) for p in placements) == 0 else 1
+
+    spans: dict[int, tuple[int, int, int, int]] = {}
+    taken = np.zeros((rows, cols), dtype=bool)
+    for p in placements:
+      if p.panel_number in spans:
+        continue
+      row = min(max(p.grid_row - offset, 0), rows - 1)
+      col = min(max(p.grid_col - offset, 0), cols - 1)
+      row_span = min(max(p.row_span, 1), rows - row)
+      col_span = min(max(p.col_span, 1), cols - col)
+      spans[p.panel_number] = (row, col, row_span, col_span)
+      taken[row:row + row_span, col:col + col_span] = True
+
+    missing = [number for number in panel_numbers if number not in spans]
+    free = iter(np.argwhere(~taken).tolist())
+    for number in missing:
+      cell = next(free, None)
+      if cell is None:
+        # The grid is full; stack leftovers as extra full-width rows
+        rows += 1
+        taken = np.vstack([taken, np.zeros((1, cols), dtype=bool)])
+        spans[number] = (rows - 1, 0, 1, cols)
+        taken[rows - 1] = True
+      else:
+        spans[number] = (cell[0], cell[1], 1, 1)
+
+    width, height = self.size
+    cell_w = (width - 2 * self.margin - (cols - 1) * self.gutter) / cols
+    cell_h = (height - 2 * self.margin - (rows - 1) * self.gutter) / rows
+    boxes = {}
+    for number, (row, col, row_span, col_span) in spans.items():
+      x0 = self.margin + col * (cell_w + self.gutter)
+      y0 = self.margin + row * (cell_h + self.gutter)
+      x1 = x0 + col_span * cell_w + (col_span - 1) * self.gutter
+      y1 = y0 + row_span * cell_h + (row_span - 1) * self.gutter
+      boxes[number] = (round(x0), round(y0), round(x1), round(y1))
+    return boxes
+
+  def _fit(self, path: str, box: Box) -> np.ndarray | None:
+    size = (box[2] - box[0] - 2 * self.border, box[3] - box[1] - 2 * self.border)
+    if size[0] <= 0 or size[1] <= 0 or not os.path.exists(path):
+      return None
+    with Image.open(path) as image:
+      # Let the JPEG decoder do a cheap power-of-two downscale before the real resample
+      image.draft("RGB", size)
+      image = image.convert("RGB")
+      if self.fit == 'cover':
+        # Centre-crop to the cell's aspect ratio as part of the resample itself
+        scale = max(size[0] / image.width, size[1] / image.height)
+        crop_w, crop_h = size[0] / scale, size[1] / scale
+        left, top = (image.width - crop_w) / 2, (image.height - crop_h) / 2
+        image = image.resize(size, Image.Resampling.LANCZOS, box=(left, top, left + crop_w, top + crop_h), reducing_gap=2.0)
+        return np.asarray(image)
+      image.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+      cell = np.full((size[1], size[0], 3), 255, dtype=np.uint8)
+      top, left = (size[1] - image.height) // 2, (size[0] - image.width) // 2
+      cell[top:top + image.height, left:left + image.width] = np.asarray(image)
+      return cell
+
+  def _assemble(self, jobs: list[tuple[Box, str]], tiles: list[np.ndarray | None], out_path: str) -> str:
+    width, height = self.size
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    b = self.border
+    for (box, _), tile in zip(jobs, tiles):
+      x0, y0, x1, y1 = box
+      if b:
+        page[y0:y1, x0:x1] = 0
+        page[y0 + b:y1 - b, x0 + b:x1 - b] = 255
+      if tile is not None:
+        page[y0 + b:y0 + b + tile.shape[0], x0 + b:x0 + b + tile.shape[1]] = tile
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    Image.fromarray(page).save(out_path, quality=90)
+    return out_path
+
+  def compose(self, layout: PageLayout, panels: list[tuple[int, str]], out_path: str) -> str:
+    """Render one page from (panel_number, image_path) pairs and save it to `out_path`."""
+    return self.compose_pages([(layout, panels, out_path)])[0]
+
+  def compose_pages(self, pages: list[tuple[PageLayout, list[tuple[int, str]], str]]) -> list[str]:
+    """Compose many pages at once: every panel of every page is resampled as one
+    batch on the pool, then each page is assembled and encoded on the pool too."""
+    page_jobs = []
+    for layout, panels, _ in pages:
+      boxes = self.cells(layout, [number for number, _ in panels])
+      page_jobs.append([(boxes[number], path) for number, path in panels])
+    flat = [job for jobs in page_jobs for job in jobs]
+    with ThreadPoolExecutor(self.workers) as pool:
+      flat_tiles = iter(list(pool.map(lambda job: self._fit(job[1], job[0]), flat)))
+      tiles = [[next(flat_tiles) for _ in jobs] for jobs in page_jobs]
+      return list(pool.map(self._assemble, page_jobs, tiles, [out_path for _, _, out_path in pages]))
@@ -0,0 +1,11 @@
+import os
+
+# Panels of one manga rendered at once, unless a request says otherwise
+MAX_PANELS_IN_FLIGHT = int(os.getenv("MAX_PANELS_IN_FLIGHT", "4"))
+# Chapter scripts written ahead of the chapter being rendered
+CHAPTER_LOOKAHEAD = int(os.getenv("CHAPTER_LOOKAHEAD", "2"))
+
+def env_flag(name: str, default: bool) -> bool:
+  """A boolean setting: '1', 'true' or 'yes' (any case) turn it on, anything else off."""
+  value = os.getenv(name)
+  return default if value is None else value.lower() in ("1", "true", "yes")
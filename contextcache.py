@@ -0,0 +1,68 @@
+import os
+from google.genai import errors
+from gemini import client
+from ratelimit import estimate_tokens
+from sharedtasks import SharedTasks
+from config import env_flag
+
+CONTEXT_CACHE = env_flag("CONTEXT_CACHE", True)
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+# The API refuses to cache less than this; shorter prefixes are sent inline without trying
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))
+# Errors on a cached call that mean the cache itself is gone (expired or deleted)
+STALE_CACHE_CODES = (403, 404)
+
+class CachedPrefix:
+  """A prompt prefix shared by several structured calls of one manga.
+
+  The prefix is put in a Gemini cached-content handle the first time it is
+  needed and the handle is shared by every later call, so the long
+  instructions and character roster are sent and processed once instead of
+  once per chapter. When caching is off, unsupported for the model or the
+  prefix is too short, `handle()` returns None and callers send the prefix
+  inline, which gives the same prompt.
+  """
+
+  def __init__(self, model: str, text: str, ttl: int = CONTEXT_CACHE_TTL, enabled: bool = CONTEXT_CACHE):
+    self.model = model
+    self.text = text
+    self.ttl = ttl
+    self.enabled = enabled and estimate_tokens(text) >= CONTEXT_CACHE_MIN_TOKENS
+    self._created: SharedTasks[None, str | None] = SharedTasks()
+
+  async def _create(self) -> str | None:
+    try:
+      cache = await client.aio.caches.create(
+        model=self.model,
+        config={"contents": [self.text], "ttl": f"{self.ttl}s", "display_name": "manga-script-prefix"},
+      )
+      return cache.name
+    except Exception as e:
+      # Caching is an optimisation: whatever went wrong, fall back to sending the prefix inline
+      print(f"Context cache unavailable for {self.model}, sending the prompt prefix inline: {e}")
+      self.enabled = False
+      return None
+
+  async def handle(self) -> str | None:
+    """Name of the cached content, created on first use; None to send the prefix inline."""
+    if not self.enabled:
+      return None
+    return await self._created.run(None, self._create)
+
+  def stale(self, e: BaseException) -> bool:
+    """Whether a failed cached call should be sent again inline; stops using the cache if so."""
+    if isinstance(e, errors.APIError) and e.code in STALE_CACHE_CODES:
+      print(f"Context cache for {self.model} is gone, sending the prompt prefix inline: {e}")
+      self.enabled = False
+      return True
+    return False
+
+  async def close(self):
+    """Delete the cached content instead of waiting for its TTL."""
+    task = self._created.pop(None)
+    name = await task if task else None
+    if name:
+      try:
+        await client.aio.caches.delete(name=name)
+      except Exception as e:
+        print(f"Could not delete context cache {name}: {e}")
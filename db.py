@@ -0,0 +1,32 @@
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+
+@contextmanager
+def connect(path: Path):
+  """A fresh SQLite connection in autocommit mode, WAL journal and foreign keys on.
+
+  Connections aren't shared, so callers can use them from any thread or process;
+  WAL lets readers poll while another process writes.
+  """
+  db = sqlite3.connect(path, timeout=30, isolation_level=None)
+  db.row_factory = sqlite3.Row
+  try:
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA foreign_keys=ON")
+    yield db
+  finally:
+    db.close()
+
+@contextmanager
+def transaction(path: Path):
+  """A connection inside BEGIN IMMEDIATE, committed on success and rolled back on error."""
+  with connect(path) as db:
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      yield db
+    except BaseException:
+      db.execute("ROLLBACK")
+      raise
+    db.execute("COMMIT")
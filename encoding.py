@@ -0,0 +1,59 @@
+import os
+from io import BytesIO
+from PIL import Image, features
+from models import EncodingOptions
+from atomic import atomic_write
+
+EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'avif': '.avif'}
+MIME_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.webp': 'image/webp', '.avif': 'image/avif'}
+
+def resolve_format(fmt: str) -> str:
+  """The requested format, falling back to WebP when Pillow was built without AVIF."""
+  fmt = fmt.lower()
+  if fmt == 'jpg':
+    fmt = 'jpeg'
+  if fmt not in EXTENSIONS:
+    raise ValueError(f"Unsupported image format '{fmt}', expected one of {', '.join(EXTENSIONS)}")
+  if fmt == 'avif' and not features.check('avif'):
+    return 'webp'
+  return fmt
+
+def output_path(path: str, options: EncodingOptions) -> str:
+  """`path` with the extension of the format the options will produce."""
+  return os.path.splitext(path)[0] + EXTENSIONS[resolve_format(options.format)]
+
+def mime_type(path: str) -> str:
+  return MIME_TYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+def encode(image: Image.Image, options: EncodingOptions) -> tuple[bytes, str]:
+  """Encode `image` per `options`. Returns the bytes and the file extension."""
+  fmt = resolve_format(options.format)
+  if options.max_dimension and max(image.size) > options.max_dimension:
+    image = image.copy()
+    image.thumbnail((options.max_dimension, options.max_dimension), Image.Resampling.LANCZOS, reducing_gap=2.0)
+  if fmt != 'png' and image.mode not in ('RGB', 'L'):
+    image = image.convert('RGB')
+
+  params = {}
+  if fmt == 'png':
+    params = {'optimize': True}
+  elif fmt == 'jpeg':
+    params = {'quality': options.quality, 'subsampling': options.subsampling, 'optimize': True, 'progressive': True}
+  elif fmt == 'webp':
+    params = {'quality': options.quality, 'method': 6}
+  elif fmt == 'avif':
+    params = {'quality': options.quality, 'subsampling': options.subsampling}
+
+  buffer = BytesIO()
+  image.save(buffer, format=fmt.upper(), **params)
+  return buffer.getvalue(), EXTENSIONS[fmt]
+
+def encode_to_file(data: bytes, path: str, options: EncodingOptions) -> str:
+  """Decode model output bytes, encode them per `options` and write the result
+  next to `path` with the right extension. Returns the path written."""
+  with Image.open(BytesIO(data)) as image:
+    encoded, ext = encode(image, options)
+  out = os.path.splitext(path)[0] + ext
+  # Swapped in whole, so a hardlinked cache entry at `out` is never rewritten
+  atomic_write(out, encoded)
+  return out
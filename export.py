@@ -0,0 +1,60 @@
+import os
+import re
+import zipfile
+from xml.etree import ElementTree as ET
+from models import Manga
+from atomic import atomic_path
+
+ID_PATTERN = re.compile(r"^(\d+(?:_\d+)*)$")
+
+def panel_order(path: str) -> tuple:
+  """Sort key from a stored panel id such as '2_0_3' (chapter_page_panel).
+  Files without a numeric id sort after all panels, by name."""
+  stem = os.path.splitext(os.path.basename(path))[0]
+  match = ID_PATTERN.match(stem)
+  if match:
+    return (0, tuple(int(part) for part in match.group(1).split("_")), stem)
+  return (1, (), stem)
+
+def comic_info(title: str, pages: int, manga: Manga | None = None, lang: str | None = None) -> bytes:
+  """ComicInfo.xml as read by CBZ readers (ComicRack schema)."""
+  root = ET.Element("ComicInfo", {
+    "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "xmlns:xsd": "http://www.w3.org/2001/XMLSchema",
+  })
+  ET.SubElement(root, "Title").text = title
+  ET.SubElement(root, "Series").text = title
+  if manga:
+    ET.SubElement(root, "Summary").text = "\n\n".join(
+      f"Chapter {i + 1}: {chapter.chapter_title}\n{chapter.story}" for i, chapter in enumerate(manga.chapters)
+    )
+    characters = ", ".join(ch.character_id for ch in manga.global_style.character_sheets)
+    if characters:
+      ET.SubElement(root, "Characters").text = characters
+  if lang:
+    ET.SubElement(root, "LanguageISO").text = lang
+  ET.SubElement(root, "PageCount").text = str(pages)
+  ET.SubElement(root, "Manga").text = "Yes"
+  pages_el = ET.SubElement(root, "Pages")
+  for i in range(pages):
+    ET.SubElement(pages_el, "Page", {"Image": str(i), **({"Type": "FrontCover"} if i == 0 else {})})
+  ET.indent(root)
+  return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+def export_archive(images: list[str], out_path: str, title: str, manga: Manga | None = None, cbz: bool = True, lang: str | None = None) -> str:
+  """Write the manga's images to a CBZ (with ComicInfo.xml) or plain ZIP.
+
+  Entries are ordered by chapter/page/panel and copied from disk in chunks by
+  ZipFile.write, stored without recompression since the images are already
+  compressed, so memory use does not depend on the size of the manga.
+  """
+  images = sorted((path for path in images if os.path.exists(path)), key=panel_order)
+  width = max(3, len(str(len(images))))
+  # Sessions exporting the same manga at once each write their own temp archive
+  with atomic_path(out_path) as tmp:
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+      for i, path in enumerate(images):
+        archive.write(path, f"{i:0{width}d}{os.path.splitext(path)[1].lower()}")
+      if cbz:
+        archive.writestr("ComicInfo.xml", comic_info(title, len(images), manga, lang), compress_type=zipfile.ZIP_DEFLATED)
+  return out_path
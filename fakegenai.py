@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import math
+import os
+import random
+import re
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+from google.genai import errors, types
+from models import (
+  Chapter, CharacterSheet, GlobalStyle, Manga, MangaChapterScript, Page, PageLayout, Panel, PanelPlacement, PromptComponents,
+)
+
+def _latency(name: str, default: str) -> tuple[float, float]:
+  median, sigma = os.getenv(name, default).split(",")
+  return float(median), float(sigma)
+
+# Latencies are log-normal: "median seconds,sigma"
+FAKE_STRUCTURED_LATENCY = _latency("FAKE_STRUCTURED_LATENCY", "2.0,0.4")
+FAKE_IMAGE_LATENCY = _latency("FAKE_IMAGE_LATENCY", "1.0,0.5")
+FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0.0"))
+FAKE_NO_IMAGE_RATE = float(os.getenv("FAKE_NO_IMAGE_RATE", "0.0"))
+# Share of images that come back blank, for exercising the quality gate
+FAKE_BLANK_IMAGE_RATE = float(os.getenv("FAKE_BLANK_IMAGE_RATE", "0.0"))
+FAKE_IMAGE_SIZE = int(os.getenv("FAKE_IMAGE_SIZE", "1024"))
+FAKE_CHAPTERS = int(os.getenv("FAKE_CHAPTERS", "3"))
+FAKE_CHARACTERS = int(os.getenv("FAKE_CHARACTERS", "3"))
+FAKE_PAGES = int(os.getenv("FAKE_PAGES", "2"))
+FAKE_PANELS = int(os.getenv("FAKE_PANELS", "4"))
+FAKE_SEED = int(os.getenv("FAKE_SEED", "0"))
+# Characters per streamed chunk
+FAKE_STREAM_CHUNK = int(os.getenv("FAKE_STREAM_CHUNK", "200"))
+
+ASPECT_RATIOS = ["1:1", "4:3", "3:4", "16:9", "9:16"]
+WORDS = "shadow village ninja storm ancient blade rooftop lantern river mask spirit dawn".split()
+
+def _words(rng: random.Random, count: int) -> str:
+  return " ".join(rng.choice(WORDS) for _ in range(count))
+
+def fake_manga(rng: random.Random, chapters: int) -> Manga:
+  characters = [
+    CharacterSheet(character_id=f"character_{i + 1}", personality=_words(rng, 4), detailed_appearence=_words(rng, 20))
+    for i in range(FAKE_CHARACTERS)
+  ]
+  return Manga(
+    title=f"Bench {_words(rng, 2).title()} {rng.randrange(10**6)}",
+    global_style=GlobalStyle(art_style_description=_words(rng, 12), character_sheets=characters),
+    chapters=[Chapter(chapter_number=i + 1, chapter_title=_words(rng, 3).title(), story=_words(rng, 80)) for i in range(chapters)],
+  )
+
+def fake_script(rng: random.Random, chapter_number: int) -> MangaChapterScript:
+  pages = []
+  for page_number in range(1, FAKE_PAGES + 1):
+    columns = 2 if FAKE_PANELS > 1 else 1
+    rows = math.ceil(FAKE_PANELS / columns)
+    panels = [
+      Panel(panel_number=n, scene_description=PromptComponents(
+        camera_shot=_words(rng, 2),
+        subject=_words(rng, 3),
+        emotion=rng.choice(WORDS),
+        action_description=_words(rng, 8),
+        environment_description=_words(rng, 10),
+        style_tags=[rng.choice(WORDS) for _ in range(3)],
+        aspect_ratio=rng.choice(ASPECT_RATIOS),
+        character_ids=rng.sample([f"character_{i + 1}" for i in range(FAKE_CHARACTERS)], k=min(2, FAKE_CHARACTERS)),
+      ))
+      for n in range(1, FAKE_PANELS + 1)
+    ]
+    placements = [
+      PanelPlacement(panel_number=n, grid_row=(n - 1) // columns, grid_col=(n - 1) % columns, row_span=1, col_span=1)
+      for n in range(1, FAKE_PANELS + 1)
+    ]
+    pages.append(Page(page_number=page_number, layout=PageLayout(grid_rows=rows, grid_columns=columns, placements=placements), panels=panels))
+  return MangaChapterScript(chapter_number=chapter_number, chapter_title=_words(rng, 3).title(), pages=pages)
+
+def fake_image(rng: random.Random, prompt: str, blank: bool = False) -> bytes:
+  """A smooth random PNG, shaped to the aspect ratio named in the prompt; a single colour if `blank`."""
+  match = re.search(r"\b(\d{1,2}):(\d{1,2})\b", prompt)
+  ratio = int(match.group(1)) / int(match.group(2)) if match else 1.0
+  size = (FAKE_IMAGE_SIZE, max(1, round(FAKE_IMAGE_SIZE / ratio))) if ratio >= 1 else (max(1, round(FAKE_IMAGE_SIZE * ratio)), FAKE_IMAGE_SIZE)
+  noise = np.random.default_rng(rng.randrange(2**32)).integers(0, 256, (1, 1, 3) if blank else (8, 8, 3), dtype=np.uint8)
+  buffer = BytesIO()
+  Image.fromarray(noise).resize(size, Image.Resampling.BICUBIC).save(buffer, format="PNG", compress_level=1)
+  return buffer.getvalue()
+
+class FakeModels:
+  def __init__(self, client: "FakeClient"):
+    self.client = client
+
+  def _request(self, contents, config) -> tuple:
+    """Schema, prompt, usage and latency of a call; raises like the API for an unknown cache."""
+    client = self.client
+    config = config or {}
+    schema = config.get("response_schema") if isinstance(config, dict) else getattr(config, "response_schema", None)
+    cached_content = config.get("cached_content") if isinstance(config, dict) else getattr(config, "cached_content", None)
+    prompt = "\n".join(part for part in contents if isinstance(part, str))
+    cached = ""
+    if cached_content:
+      if cached_content not in client.aio.caches.contents:
+        raise errors.APIError(404, {"error": {"code": 404, "message": f"Cached content {cached_content} not found", "status": "NOT_FOUND"}})
+      cached = client.aio.caches.contents[cached_content]
+    prompt_tokens = (len(cached) + len(prompt)) // 4
+    usage = types.GenerateContentResponseUsageMetadata(prompt_token_count=prompt_tokens, cached_content_token_count=len(cached) // 4 or None, total_token_count=prompt_tokens + 500)
+    median, sigma = FAKE_STRUCTURED_LATENCY if schema else FAKE_IMAGE_LATENCY
+    latency = client.rng.lognormvariate(math.log(median), sigma) if median > 0 else 0
+    return schema, prompt, usage, latency
+
+  def _answer(self):
+    """Count the call and fail it at FAKE_ERROR_RATE."""
+    client = self.client
+    client.calls += 1
+    if client.rng.random() < FAKE_ERROR_RATE:
+      client.errors += 1
+      code = client.rng.choice([429, 503])
+      raise errors.APIError(code, {"error": {"code": code, "message": "Fake backend error", "status": "UNAVAILABLE"}})
+
+  def _parsed(self, schema, prompt: str):
+    client = self.client
+    if schema is Manga:
+      match = re.search(r"Number of Chapters:\s*(\d+)", prompt)
+      return fake_manga(client.rng, int(match.group(1)) if match else FAKE_CHAPTERS)
+    if schema is MangaChapterScript:
+      # The chapter prompt doesn't carry its number; scripts are numbered in call order
+      client.scripts += 1
+      return fake_script(client.rng, client.scripts)
+    raise ValueError(f"Fake backend has no generator for {schema}")
+
+  async def generate_content(self, model: str, contents, config=None):
+    client = self.client
+    schema, prompt, usage, latency = self._request(contents, config)
+    await asyncio.sleep(latency)
+    self._answer()
+
+    if schema is None:
+      if client.rng.random() < FAKE_NO_IMAGE_RATE:
+        client.no_images += 1
+        part = types.Part(text="I can't draw that.")
+        return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(parts=[part]), finish_reason="STOP")], usage_metadata=usage)
+      blank = client.rng.random() < FAKE_BLANK_IMAGE_RATE
+      client.blank_images += blank
+      data = await asyncio.to_thread(fake_image, random.Random(client.rng.random()), prompt, blank)
+      part = types.Part(inline_data=types.Blob(data=data, mime_type="image/png"))
+      return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(parts=[part]), finish_reason="STOP")], usage_metadata=usage)
+
+    parsed = self._parsed(schema, prompt)
+    return types.GenerateContentResponse(
+      candidates=[types.Candidate(content=types.Content(parts=[types.Part(text=parsed.model_dump_json())]), finish_reason="STOP")],
+      usage_metadata=usage,
+      parsed=parsed,
+    )
+
+  async def generate_content_stream(self, model: str, contents, config=None):
+    """Structured output only. The first chunk comes after a tenth of the
+    latency and the rest of the JSON is spread evenly over the remainder."""
+    schema, prompt, usage, latency = self._request(contents, config)
+    if schema is None:
+      raise ValueError("Fake backend only streams structured output")
+    await asyncio.sleep(latency * 0.1)
+    self._answer()
+    text = self._parsed(schema, prompt).model_dump_json()
+    pieces = [text[i:i + FAKE_STREAM_CHUNK] for i in range(0, len(text), FAKE_STREAM_CHUNK)]
+
+    async def chunks():
+      for i, piece in enumerate(pieces):
+        await asyncio.sleep(latency * 0.9 / len(pieces))
+        last = i == len(pieces) - 1
+        yield types.GenerateContentResponse(
+          candidates=[types.Candidate(content=types.Content(parts=[types.Part(text=piece)]), finish_reason="STOP" if last else None)],
+          usage_metadata=usage if last else None,
+        )
+    return chunks()
+
+class FakeFiles:
+  async def upload(self, file, config=None):
+    with open(file, "rb") as f:
+      digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    return types.File(
+      name=f"files/{digest}",
+      uri=f"https://fake.invalid/files/{digest}",
+      mime_type="application/octet-stream",
+      state=types.FileState.ACTIVE,
+      expiration_time=datetime.now(timezone.utc) + timedelta(hours=48),
+    )
+
+  async def get(self, name: str, config=None):
+    return types.File(name=name, state=types.FileState.ACTIVE, expiration_time=datetime.now(timezone.utc) + timedelta(hours=48))
+
+class FakeCaches:
+  def __init__(self):
+    self.contents: dict[str, str] = {}
+    self.created = 0
+
+  async def create(self, model: str, config=None):
+    config = config or {}
+    contents = config.get("contents", []) if isinstance(config, dict) else (config.contents or [])
+    self.created += 1
+    name = f"cachedContents/{self.created}"
+    self.contents[name] = "\n".join(part for part in contents if isinstance(part, str))
+    return types.CachedContent(name=name, model=model, expire_time=datetime.now(timezone.utc) + timedelta(hours=1))
+
+  async def delete(self, name: str, config=None):
+    self.contents.pop(name, None)
+
+class FakeClient:
+  """Stands in for genai.Client with no network and no quota.
+
+  Structured calls return schema-valid Manga and MangaChapterScript objects,
+  image calls return synthetic PNGs, and both wait a log-normal latency and
+  fail at the configured rates, so the whole pipeline can be run and timed
+  offline. Select it with GEMINI_BACKEND=fake.
+  """
+
+  def __init__(self, seed: int = FAKE_SEED):
+    self.rng = random.Random(seed)
+    self.calls = 0
+    self.errors = 0
+    self.no_images = 0
+    self.blank_images = 0
+    self.scripts = 0
+    self.aio = SimpleNamespace(models=FakeModels(self), files=FakeFiles(), caches=FakeCaches())
+    self.models = self.aio.models
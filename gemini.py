@@ -1,5 +1,11 @@
+import os
 from google import genai
 from dotenv import load_dotenv
 load_dotenv()
 
-client = genai.Client()
+# GEMINI_BACKEND=fake swaps in an offline stand-in, for benchmarks and development
+if os.getenv("GEMINI_BACKEND", "genai") == "fake":
+  from fakegenai import FakeClient
+  client = FakeClient()
+else:
+  client = genai.Client()
@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from models import JobEvent, JobRecord, MainRequest, MangaResult
+from services import DATA_DIR
+from db import connect, transaction
+
+JOB_DB = Path(os.getenv("JOB_DB", f"{DATA_DIR}/jobs.db"))
+# A running job whose worker hasn't checked in for this long is handed to another worker
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "60"))
+ACTIVE_STATUSES = ('queued', 'running')
+# Back to the queue, resuming from the job's manifest once it has one
+REQUEUE = (
+  "status = 'queued', worker = NULL,"
+  " kind = CASE WHEN manifest IS NULL THEN kind ELSE 'resume' END,"
+  " payload = COALESCE(manifest, payload)"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'queued',
+  owner TEXT,
+  worker TEXT,
+  created REAL NOT NULL,
+  started REAL,
+  finished REAL,
+  heartbeat REAL,
+  stage TEXT,
+  progress REAL NOT NULL DEFAULT 0,
+  title TEXT,
+  panels_done INTEGER NOT NULL DEFAULT 0,
+  panels_total INTEGER NOT NULL DEFAULT 0,
+  manifest TEXT,
+  result TEXT,
+  error TEXT,
+  cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS job_events (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  job_id INTEGER NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+  created REAL NOT NULL,
+  kind TEXT NOT NULL,
+  data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id);
+CREATE TABLE IF NOT EXISTS workers (
+  id TEXT PRIMARY KEY,
+  pid INTEGER NOT NULL,
+  started REAL NOT NULL,
+  heartbeat REAL NOT NULL,
+  job_id INTEGER,
+  rate_limits TEXT
+);
+"""
+
+class JobQueue:
+  """Persistent queue of generation jobs shared by the UI and the workers.
+
+  The UI enqueues jobs and polls their progress; worker processes claim them,
+  report stages, characters and panels as events, and store the result.
+  """
+
+  def __init__(self, path: Path = JOB_DB):
+    self.path = Path(path)
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    with connect(self.path) as db:
+      db.executescript(SCHEMA)
+
+  @staticmethod
+  def _job(row: sqlite3.Row | None) -> JobRecord | None:
+    if row is None:
+      return None
+    job = dict(row)
+    job["result"] = MangaResult.model_validate_json(job["result"]) if job["result"] else None
+    return JobRecord.model_validate(job)
+
+  def _insert(self, kind: str, payload: str, owner: str | None, manifest: str | None = None) -> int:
+    with connect(self.path) as db:
+      cursor = db.execute(
+        "INSERT INTO jobs (kind, payload, owner, manifest, created) VALUES (?, ?, ?, ?, ?)",
+        (kind, payload, owner, manifest, time.time()),
+      )
+      return cursor.lastrowid
+
+  def enqueue(self, request: MainRequest, owner: str | None = None) -> int:
+    return self._insert('generate', request.model_dump_json(), owner)
+
+  def enqueue_resume(self, manifest_path: Path, owner: str | None = None) -> int:
+    return self._insert('resume', str(manifest_path), owner, str(manifest_path))
+
+  def claim(self, worker: str) -> JobRecord | None:
+    """Atomically take the oldest queued job for `worker`."""
+    now = time.time()
+    with connect(self.path) as db:
+      row = db.execute(
+        "UPDATE jobs SET status = 'running', worker = ?, started = COALESCE(started, ?), heartbeat = ?"
+        " WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1) RETURNING *",
+        (worker, now, now),
+      ).fetchone()
+      if row:
+        db.execute("UPDATE workers SET job_id = ? WHERE id = ?", (row["id"], worker))
+      return self._job(row)
+
+  def get(self, job_id: int) -> JobRecord | None:
+    with connect(self.path) as db:
+      return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+  def jobs(self, statuses: tuple[str, ...] = ACTIVE_STATUSES, owner: str | None = None, limit: int = 50) -> list[JobRecord]:
+    query = f"SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(statuses))})"
+    params: list = list(statuses)
+    if owner:
+      query += " AND owner = ?"
+      params.append(owner)
+    with connect(self.path) as db:
+      rows = db.execute(f"{query} ORDER BY id DESC LIMIT ?", (*params, limit)).fetchall()
+    return [self._job(row) for row in rows]
+
+  def update(self, job_id: int, **fields):
+    if not fields:
+      return
+    columns = ", ".join(f"{column} = ?" for column in fields)
+    with connect(self.path) as db:
+      db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+  def add_event(self, job_id: int, kind: str, data: dict | None = None, **fields):
+    """Record a progress event and optionally update the job's columns with it."""
+    self.add_events(job_id, [(kind, data, fields)])
+
+  def add_events(self, job_id: int, events: list[tuple[str, dict | None, dict]]):
+    """Record (kind, data, fields) events in order in one transaction; later fields win."""
+    now = time.time()
+    fields = {}
+    for _, _, changes in events:
+      fields.update(changes)
+    with transaction(self.path) as db:
+      db.executemany(
+        "INSERT INTO job_events (job_id, created, kind, data) VALUES (?, ?, ?, ?)",
+        [(job_id, now, kind, json.dumps(data or {})) for kind, data, _ in events],
+      )
+      columns = "".join(f", {column} = ?" for column in fields)
+      db.execute(f"UPDATE jobs SET heartbeat = ?{columns} WHERE id = ?", (now, *fields.values(), job_id))
+
+  def events(self, job_id: int, after: int = 0, kind: str | None = None) -> list[JobEvent]:
+    query = "SELECT * FROM job_events WHERE job_id = ? AND id > ?"
+    params: list = [job_id, after]
+    if kind:
+      query += " AND kind = ?"
+      params.append(kind)
+    with connect(self.path) as db:
+      rows = db.execute(f"{query} ORDER BY id", params).fetchall()
+    return [JobEvent(**{**dict(row), "data": json.loads(row["data"])}) for row in rows]
+
+  def heartbeat(self, job_id: int) -> bool:
+    """Mark the job alive. Returns True if the UI asked for it to be cancelled."""
+    with connect(self.path) as db:
+      row = db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? RETURNING cancel_requested", (time.time(), job_id)).fetchone()
+    return bool(row and row["cancel_requested"])
+
+  def finish(self, job_id: int, result: MangaResult):
+    self.update(job_id, status='complete', stage='done', progress=1.0, finished=time.time(), result=result.model_dump_json())
+
+  def fail(self, job_id: int, error: str, status: str = 'failed'):
+    self.update(job_id, status=status, finished=time.time(), error=error)
+
+  def cancel(self, job_id: int):
+    """Cancel a queued job now, or ask the worker running it to stop."""
+    with connect(self.path) as db:
+      db.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+      db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+
+  def requeue_stale(self, stale_after: float = JOB_STALE_AFTER) -> int:
+    """Put running jobs whose worker died back on the queue. Returns how many were requeued."""
+    with connect(self.path) as db:
+      cursor = db.execute(f"UPDATE jobs SET {REQUEUE} WHERE status = 'running' AND heartbeat < ?", (time.time() - stale_after,))
+      return cursor.rowcount
+
+  def release(self, job_id: int):
+    """Hand a running job back to the queue, e.g. when its worker shuts down."""
+    with connect(self.path) as db:
+      db.execute(f"UPDATE jobs SET {REQUEUE} WHERE id = ? AND status = 'running'", (job_id,))
+
+  def active_manifests(self) -> set[str]:
+    with connect(self.path) as db:
+      rows = db.execute("SELECT manifest FROM jobs WHERE status IN ('queued', 'running') AND manifest IS NOT NULL").fetchall()
+    return {row["manifest"] for row in rows}
+
+  def register_worker(self, worker: str):
+    now = time.time()
+    with connect(self.path) as db:
+      db.execute("INSERT OR REPLACE INTO workers (id, pid, started, heartbeat) VALUES (?, ?, ?, ?)", (worker, os.getpid(), now, now))
+
+  def worker_heartbeat(self, worker: str, job_id: int | None = None, rate_limits: list[dict] | None = None):
+    """Mark the worker alive, with the job it is running and its rate limiter snapshot."""
+    with connect(self.path) as db:
+      db.execute(
+        "UPDATE workers SET heartbeat = ?, job_id = ?, rate_limits = COALESCE(?, rate_limits) WHERE id = ?",
+        (time.time(), job_id, json.dumps(rate_limits) if rate_limits is not None else None, worker),
+      )
+
+  def remove_worker(self, worker: str):
+    with connect(self.path) as db:
+      db.execute("DELETE FROM workers WHERE id = ?", (worker,))
+
+  def live_workers(self, stale_after: float = JOB_STALE_AFTER) -> list[dict]:
+    with connect(self.path) as db:
+      rows = db.execute("SELECT * FROM workers WHERE heartbeat >= ? ORDER BY id", (time.time() - stale_after,)).fetchall()
+    return [dict(row) for row in rows]
+
+  def rate_limits(self) -> list[dict]:
+    """The latest rate limiter snapshot of every live worker, one row per worker and model."""
+    return [
+      {"worker": worker["id"], **limits}
+      for worker in self.live_workers()
+      for limits in json.loads(worker["rate_limits"] or "[]")
+    ]
+
+  def stats(self) -> dict[str, int]:
+    with connect(self.path) as db:
+      rows = db.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+    return {row["status"]: row["count"] for row in rows}
+
+job_queue = JobQueue()
@@ -1,14 +1,20 @@
 import streamlit as st
-import asyncio
 import os
-import json
+import uuid
 from datetime import datetime
 from pathlib import Path
 
-from models import MangaRequest, ChapterRequest, PanelRequest, MainRequest
-from services import generate_chapters, process_chapter, process_panel
-from utils import clean_string, get_pdf, generate_image
-from prompts import character_prompt
+from models import MainRequest, EncodingOptions, MangaResult
+from encoding import mime_type
+from export import export_archive
+from thumbnails import thumbnail, prefetch
+from pipeline import CHAPTER_LOOKAHEAD
+from manifest import list_manifests, manifests_signature
+from scheduler import MAX_PANELS_IN_FLIGHT
+from jobqueue import job_queue
+from worker import ensure_workers
+from store import state_store
+from tracing import load_traces, stage_stats
 from gemini import client
 
 # Page configuration
@@ -63,159 +69,37 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Persistence configuration
-STATE_FILE = "nanobanana_state.json"
 DATA_DIR = Path("nanobanana_data")
+# UI state restored in the next session; the manga history lives in the state store
+SESSION_KEYS = ['generated_images', 'generated_pdf', 'carousel_manga_id', 'show_carousel', 'show_pdf', 'carousel_panel_index']
 
-def ensure_data_dir():
-    """Ensure data directory exists"""
-    DATA_DIR.mkdir(exist_ok=True)
-
-def save_state_to_file():
-    """Save session state to JSON file"""
+def save_session_state(*keys):
+    """Save the given UI state keys (all of them by default) to the state store"""
     try:
-        ensure_data_dir()
-        state_file_path = DATA_DIR / STATE_FILE
-        
-        # Prepare state for serialization
-        state_to_save = {
-            'manga_history': [],
-            'generation_progress': st.session_state.get('generation_progress', 0),
-            'current_step': st.session_state.get('current_step', ""),
-            'generated_images': st.session_state.get('generated_images', []),
-            'generated_pdf': st.session_state.get('generated_pdf'),
-            'manga_data': None,  # Will be handled separately
-            'current_carousel_index': st.session_state.get('current_carousel_index', 0),
-            'show_carousel': st.session_state.get('show_carousel', False),
-            'show_pdf': st.session_state.get('show_pdf'),
-            'carousel_panel_index': st.session_state.get('carousel_panel_index', 0),
-            'last_saved': datetime.now().isoformat()
-        }
-        
-        # Handle manga history with serializable data
-        if 'manga_history' in st.session_state:
-            for manga in st.session_state.manga_history:
-                manga_entry = {
-                    'title': manga['title'],
-                    'chapters': manga['chapters'],
-                    'panels': manga['panels'],
-                    'images': manga['images'],
-                    'pdf': manga['pdf'],
-                    'timestamp': manga['timestamp'],
-                    'manga_data': None  # Will be reconstructed from other data
-                }
-                
-                # Save manga data separately if it exists
-                if manga.get('manga_data'):
-                    manga_data = manga['manga_data']
-                    manga_entry['manga_data'] = {
-                        'title': manga_data.title,
-                        'global_style': {
-                            'art_style_description': manga_data.global_style.art_style_description,
-                            'character_sheets': [
-                                {
-                                    'character_id': char.character_id,
-                                    'personality': char.personality,
-                                    'detailed_appearence': char.detailed_appearence
-                                }
-                                for char in manga_data.global_style.character_sheets
-                            ]
-                        },
-                        'chapters': [
-                            {
-                                'chapter_number': ch.chapter_number,
-                                'chapter_title': ch.chapter_title,
-                                'story': ch.story
-                            }
-                            for ch in manga_data.chapters
-                        ]
-                    }
-                
-                state_to_save['manga_history'].append(manga_entry)
-        
-        # Save to file
-        with open(state_file_path, 'w', encoding='utf-8') as f:
-            json.dump(state_to_save, f, indent=2, ensure_ascii=False)
-            
+        values = {key: st.session_state.get(key) for key in (keys or SESSION_KEYS)}
+        state_store.save_session(**values, last_saved=datetime.now().isoformat())
     except Exception as e:
         st.error(f"Error saving state: {e}")
 
-def load_state_from_file():
-    """Load session state from JSON file"""
+def load_session_state():
+    """Load the manga history and UI state from the state store"""
     try:
-        ensure_data_dir()
-        state_file_path = DATA_DIR / STATE_FILE
+        # Move a nanobanana_state.json from older versions into the store, once
+        migrated = state_store.migrate_legacy()
+        if migrated:
+            st.info(f"📦 Imported {migrated} mangas from nanobanana_state.json")
         
-        if not state_file_path.exists():
+        saved_state = state_store.load_session()
+        if not saved_state and not state_store.totals()[0]:
             return False
-            
-        with open(state_file_path, 'r', encoding='utf-8') as f:
-            saved_state = json.load(f)
         
         # Restore session state
-        st.session_state.generation_progress = saved_state.get('generation_progress', 0)
-        st.session_state.current_step = saved_state.get('current_step', "")
-        st.session_state.generated_images = saved_state.get('generated_images', [])
+        st.session_state.generated_images = saved_state.get('generated_images') or []
         st.session_state.generated_pdf = saved_state.get('generated_pdf')
-        st.session_state.current_carousel_index = saved_state.get('current_carousel_index', 0)
-        st.session_state.show_carousel = saved_state.get('show_carousel', False)
+        st.session_state.carousel_manga_id = saved_state.get('carousel_manga_id')
+        st.session_state.show_carousel = saved_state.get('show_carousel') or False
         st.session_state.show_pdf = saved_state.get('show_pdf')
-        st.session_state.carousel_panel_index = saved_state.get('carousel_panel_index', 0)
-        
-        # Restore manga history
-        st.session_state.manga_history = []
-        for manga_entry in saved_state.get('manga_history', []):
-            # Reconstruct manga data if available
-            manga_data = None
-            if manga_entry.get('manga_data'):
-                try:
-                    from models import Manga, GlobalStyle, CharacterSheet, Chapter
-                    
-                    # Reconstruct character sheets
-                    character_sheets = [
-                        CharacterSheet(
-                            character_id=char['character_id'],
-                            personality=char['personality'],
-                            detailed_appearence=char['detailed_appearence']
-                        )
-                        for char in manga_entry['manga_data']['global_style']['character_sheets']
-                    ]
-                    
-                    # Reconstruct global style
-                    global_style = GlobalStyle(
-                        art_style_description=manga_entry['manga_data']['global_style']['art_style_description'],
-                        character_sheets=character_sheets
-                    )
-                    
-                    # Reconstruct chapters
-                    chapters = [
-                        Chapter(
-                            chapter_number=ch['chapter_number'],
-                            chapter_title=ch['chapter_title'],
-                            story=ch['story']
-                        )
-                        for ch in manga_entry['manga_data']['chapters']
-                    ]
-                    
-                    # Reconstruct manga
-                    manga_data = Manga(
-                        title=manga_entry['manga_data']['title'],
-                        global_style=global_style,
-                        chapters=chapters
-                    )
-                except Exception as e:
-                    st.warning(f"Could not reconstruct manga data for {manga_entry['title']}: {e}")
-            
-            # Create manga entry
-            manga = {
-                'title': manga_entry['title'],
-                'chapters': manga_entry['chapters'],
-                'panels': manga_entry['panels'],
-                'images': manga_entry['images'],
-                'pdf': manga_entry['pdf'],
-                'manga_data': manga_data,
-                'timestamp': manga_entry['timestamp']
-            }
-            st.session_state.manga_history.append(manga)
+        st.session_state.carousel_panel_index = saved_state.get('carousel_panel_index') or 0
         
         return True
         
@@ -224,19 +108,16 @@ def load_state_from_file():
         return False
 
 def clear_persisted_state():
-    """Clear persisted state file"""
+    """Clear the persisted manga history and UI state"""
     try:
-        ensure_data_dir()
-        state_file_path = DATA_DIR / STATE_FILE
-        if state_file_path.exists():
-            state_file_path.unlink()
+        state_store.clear()
     except Exception as e:
         st.error(f"Error clearing state: {e}")
 
 # Initialize session state
 if 'state_loaded' not in st.session_state:
     # Try to load state from file
-    if load_state_from_file():
+    if load_session_state():
         st.session_state.state_loaded = True
         st.success("📁 Previous session restored!")
     else:
@@ -246,8 +127,7 @@ if 'state_loaded' not in st.session_state:
         st.session_state.generated_images = []
         st.session_state.generated_pdf = None
         st.session_state.manga_data = None
-        st.session_state.manga_history = []
-        st.session_state.current_carousel_index = 0
+        st.session_state.carousel_manga_id = None
         st.session_state.show_carousel = False
         st.session_state.show_pdf = None
         st.session_state.carousel_panel_index = 0
@@ -256,19 +136,19 @@ if 'state_loaded' not in st.session_state:
 # Ensure all required session state attributes exist
 required_attrs = [
     'generation_progress', 'current_step', 'generated_images', 'generated_pdf',
-    'manga_data', 'manga_history', 'current_carousel_index', 'show_carousel',
-    'show_pdf', 'carousel_panel_index', 'state_loaded'
+    'manga_data', 'carousel_manga_id', 'show_carousel',
+    'show_pdf', 'carousel_panel_index', 'state_loaded', 'active_job', 'finished_job'
 ]
 
 for attr in required_attrs:
     if attr not in st.session_state:
         if attr == 'generation_progress':
             st.session_state[attr] = 0
-        elif attr in ['current_step', 'generated_pdf', 'manga_data', 'show_pdf']:
+        elif attr in ['current_step', 'generated_pdf', 'manga_data', 'show_pdf', 'carousel_manga_id', 'active_job', 'finished_job']:
             st.session_state[attr] = None
-        elif attr in ['generated_images', 'manga_history']:
+        elif attr == 'generated_images':
             st.session_state[attr] = []
-        elif attr in ['current_carousel_index', 'carousel_panel_index']:
+        elif attr == 'carousel_panel_index':
             st.session_state[attr] = 0
         elif attr in ['show_carousel', 'state_loaded']:
             st.session_state[attr] = False
@@ -354,6 +234,63 @@ def main_page():
                     help="Choose the AI model for generation",
                 )
             
+            max_in_flight = st.slider(
+                "Panels in Parallel",
+                min_value=1,
+                max_value=16,
+                value=MAX_PANELS_IN_FLIGHT,
+                help="How many panels are rendered at the same time",
+            )
+            
+            chapter_lookahead = st.slider(
+                "Chapter Lookahead",
+                min_value=1,
+                max_value=5,
+                value=CHAPTER_LOOKAHEAD,
+                help="How many chapters are scripted ahead of panel rendering",
+            )
+            
+            col5, col6, col7 = st.columns(3)
+            
+            with col5:
+                image_format = st.selectbox(
+                    "Image Format",
+                    options=["jpeg", "webp", "avif", "png"],
+                    index=0,
+                    help="Format panels and characters are stored in. AVIF falls back to WebP if unavailable",
+                )
+            
+            with col6:
+                image_quality = st.slider(
+                    "Image Quality",
+                    min_value=50,
+                    max_value=100,
+                    value=90,
+                    help="Quality for JPEG, WebP and AVIF",
+                )
+            
+            with col7:
+                max_dimension = st.number_input(
+                    "Max Image Size (px)",
+                    min_value=0,
+                    max_value=4096,
+                    value=0,
+                    step=128,
+                    help="Downscale images whose longest side is larger than this. 0 keeps the original size",
+                )
+            
+            compose_pages = st.checkbox(
+                "Compose Manga Pages",
+                value=True,
+                help="Lay panels out on pages using the script's layouts; otherwise the PDF has one panel per page",
+            )
+            
+            use_cache = st.checkbox(
+                "Reuse Cached Results",
+                value=True,
+                help="Reuse outlines, scripts and images cached from earlier runs with the same inputs. Uncheck to generate everything anew",
+            )
+            
         submitted = st.form_submit_button("🚀 Generate Manga", type="primary")
     
     if submitted:
@@ -369,204 +306,255 @@ def main_page():
             num_chapters=num_chapters,
             lang=lang,
             model=model_choice,
-            files=files_list
+            files=files_list,
+            max_in_flight=max_in_flight,
+            chapter_lookahead=chapter_lookahead,
+            compose_pages=compose_pages,
+            use_cache=use_cache,
+            encoding=EncodingOptions(
+                format=image_format,
+                quality=image_quality,
+                max_dimension=max_dimension
+            )
         )
         
-        # Start generation process
-        asyncio.run(generate_manga_async(request))
+        # Hand the job to the worker pool; this page only follows its progress
+        start_job(job_queue.enqueue(request, owner=session_owner()))
+    
+    active_job = safe_get_session_state('active_job')
+    if active_job:
+        job_progress(active_job)
+    elif safe_get_session_state('finished_job'):
+        show_finished_job()
+    
+    show_job_queue()
+    
+    # Interrupted or failed jobs can pick up where they stopped
+    queued_manifests = job_queue.active_manifests()
+    unfinished = [(path, manifest) for path, manifest in unfinished_manifests(manifests_signature()) if str(path) not in queued_manifests]
+    if unfinished:
+        st.markdown('<div class="section-header">⏯️ Unfinished Mangas</div>', unsafe_allow_html=True)
+        for idx, (manifest_path, manifest) in enumerate(unfinished):
+            done = sum(1 for panel in manifest.panels.values() if panel.status == 'done')
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.write(f"**{manifest.manga.title}** — {len(manifest.scripts)}/{len(manifest.manga.chapters)} chapters scripted, {done}/{len(manifest.panels)} panels done ({manifest.status})")
+            with col2:
+                if st.button("▶️ Resume", key=f"resume_{idx}"):
+                    start_job(job_queue.enqueue_resume(manifest_path, owner=session_owner()))
+                    st.rerun()
 
-async def generate_manga_async(request: MainRequest):
-    """Async function to handle manga generation with progress tracking"""
-    try:
-        # Progress tracking
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        
-        # Create containers for real-time updates
-        manga_info_container = st.container()
-        character_container = st.container()
-        chapter_container = st.container()
-        
-        # Step 1: Generate chapters
-        status_text.text("📚 Generating manga structure and chapters...")
-        progress_bar.progress(10)
-        
-        manga_request = MangaRequest(
-            prompt=request.prompt,
-            context=request.context,
-            instructions=request.instructions,
-            num_chapters=request.num_chapters,
-            lang=request.lang,
-            model=request.model,
-            files=request.files
-        )
-        
-        manga = await generate_chapters(manga_request)
-        st.session_state.manga_data = manga
-        os.makedirs(f"{DATA_DIR}/{manga.title}", exist_ok=True)
-        
-        # Display manga details immediately
-        with manga_info_container:
-            st.markdown('<div class="section-header">📖 Generated Manga Details</div>', unsafe_allow_html=True)
+@st.cache_data(max_entries=1, show_spinner=False)
+def unfinished_manifests(signature):
+    """Manifests of unfinished jobs, parsed again only when `signature` says one was written"""
+    return list_manifests()
+
+def session_owner():
+    """Id of this browser session, recorded on the jobs it enqueues"""
+    if 'session_owner' not in st.session_state:
+        st.session_state.session_owner = uuid.uuid4().hex
+    return st.session_state.session_owner
+
+def start_job(job_id):
+    st.session_state.active_job = job_id
+    st.session_state.finished_job = None
+    ensure_workers()
+
+JOB_STAGES = {
+    'outline': "📚 Generating manga structure and chapters...",
+    'characters': "🎭 Generating character designs...",
+    'chapters': "📖 Scripting chapters and generating panels...",
+    'pdf': "📄 Finishing PDF...",
+    'done': "✅ Generation complete!",
+}
+
+@st.fragment(run_every=2)
+def job_progress(job_id):
+    """Live progress of a queued job, polled from the job queue"""
+    job = job_queue.get(job_id)
+    if job is None:
+        st.session_state.active_job = None
+        return
+    
+    st.markdown('<div class="section-header">⏳ Generation Progress</div>', unsafe_allow_html=True)
+    
+    if job.status == 'complete':
+        store_result(job.result)
+        st.session_state.active_job = None
+        st.session_state.finished_job = job_id
+        st.rerun()
+    
+    if job.status in ('failed', 'cancelled'):
+        st.error(f"❌ Generation {job.status}: {job.error}")
+        if st.button("Dismiss", key=f"dismiss_{job_id}"):
+            st.session_state.active_job = None
+            st.rerun()
+        return
+    
+    if job.status == 'queued':
+        ahead = sum(1 for other in job_queue.jobs(('queued',)) if other.id < job_id)
+        st.info(f"🕒 Waiting for a worker ({ahead} job{'s' if ahead != 1 else ''} ahead)")
+        if not job_queue.live_workers():
+            st.warning("No worker is running. Start one with `python worker.py`.")
+    
+    status = JOB_STAGES.get(job.stage, "🕒 Queued")
+    if job.panels_total:
+        status = f"🎨 Generated panel {job.panels_done}/{job.panels_total}"
+    st.progress(job.progress, text=status)
+    
+    if st.button("⏹️ Cancel", key=f"cancel_{job_id}"):
+        job_queue.cancel(job_id)
+    
+    events = job_queue.events(job_id)
+    for event in events:
+        if event.kind == 'outline':
+            manga = event.data['manga']
             col1, col2 = st.columns(2)
-            
             with col1:
                 st.subheader("📚 Manga Information")
-                st.write(f"**Title:** {manga.title}")
-                st.write(f"**Chapters:** {len(manga.chapters)}")
-                st.write(f"**Art Style:** {manga.global_style.art_style_description}")
-            
+                st.write(f"**Title:** {manga['title']}")
+                st.write(f"**Chapters:** {len(manga['chapters'])}")
+                st.write(f"**Art Style:** {manga['global_style']['art_style_description']}")
             with col2:
                 st.subheader("📝 Chapter Overview")
-                for i, chapter in enumerate(manga.chapters):
-                    with st.expander(f"Chapter {i+1}: {chapter.chapter_title}", expanded=False):
-                        st.write(chapter.story)
-        
-        progress_bar.progress(30)
-        status_text.text("🎭 Generating character designs...")
-        
-        # Step 2: Generate characters with real-time display
-        with character_container:
-            st.markdown('<div class="section-header">🎭 Character Generation</div>', unsafe_allow_html=True)
-            character_cols = st.columns(min(len(manga.global_style.character_sheets), 3))
-            
-            for idx, character in enumerate(manga.global_style.character_sheets):
-                with character_cols[idx % 3]:
-                    st.markdown(f"**{character.character_id}**")
-                    st.write(f"*{character.personality}*")
-                    st.write(character.detailed_appearence)
-                    # Placeholder for character image
-                    character_image_placeholder = st.empty()
-                    character_image_placeholder.info("🔄 Generating character image...")
-        
-        # Generate character images one by one with real-time updates
-        for idx, character in enumerate(manga.global_style.character_sheets):
-            cprompt = character_prompt.format(**{
-                'character_id': character.character_id,
-                'personality': character.personality,
-                'detailed_appearance': character.detailed_appearence,
-                'art_style_description': manga.global_style.art_style_description
-            })
-            path = f'{DATA_DIR}/{await clean_string(manga.title)}/{await clean_string(character.character_id)}.png'
-            path = await generate_image(cprompt, path, [])
-            
-            # Update the character image in real-time
+                for i, chapter in enumerate(manga['chapters']):
+                    with st.expander(f"Chapter {i+1}: {chapter['chapter_title']}", expanded=False):
+                        st.write(chapter['story'])
+    
+    characters = [event.data for event in events if event.kind == 'character']
+    if characters:
+        st.markdown('<div class="section-header">🎭 Character Generation</div>', unsafe_allow_html=True)
+        character_cols = st.columns(min(len(characters), 3))
+        for idx, character in enumerate(characters):
             with character_cols[idx % 3]:
-                if os.path.exists(path):
-                    character_image_placeholder = st.empty()
-                    character_image_placeholder.image(path, caption=f"{character.character_id}")
+                if character['path'] and os.path.exists(character['path']):
+                    st.image(thumbnail(character['path']), caption=character['character_id'])
                 else:
-                    st.error(f"Failed to generate image for {character.character_id}")
-        
-        progress_bar.progress(50)
-        
-        # Step 3: Process chapters and panels
-        with chapter_container:
-            st.markdown('<div class="section-header">📖 Chapter Processing & Panel Generation</div>', unsafe_allow_html=True)
-            panel_gallery_container = st.container()
-        
-        all_images = []
-        current_panel = 0   
-        total_panels = 0
-        
-        for chapter_idx, chapter in enumerate(manga.chapters):
-            status_text.text(f"📖 Processing Chapter {chapter_idx + 1}: {chapter.chapter_title}")
-            
-            chapter_script = await process_chapter(ChapterRequest(
-                chapter=chapter,
-                global_style=manga.global_style,
-                lang=request.lang,
-                model=request.model
-            ))
-            total_panels = sum(len(page.panels) for page in chapter_script.pages)
-            
-            # Display chapter processing info
-            with chapter_container:
-                st.info(f"📖 Processing Chapter {chapter_idx + 1}: {chapter.chapter_title} ({total_panels} panels)")
-            
-            for page_idx, page in enumerate(chapter_script.pages):
-                for panel in page.panels:
-                    status_text.text(f"🎨 Generating panel {current_panel + 1}/{total_panels}")
-                    
-                    imgpath = await process_panel(PanelRequest(
-                        manga=manga.title,
-                        scene_description=panel.scene_description,
-                        global_style=manga.global_style,
-                        id=f"{chapter_idx}_{page_idx}_{panel.panel_number}",
-                        model=request.model
-                    ))
-                    
-                    all_images.append(imgpath)
-                    current_panel += 1
-                    
-                    # Update progress
-                    progress = min(50 + (current_panel / total_panels) * 40, 100)
-                    progress_bar.progress(int(progress))
-                    
-                    # Show generated panel in real-time
-                    with panel_gallery_container:
-                        if os.path.exists(imgpath):
-                            cols = st.columns(3)
-                            with cols[current_panel % 3]:
-                                st.image(imgpath, caption=f"Panel {current_panel} - Ch{chapter_idx + 1}P{page_idx + 1}")
-                        else:
-                            st.warning(f"Panel {current_panel} generation failed")
-        
-        # Step 4: Create PDF
-        status_text.text("📄 Creating PDF...")
-        progress_bar.progress(90)
-        
-        if all_images:
-            pdf_path = await get_pdf(all_images, f"{DATA_DIR}/{await clean_string(manga.title)}/generated_manga.pdf")
-            st.session_state.generated_pdf = pdf_path
-        
-        progress_bar.progress(100)
-        status_text.text("✅ Generation complete!")
-        
-        # Store results
-        st.session_state.generated_images = all_images
-        
-        # Save to manga history
-        import time
-        manga_entry = {
-            'title': manga.title,
-            'chapters': len(manga.chapters),
-            'panels': len(all_images),
-            'images': all_images,
-            'pdf': st.session_state.generated_pdf,
-            'manga_data': manga,
-            'timestamp': time.time()
-        }
-        st.session_state.manga_history.append(manga_entry)
-        
-        # Auto-save state
-        save_state_to_file()
-        
-        # Show success message
-        st.markdown('<div class="success-box">🎉 Your manga has been generated successfully!</div>', unsafe_allow_html=True)
-        
-        # Clear the status text and progress bar
-        status_text.empty()
-        progress_bar.empty()
-        
-        # Display final results summary
-        with st.container():
-            st.markdown('<div class="section-header">📊 Generation Summary</div>', unsafe_allow_html=True)
-            col1, col2, col3 = st.columns(3)
-            
-            with col1:
-                st.metric("Chapters Generated", len(manga.chapters))
-            with col2:
-                st.metric("Panels Created", len(all_images))
-            with col3:
-                st.metric("Characters Designed", len(manga.global_style.character_sheets))
-        
-        # Display results
-        display_results()
+                    st.error(f"Failed to generate image for {character['character_id']}")
+    
+    chapters = [event.data for event in events if event.kind == 'chapter']
+    if chapters:
+        st.markdown('<div class="section-header">📖 Chapter Processing & Panel Generation</div>', unsafe_allow_html=True)
+        for chapter in chapters:
+            st.info(f"📖 Processing Chapter {chapter['chapter'] + 1}: {chapter['title']} ({chapter['panels']} panels)")
+    
+    # Latest panels, in completion order
+    panels = [event.data for event in events if event.kind == 'panel']
+    if panels:
+        gallery_cols = st.columns(3)
+        first = max(len(panels) - 9, 0)
+        for idx, panel in enumerate(panels[first:], start=first):
+            chapter_idx, page_idx, _ = panel['key']
+            with gallery_cols[(idx - first) % 3]:
+                if panel['path'] and os.path.exists(panel['path']):
+                    st.image(thumbnail(panel['path']), caption=f"Panel {idx + 1} - Ch{chapter_idx + 1}P{page_idx + 1}")
+                else:
+                    st.warning(f"Panel {idx + 1} generation failed")
+
+def show_job_queue():
+    """Jobs waiting for or running on the worker pool"""
+    jobs = job_queue.jobs()
+    if not jobs:
+        return
+    st.markdown('<div class="section-header">📋 Job Queue</div>', unsafe_allow_html=True)
+    st.caption(f"{len(job_queue.live_workers())} worker(s) running")
+    for job in jobs:
+        col1, col2, col3 = st.columns([4, 1, 1])
+        with col1:
+            title = job.title or "Untitled manga"
+            progress = f"{job.panels_done}/{job.panels_total} panels" if job.panels_total else (job.stage or "waiting")
+            st.write(f"**#{job.id} {title}** — {job.status}, {progress}")
+        with col2:
+            if job.id != safe_get_session_state('active_job') and st.button("👁️ Watch", key=f"watch_{job.id}"):
+                st.session_state.active_job = job.id
+                st.rerun()
+        with col3:
+            if st.button("⏹️ Cancel", key=f"queue_cancel_{job.id}"):
+                job_queue.cancel(job.id)
+                st.rerun()
+
+def store_result(result: MangaResult):
+    """Move a finished job's result into the session; the worker already saved it to the history"""
+    manga = result.manga
+    all_images = result.images
+    st.session_state.manga_data = manga
+    st.session_state.generated_pdf = result.pdf
+    
+    # Store results
+    st.session_state.generated_images = all_images
+    
+    # Auto-save state
+    save_session_state('generated_images', 'generated_pdf')
+
+def show_finished_job():
+    """Summary and results of the job this session last completed"""
+    manga = safe_get_session_state('manga_data')
+    if not manga:
+        return
+    
+    # Show success message
+    st.markdown('<div class="success-box">🎉 Your manga has been generated successfully!</div>', unsafe_allow_html=True)
+    
+    # Display final results summary
+    with st.container():
+        st.markdown('<div class="section-header">📊 Generation Summary</div>', unsafe_allow_html=True)
+        col1, col2, col3 = st.columns(3)
         
-    except Exception as e:
-        st.error(f"❌ Error during generation: {str(e)}")
-        st.exception(e)
+        with col1:
+            st.metric("Chapters Generated", len(manga.chapters))
+        with col2:
+            st.metric("Panels Created", len(st.session_state.generated_images))
+        with col3:
+            st.metric("Characters Designed", len(manga.global_style.character_sheets))
+    
+    # Display results
+    display_results()
+
+def lazy_download_button(label, path, file_name, mime, key, type="secondary"):
+    """Download button that only reads the file once the user asks for it"""
+    ready_key = f"{key}_ready"
+    
+    def reset():
+        st.session_state[ready_key] = False
+    
+    if st.session_state.get(ready_key):
+        with open(path, "rb") as file:
+            st.download_button(
+                label=f"{label} (ready)",
+                data=file.read(),
+                file_name=file_name,
+                mime=mime,
+                key=key,
+                type=type,
+                on_click=reset
+            )
+    elif st.button(label, key=f"{key}_prepare", type=type):
+        st.session_state[ready_key] = True
+        st.rerun()
+
+def export_buttons(title, images, manga_data, key):
+    """CBZ and ZIP exports of a whole manga, written to disk next to its panels"""
+    images = [path for path in images if os.path.exists(path)]
+    if not images:
+        return
+    base = os.path.join(os.path.dirname(images[0]), "".join(c if c.isalnum() else "_" for c in title) or "manga")
+    col1, col2 = st.columns(2)
+    for col, ext, label in ((col1, "cbz", "📦 Export CBZ"), (col2, "zip", "🗜️ Export ZIP")):
+        with col:
+            path = f"{base}.{ext}"
+            if st.session_state.get(f"{key}_{ext}_ready") and os.path.exists(path):
+                lazy_download_button(
+                    label=f"📥 Download {ext.upper()}",
+                    path=path,
+                    file_name=os.path.basename(path),
+                    mime="application/vnd.comicbook+zip" if ext == "cbz" else "application/zip",
+                    key=f"{key}_{ext}_download"
+                )
+            elif st.button(label, key=f"{key}_{ext}_export"):
+                with st.spinner(f"Writing {ext.upper()}..."):
+                    export_archive(images, path, title, manga=manga_data, cbz=ext == "cbz")
+                st.session_state[f"{key}_{ext}_ready"] = True
+                st.rerun()
 
 def display_results():
     """Display generated manga results"""
@@ -605,31 +593,33 @@ def display_results():
         for idx, img_path in enumerate(st.session_state.generated_images):
             if os.path.exists(img_path):
                 with cols[idx % 3]:
-                    st.image(img_path, caption=f"Panel {idx + 1}")
+                    st.image(thumbnail(img_path), caption=f"Panel {idx + 1}")
                     
                     # Download button for individual image
-                    with open(img_path, "rb") as file:
-                        st.download_button(
-                            label=f"📥 Download Panel {idx + 1}",
-                            data=file.read(),
-                            file_name=f"panel_{idx + 1}.png",
-                            mime="image/png"
-                        )
+                    lazy_download_button(
+                        label=f"📥 Download Panel {idx + 1}",
+                        path=img_path,
+                        file_name=f"panel_{idx + 1}{os.path.splitext(img_path)[1]}",
+                        mime=mime_type(img_path),
+                        key=f"download_result_{idx}"
+                    )
     
     # PDF download
     if st.session_state.generated_pdf and os.path.exists(st.session_state.generated_pdf):
         st.markdown('<div class="section-header">📄 Download Complete Manga</div>', unsafe_allow_html=True)
         
-        with open(st.session_state.generated_pdf, "rb") as file:
-            # Extract filename from path
-            pdf_filename = os.path.basename(st.session_state.generated_pdf)
-            st.download_button(
-                label="📥 Download Complete Manga PDF",
-                data=file.read(),
-                file_name=pdf_filename,
-                mime="application/pdf",
-                type="primary"
-            )
+        lazy_download_button(
+            label="📥 Download Complete Manga PDF",
+            path=st.session_state.generated_pdf,
+            file_name=os.path.basename(st.session_state.generated_pdf),
+            mime="application/pdf",
+            key="download_result_pdf",
+            type="primary"
+        )
+
+    if st.session_state.generated_images:
+        title = manga_data.title if manga_data else "manga"
+        export_buttons(title, st.session_state.generated_images, manga_data, "export_result")
 
 def config_page():
     """Configuration page for API keys and settings"""
@@ -660,6 +650,20 @@ def config_page():
         else:
             st.error("Please enter a valid API key!")
     
+    # Rate limits
+    st.markdown("---")
+    st.subheader("📈 Rate Limits")
+    
+    # Gemini calls run in the workers, which publish their limiters with each heartbeat
+    limits = job_queue.rate_limits()
+    if limits:
+        st.dataframe(limits, use_container_width=True, hide_index=True)
+        st.caption("One row per worker and model. Concurrency halves on quota errors (429/503) and creeps back up on success. Set RATE_LIMIT_RPM, RATE_LIMIT_TPM, RATE_MAX_CONCURRENCY or per-model RATE_LIMITS to match your quota.")
+    else:
+        st.info("No worker has made Gemini requests yet.")
+    if st.button("🔄 Refresh Limits"):
+        st.rerun()
+    
     # Manual state management
     st.markdown("---")
     st.subheader("🗂️ State Management")
@@ -668,7 +672,7 @@ def config_page():
     
     with col_state1:
         if st.button("📁 Load Previous Session"):
-            if load_state_from_file():
+            if load_session_state():
                 st.success("✅ Previous session loaded!")
                 st.rerun()
             else:
@@ -682,12 +686,13 @@ def config_page():
             st.success("✅ All data cleared!")
             st.rerun()
 
+GALLERY_SORTS = {'created': "Date", 'title': "Title", 'panels': "Panels"}
+
 def gallery_page():
     """Gallery page to view generated content"""
     st.markdown('<h1 class="main-header">🖼️ Manga Gallery</h1>', unsafe_allow_html=True)
     
-    manga_history = safe_get_session_state('manga_history', [])
-    if not manga_history:
+    if not state_store.totals()[0]:
         st.info("📚 No mangas generated yet. Go to the main page to create your first manga!")
         return
     
@@ -696,7 +701,29 @@ def gallery_page():
     # Display manga list
     st.subheader("📚 Your Generated Mangas")
     
-    for idx, manga in enumerate(manga_history):
+    # Search, sort and pagination all run in the state store; only one page is loaded
+    col_search, col_sort, col_order, col_size = st.columns([3, 1, 1, 1])
+    with col_search:
+        search = st.text_input("🔍 Search titles", key="gallery_search")
+    with col_sort:
+        sort = st.selectbox("Sort by", options=list(GALLERY_SORTS), format_func=GALLERY_SORTS.get, key="gallery_sort")
+    with col_order:
+        order = st.selectbox("Order", options=["Descending", "Ascending"], key="gallery_order")
+    with col_size:
+        page_size = st.selectbox("Per page", options=[5, 10, 20, 50], index=1, key="gallery_page_size")
+    
+    mangas, total = state_store.page(search, sort, order == "Descending", limit=page_size, offset=safe_get_session_state('gallery_page', 0) * page_size)
+    pages = max((total + page_size - 1) // page_size, 1)
+    page_idx = min(safe_get_session_state('gallery_page', 0), pages - 1)
+    if page_idx != safe_get_session_state('gallery_page', 0):
+        st.session_state.gallery_page = page_idx
+        mangas, total = state_store.page(search, sort, order == "Descending", limit=page_size, offset=page_idx * page_size)
+    
+    if not mangas:
+        st.info("No mangas match your search.")
+    
+    for manga in mangas:
+        manga_id = manga['id']
         with st.container():
             st.markdown("---")
             
@@ -705,28 +732,47 @@ def gallery_page():
             
             with col1:
                 st.markdown(f"### 📖 {manga['title']}")
-                st.write(f"**Chapters:** {manga['chapters']} | **Panels:** {manga['panels']}")
+                size = ((manga['image_bytes'] or 0) + (manga['pdf_bytes'] or 0)) / 1e6
+                missing = f" | ⚠️ {manga['missing_images']} missing" if manga['missing_images'] else ""
+                st.write(f"**Chapters:** {manga['chapters']} | **Panels:** {manga['panels']} | **Size:** {size:.1f} MB{missing}")
+                st.write(f"**Created:** {datetime.fromtimestamp(manga['timestamp']).strftime('%Y-%m-%d %H:%M')}")
                 if manga['manga_data']:
                     st.write(f"**Style:** {manga['manga_data'].global_style.art_style_description}")
             
             with col2:
-                if st.button(f"👁️ View", key=f"view_{idx}"):
-                    st.session_state.current_carousel_index = idx
+                if st.button(f"👁️ View", key=f"view_{manga_id}"):
+                    st.session_state.carousel_manga_id = manga_id
+                    st.session_state.carousel_panel_index = 0
                     st.session_state.show_carousel = True
             
             with col3:
-                if manga['pdf'] and os.path.exists(manga['pdf']):
-                    if st.button(f"📄 PDF", key=f"pdf_{idx}"):
+                if manga['pdf']:
+                    if st.button(f"📄 PDF", key=f"pdf_{manga_id}"):
                         st.session_state.show_pdf = manga['pdf']
                 else:
-                    st.button(f"📄 PDF", key=f"pdf_{idx}", disabled=True)
+                    st.button(f"📄 PDF", key=f"pdf_{manga_id}", disabled=True)
             
             with col4:
-                if st.button(f"🗑️ Delete", key=f"delete_{idx}"):
-                    st.session_state.manga_history.pop(idx)
-                    save_state_to_file()  # Auto-save after deletion
+                if st.button(f"🗑️ Delete", key=f"delete_{manga_id}"):
+                    state_store.delete_manga(manga_id)
+                    if safe_get_session_state('carousel_manga_id') == manga_id:
+                        st.session_state.show_carousel = False
                     st.rerun()
     
+    # Pagination
+    if pages > 1:
+        col_prev, col_info, col_next = st.columns([1, 2, 1])
+        with col_prev:
+            if st.button("⬅️ Newer" if order == "Descending" and sort == 'created' else "⬅️ Previous", disabled=page_idx == 0):
+                st.session_state.gallery_page = page_idx - 1
+                st.rerun()
+        with col_info:
+            st.write(f"Page {page_idx + 1} of {pages} ({total} mangas)")
+        with col_next:
+            if st.button("Older ➡️" if order == "Descending" and sort == 'created' else "Next ➡️", disabled=page_idx >= pages - 1):
+                st.session_state.gallery_page = page_idx + 1
+                st.rerun()
+    
     # Carousel view
     if safe_get_session_state('show_carousel', False):
         show_carousel()
@@ -738,12 +784,11 @@ def gallery_page():
 
 def show_carousel():
     """Show carousel for selected manga"""
-    manga_idx = safe_get_session_state('current_carousel_index', 0)
-    manga_history = safe_get_session_state('manga_history', [])
-    if manga_idx >= len(manga_history):
-        st.error("Invalid manga index!")
+    manga_id = safe_get_session_state('carousel_manga_id')
+    manga = state_store.entry(manga_id) if manga_id else None
+    if manga is None:
+        st.error("Manga not found!")
         return
-    manga = manga_history[manga_idx]
     
     st.markdown("---")
     st.markdown(f"### 🎠 Carousel: {manga['title']}")
@@ -789,7 +834,9 @@ def show_carousel():
         # Display current panel
         img_path = manga['images'][current_panel]
         if os.path.exists(img_path):
-            st.image(img_path, caption=f"Panel {current_panel + 1} of {total_panels}")
+            st.image(thumbnail(img_path, 'preview'), caption=f"Panel {current_panel + 1} of {total_panels}")
+            # Warm up the neighbours so Previous/Next show instantly
+            prefetch([manga['images'][i] for i in (current_panel - 1, current_panel + 1) if 0 <= i < total_panels])
             
             # Panel navigation buttons
             nav_col1, nav_col2, nav_col3, nav_col4 = st.columns([1, 1, 1, 1])
@@ -798,14 +845,14 @@ def show_carousel():
                 if st.button("⬅️ Previous"):
                     if current_panel > 0:
                         st.session_state.carousel_panel_index = current_panel - 1
-                        save_state_to_file()  # Auto-save navigation state
+                        save_session_state('carousel_panel_index')  # Auto-save navigation state
                         st.rerun()
             
             with nav_col2:
                 if st.button("➡️ Next"):
                     if current_panel < total_panels - 1:
                         st.session_state.carousel_panel_index = current_panel + 1
-                        save_state_to_file()  # Auto-save navigation state
+                        save_session_state('carousel_panel_index')  # Auto-save navigation state
                         st.rerun()
             
             with nav_col3:
@@ -818,21 +865,23 @@ def show_carousel():
                 )
                 if selected_panel != current_panel + 1:
                     st.session_state.carousel_panel_index = selected_panel - 1
-                    save_state_to_file()  # Auto-save navigation state
+                    save_session_state('carousel_panel_index')  # Auto-save navigation state
                     st.rerun()
             
             with nav_col4:
                 # Download current panel
-                with open(img_path, "rb") as file:
-                    st.download_button(
-                        label="📥 Download",
-                        data=file.read(),
-                        file_name=f"{manga['title']}_panel_{current_panel + 1}.png",
-                        mime="image/png",
-                        key=f"download_panel_{current_panel}"
-                    )
+                lazy_download_button(
+                    label="📥 Download",
+                    path=img_path,
+                    file_name=f"{manga['title']}_panel_{current_panel + 1}{os.path.splitext(img_path)[1]}",
+                    mime=mime_type(img_path),
+                    key=f"download_panel_{current_panel}"
+                )
         else:
             st.error(f"Image not found: {img_path}")
+        
+        # Whole-manga archives
+        export_buttons(manga['title'], manga['images'], manga.get('manga_data'), f"export_{manga_id}")
 
 def show_pdf_viewer(pdf_path):
     """Show PDF viewer for selected manga"""
@@ -847,37 +896,71 @@ def show_pdf_viewer(pdf_path):
                 st.session_state.show_pdf = None
                 st.rerun()
             
-            # PDF download
-            with open(pdf_path, "rb") as file:
-                st.download_button(
-                    label="📥 Download PDF",
-                    data=file.read(),
-                    file_name="generated_manga.pdf",
-                    mime="application/pdf",
-                    key="download_pdf"
-                )
+            # PDF download, read only when asked for
+            lazy_download_button(
+                label="📥 Download PDF",
+                path=pdf_path,
+                file_name="generated_manga.pdf",
+                mime="application/pdf",
+                key="download_pdf"
+            )
         
         with col2:
-            # Display PDF using iframe (if supported by browser)
-            try:
-                with open(pdf_path, "rb") as file:
-                    pdf_bytes = file.read()
-                    st.download_button(
-                        label="📄 Open PDF in New Tab",
-                        data=pdf_bytes,
-                        file_name="manga.pdf",
-                        mime="application/pdf",
-                        key="open_pdf"
-                    )
-                
-                # Alternative: Show PDF info
-                st.info("💡 Click the download button above to view the PDF. For best experience, open it in a new tab.")
-                
-            except Exception as e:
-                st.error(f"Error loading PDF: {e}")
+            st.info("💡 Click the download button to view the PDF. For best experience, open it in a new tab.")
     else:
         st.error("PDF file not found or not generated yet.")
 
+def performance_page():
+    """Where the time of recent runs went, from the trace file"""
+    st.markdown('<h1 class="main-header">📈 Performance</h1>', unsafe_allow_html=True)
+    
+    limit = st.slider("Recent runs", min_value=1, max_value=100, value=20)
+    traces = load_traces(limit=limit)
+    if not traces:
+        st.info("No traced runs yet. Every manga generated from now on is recorded here.")
+        return
+    
+    # One row per run
+    runs = []
+    for trace in traces:
+        root = next(span for span in trace if span['parent'] is None)
+        runs.append({
+            'started': datetime.fromtimestamp(root['start']).strftime('%Y-%m-%d %H:%M:%S'),
+            'title': root['attrs'].get('title', '—'),
+            'status': root['status'],
+            'wall (s)': round(root['duration'], 1),
+            'panels': root['attrs'].get('panels', 0),
+            'retries': root['retries'],
+            'tokens': root['tokens']['total'],
+            'MB sent': round(root['request_bytes'] / 1e6, 2),
+            'MB received': round(root['response_bytes'] / 1e6, 2),
+        })
+    st.subheader("🕒 Recent Runs")
+    st.dataframe(runs, use_container_width=True, hide_index=True)
+    
+    stats = stage_stats(traces)
+    st.subheader("🐢 Slowest Stages")
+    st.bar_chart(stats, x='stage', y='p95 (s)', horizontal=True)
+    st.dataframe(stats, use_container_width=True, hide_index=True)
+    st.caption("Wall time includes the queue: waiting for the rate limiter, a panel slot or a panel's characters. Retries and tokens of model calls are also counted on the panel, character and manga spans that made them.")
+    
+    st.subheader("🔍 Slowest Spans")
+    slowest = sorted((span for trace in traces for span in trace if span['parent'] is not None), key=lambda span: span['duration'] or 0, reverse=True)[:20]
+    st.dataframe([
+        {
+            'stage': span['name'],
+            'wall (s)': round(span['duration'] or 0, 2),
+            'queue (s)': round(span['queue_wait'], 2),
+            'retries': span['retries'],
+            'status': span['status'],
+            'details': ", ".join(f"{key}={value}" for key, value in span['attrs'].items()),
+        }
+        for span in slowest
+    ], use_container_width=True, hide_index=True)
+    
+    if st.button("🔄 Refresh"):
+        st.rerun()
+
 def about_page():
     """About page with project information"""
     st.markdown('<h1 class="main-header">ℹ️ About NanoBanana</h1>', unsafe_allow_html=True)
@@ -926,7 +1009,7 @@ def about_page():
     - **Image Generation:** Gemini 2.5 Flash Image Preview
     - **Framework:** Streamlit for web interface
     - **Data Models:** Pydantic for structured data
-    - **PDF Generation:** img2pdf library
+    - **PDF Generation:** Streaming PDF writer (pages are appended as chapters finish)
     - **Image Processing:** Pillow (PIL)
     """)
     
@@ -947,7 +1030,7 @@ def main():
     st.sidebar.title("🍌 Navigation")
     page = st.sidebar.selectbox(
         "Choose a page",
-        ["🏠 Home", "⚙️ Configuration", "🖼️ Gallery", "ℹ️ About"]
+        ["🏠 Home", "⚙️ Configuration", "🖼️ Gallery", "📈 Performance", "ℹ️ About"]
     )
     
     # Sidebar info
@@ -963,24 +1046,15 @@ def main():
     if generated_images:
         st.sidebar.write(f"**Generated Panels:** {len(generated_images)}")
     
-    manga_history = safe_get_session_state('manga_history', [])
-    if manga_history:
-        st.sidebar.write(f"**Total Mangas:** {len(manga_history)}")
-        total_panels = sum(manga['panels'] for manga in manga_history)
+    total_mangas, total_panels = state_store.totals()
+    if total_mangas:
+        st.sidebar.write(f"**Total Mangas:** {total_mangas}")
         st.sidebar.write(f"**Total Panels:** {total_panels}")
     
     # Show last saved time if available
-    state_file_path = DATA_DIR / STATE_FILE
-    if state_file_path.exists():
-        try:
-            with open(state_file_path, 'r', encoding='utf-8') as f:
-                saved_state = json.load(f)
-            last_saved = saved_state.get('last_saved')
-            if last_saved:
-                last_saved_dt = datetime.fromisoformat(last_saved)
-                st.sidebar.write(f"**Last Saved:** {last_saved_dt.strftime('%H:%M:%S')}")
-        except:
-            pass
+    last_saved = state_store.session_value('last_saved')
+    if last_saved:
+        st.sidebar.write(f"**Last Saved:** {datetime.fromisoformat(last_saved).strftime('%H:%M:%S')}")
     
     # Clear session button
     if st.sidebar.button("🗑️ Clear Session"):
@@ -996,6 +1070,8 @@ def main():
         config_page()
     elif page == "🖼️ Gallery":
         gallery_page()
+    elif page == "📈 Performance":
+        performance_page()
     elif page == "ℹ️ About":
         about_page()
 
@@ -0,0 +1,136 @@
+import json
+import os
+import time
+from pathlib import Path
+from models import AssetRecord, JobManifest, Manga, MainRequest, MangaChapterScript
+from services import DATA_DIR
+from atomic import atomic_write
+
+MANIFEST_FILE = "manifest.json"
+# Panel records appended since the manifest was last written, folded into it on load
+PANEL_LOG_FILE = "panels.jsonl"
+
+def panel_id(key: tuple[int, int, int]) -> str:
+  return "_".join(str(part) for part in key)
+
+def manifest_path(title: str) -> Path:
+  return Path(DATA_DIR) / title.replace("/", "_") / MANIFEST_FILE
+
+def asset_bytes(path: str | None) -> int | None:
+  return os.path.getsize(path) if path and os.path.exists(path) else None
+
+def panel_log_path(path: Path) -> Path:
+  return Path(path).with_name(PANEL_LOG_FILE)
+
+def load_manifest(path: Path) -> JobManifest:
+  with open(path, "r", encoding="utf-8") as f:
+    manifest = JobManifest.model_validate_json(f.read())
+  log = panel_log_path(path)
+  if log.exists():
+    with open(log, "r", encoding="utf-8") as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+          manifest.panels[entry["panel"]] = AssetRecord.model_validate(entry["record"])
+        except Exception:
+          # The last line of a run killed mid-write
+          continue
+    manifest.updated = max(manifest.updated, log.stat().st_mtime)
+  return manifest
+
+def manifests_signature() -> tuple:
+  """Changes whenever a manifest or panel log under DATA_DIR is written; far cheaper than parsing them."""
+  stamps = []
+  for pattern in (f"*/{MANIFEST_FILE}", f"*/{PANEL_LOG_FILE}"):
+    for path in Path(DATA_DIR).glob(pattern):
+      try:
+        stat = path.stat()
+      except FileNotFoundError:
+        continue
+      stamps.append((str(path), stat.st_mtime_ns, stat.st_size))
+  return tuple(sorted(stamps))
+
+def list_manifests(include_complete: bool = False) -> list[tuple[Path, JobManifest]]:
+  """Job manifests under DATA_DIR, most recently updated first."""
+  manifests = []
+  for path in Path(DATA_DIR).glob(f"*/{MANIFEST_FILE}"):
+    try:
+      manifest = load_manifest(path)
+    except Exception as e:
+      print(f"Skipping unreadable manifest {path}: {e}")
+      continue
+    if include_complete or manifest.status != 'complete':
+      manifests.append((path, manifest))
+  return sorted(manifests, key=lambda item: item[1].updated, reverse=True)
+
+class JobRecorder:
+  """Keeps a manga's job manifest on disk in step with the pipeline.
+
+  Characters, scripts and the final status rewrite
+  `nanobanana_data/<title>/manifest.json` atomically. Panels, which are most
+  of the records, are each appended as one line to `panels.jsonl` instead, and
+  the log is emptied whenever the manifest is rewritten with them. Either way
+  an interrupted run can be resumed from the last completed character,
+  chapter script or panel.
+  """
+
+  def __init__(self, manifest: JobManifest, path: Path):
+    self.manifest = manifest
+    self.path = Path(path)
+
+  @classmethod
+  def create(cls, request: MainRequest, manga: Manga) -> "JobRecorder":
+    recorder = cls(JobManifest(request=request, manga=manga), manifest_path(manga.title))
+    recorder.save()
+    return recorder
+
+  @property
+  def log_path(self) -> Path:
+    return panel_log_path(self.path)
+
+  def save(self):
+    self.manifest.updated = time.time()
+    atomic_write(self.path, self.manifest.model_dump_json(indent=2))
+    # The manifest now holds every logged panel
+    if self.log_path.exists():
+      self.log_path.unlink()
+
+  def log_panel(self, key: tuple[int, int, int]):
+    entry = {"panel": panel_id(key), "record": self.manifest.panels[panel_id(key)].model_dump()}
+    with open(self.log_path, "a", encoding="utf-8") as f:
+      f.write(json.dumps(entry) + "\n")
+
+  def completed_characters(self) -> dict[str, str]:
+    return {
+      character_id: record.path
+      for character_id, record in self.manifest.characters.items()
+      if record.status == 'done' and record.path and os.path.exists(record.path)
+    }
+
+  def completed_panels(self) -> dict[tuple[int, int, int], str]:
+    # A panel streamed from a script that never finished belongs to a script the resumed run won't use
+    return {
+      tuple(int(part) for part in key.split("_")): record.path
+      for key, record in self.manifest.panels.items()
+      if record.status == 'done' and record.path and os.path.exists(record.path)
+      and int(key.split("_")[0]) in self.manifest.scripts
+    }
+
+  def record_character(self, character_id: str, path: str | None):
+    self.manifest.characters[character_id] = AssetRecord(status='done' if path else 'failed', path=path, bytes=asset_bytes(path))
+    self.save()
+
+  def record_script(self, chapter_idx: int, script: MangaChapterScript, keys: list[tuple[int, int, int]]):
+    self.manifest.scripts[chapter_idx] = script
+    for key in keys:
+      self.manifest.panels.setdefault(panel_id(key), AssetRecord())
+    self.save()
+
+  def record_panel(self, key: tuple[int, int, int], path: str | None, error: str | None = None):
+    self.manifest.panels[panel_id(key)] = AssetRecord(status='failed' if error else 'done', path=path, bytes=asset_bytes(path), error=error)
+    self.log_panel(key)
+
+  def finish(self, status: str, pdf: str | None = None):
+    self.manifest.status = status
+    self.manifest.pdf = pdf or self.manifest.pdf
+    self.save()
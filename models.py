@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from enum import Enum
+from config import CHAPTER_LOOKAHEAD, MAX_PANELS_IN_FLIGHT
 
 # class TextElementType(str, Enum):
 #     DIALOGUE = "dialogue"
@@ -56,11 +57,24 @@ class Chapter(BaseModel):
     chapter_title: str
     story: str
 
+class EncodingOptions(BaseModel):
+  format: str = 'jpeg'
+  quality: int = 90
+  max_dimension: int = 0
+  subsampling: str = '4:2:0'
+
 class Manga(BaseModel):
   title: str
   global_style: GlobalStyle
   chapters: list[Chapter]
 
+class MangaResult(BaseModel):
+  manga: Manga
+  scripts: list[MangaChapterScript]
+  images: list[str]
+  pages: list[str] = []
+  pdf: str | None = None
+
 class MainRequest(BaseModel):
   prompt: str
   context: str
@@ -69,6 +83,11 @@ class MainRequest(BaseModel):
   lang:str = 'english'
   model: str = 'gemini-2.5-pro'
   files: list[str] = []
+  max_in_flight: int = Field(default_factory=lambda: MAX_PANELS_IN_FLIGHT)
+  chapter_lookahead: int = Field(default_factory=lambda: CHAPTER_LOOKAHEAD)
+  compose_pages: bool = True
+  encoding: EncodingOptions = EncodingOptions()
+  use_cache: bool = True
   
 class MangaRequest(BaseModel):
   prompt: str
@@ -78,20 +97,70 @@ class MangaRequest(BaseModel):
   lang:str = 'english'
   model: str = 'gemini-2.5-pro'
   files: list[str] = []
+  use_cache: bool = True
   
 class ChapterRequest(BaseModel):
   chapter: Chapter
   global_style: GlobalStyle
   lang:str = 'english'
   model: str = 'gemini-2.5-pro'
+  use_cache: bool = True
 
 class CharacterRequest(BaseModel):
   manga: str
   global_style: GlobalStyle
+  encoding: EncodingOptions = EncodingOptions()
+  use_cache: bool = True
 
 class PanelRequest(BaseModel):
   manga: str
   scene_description: PromptComponents
   global_style: GlobalStyle
   id: str
-  model: str = 'gemini-2.5-pro'
\ No newline at end of file
+  model: str = 'gemini-2.5-pro'
+  encoding: EncodingOptions = EncodingOptions()
+  use_cache: bool = True
+
+class AssetRecord(BaseModel):
+  status: str = 'pending'
+  path: str | None = None
+  bytes: int | None = None
+  error: str | None = None
+
+class JobManifest(BaseModel):
+  request: MainRequest
+  manga: Manga
+  status: str = 'running'
+  scripts: dict[int, MangaChapterScript] = {}
+  characters: dict[str, AssetRecord] = {}
+  panels: dict[str, AssetRecord] = {}
+  pdf: str | None = None
+  updated: float = 0
+
+class JobRecord(BaseModel):
+  id: int
+  kind: str = 'generate'
+  payload: str
+  status: str = 'queued'
+  owner: str | None = None
+  worker: str | None = None
+  created: float = 0
+  started: float | None = None
+  finished: float | None = None
+  heartbeat: float | None = None
+  stage: str | None = None
+  progress: float = 0
+  title: str | None = None
+  panels_done: int = 0
+  panels_total: int = 0
+  manifest: str | None = None
+  result: MangaResult | None = None
+  error: str | None = None
+  cancel_requested: bool = False
+
+class JobEvent(BaseModel):
+  id: int
+  job_id: int
+  created: float
+  kind: str
+  data: dict = {}
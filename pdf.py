@@ -0,0 +1,133 @@
+import os
+import shutil
+import zlib
+from io import BytesIO
+from PIL import Image
+
+PDF_DPI = int(os.getenv("PDF_DPI", "96"))
+PDF_JPEG_QUALITY = int(os.getenv("PDF_JPEG_QUALITY", "90"))
+LOSSY_FORMATS = ("WEBP", "AVIF")
+
+class PdfStreamWriter:
+  """Writes a PDF page by page, straight to disk.
+
+  Every `add_images` call is written as a PDF incremental update: the new
+  image, content and page objects, a rewritten page tree and a fresh xref
+  section and trailer. The file on disk is a complete, readable PDF after each
+  call, and memory stays flat because only one image is held at a time. JPEGs
+  are copied into the file in chunks without being decoded, lossless formats
+  are Flate-compressed and other lossy formats (WebP, AVIF) are re-encoded as
+  JPEG, since PDF has no filter for them.
+  """
+
+  CATALOG, PAGES = 1, 2
+
+  def __init__(self, path: str, dpi: int = PDF_DPI):
+    self.path = path
+    self.dpi = dpi
+    self.page_ids: list[int] = []
+    self._next_id = 3
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    self._file = open(path, "wb")
+    self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    self._prev_xref: int | None = None
+    self._offsets: dict[int, int] = {}
+    self._write_object(self.CATALOG, f"<< /Type /Catalog /Pages {self.PAGES} 0 R >>".encode())
+    self._commit()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  @property
+  def pages(self) -> int:
+    return len(self.page_ids)
+
+  def _write_object(self, obj_id: int, body: bytes, stream: bytes | None = None):
+    self._offsets[obj_id] = self._file.tell()
+    self._file.write(f"{obj_id} 0 obj\n".encode())
+    self._file.write(body)
+    if stream is not None:
+      self._file.write(b"\nstream\n")
+      self._file.write(stream)
+      self._file.write(b"\nendstream")
+    self._file.write(b"\nendobj\n")
+
+  def _write_jpeg(self, obj_id: int, source: str | BytesIO, width: int, height: int, colorspace: str):
+    size = os.path.getsize(source) if isinstance(source, str) else source.getbuffer().nbytes
+    self._offsets[obj_id] = self._file.tell()
+    self._file.write(f"{obj_id} 0 obj\n".encode())
+    self._file.write(f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /{colorspace} /BitsPerComponent 8 /Filter /DCTDecode /Length {size} >>\nstream\n".encode())
+    if isinstance(source, str):
+      with open(source, "rb") as f:
+        shutil.copyfileobj(f, self._file, 1024 * 1024)
+    else:
+      self._file.write(source.getbuffer())
+    self._file.write(b"\nendstream\nendobj\n")
+
+  def _add_image(self, path: str):
+    image_id, content_id, page_id = self._next_id, self._next_id + 1, self._next_id + 2
+    self._next_id += 3
+    with Image.open(path) as image:
+      width, height = image.size
+      if image.format == "JPEG" and image.mode in ("L", "RGB"):
+        colorspace = "DeviceGray" if image.mode == "L" else "DeviceRGB"
+        self._write_jpeg(image_id, path, width, height, colorspace)
+      elif image.format in LOSSY_FORMATS:
+        image = image.convert("L" if image.mode in ("1", "L", "LA") else "RGB")
+        colorspace = "DeviceGray" if image.mode == "L" else "DeviceRGB"
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=PDF_JPEG_QUALITY)
+        self._write_jpeg(image_id, buffer, width, height, colorspace)
+      else:
+        image = image.convert("L" if image.mode in ("1", "L", "LA") else "RGB")
+        colorspace = "DeviceGray" if image.mode == "L" else "DeviceRGB"
+        data = zlib.compress(image.tobytes(), 6)
+        self._write_object(image_id, f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /{colorspace} /BitsPerComponent 8 /Filter /FlateDecode /Length {len(data)} >>".encode(), data)
+        del data
+    page_w, page_h = width * 72 / self.dpi, height * 72 / self.dpi
+    content = f"q {page_w:.2f} 0 0 {page_h:.2f} 0 0 cm /Im0 Do Q".encode()
+    self._write_object(content_id, f"<< /Length {len(content)} >>".encode(), content)
+    self._write_object(page_id, f"<< /Type /Page /Parent {self.PAGES} 0 R /MediaBox [0 0 {page_w:.2f} {page_h:.2f}] /Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>".encode())
+    self.page_ids.append(page_id)
+
+  def _commit(self):
+    kids = " ".join(f"{page_id} 0 R" for page_id in self.page_ids)
+    self._write_object(self.PAGES, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>".encode())
+
+    xref = self._file.tell()
+    lines = ["xref"]
+    if self._prev_xref is None:
+      lines.append("0 1")
+      lines.append("0000000000 65535 f ")
+    # One subsection per run of consecutive object ids
+    ids = sorted(self._offsets)
+    start = 0
+    for i in range(1, len(ids) + 1):
+      if i == len(ids) or ids[i] != ids[i - 1] + 1:
+        lines.append(f"{ids[start]} {i - start}")
+        lines.extend(f"{self._offsets[obj_id]:010d} 00000 n " for obj_id in ids[start:i])
+        start = i
+    prev = f" /Prev {self._prev_xref}" if self._prev_xref is not None else ""
+    lines.append(f"trailer\n<< /Size {self._next_id} /Root {self.CATALOG} 0 R{prev} >>")
+    lines.append(f"startxref\n{xref}\n%%EOF\n")
+    self._file.write("\n".join(lines).encode())
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self._prev_xref = xref
+    self._offsets = {}
+
+  def add_images(self, paths: list[str]) -> int:
+    """Append one page per image and make the file complete again. Returns the page count."""
+    paths = [path for path in paths if os.path.exists(path)]
+    if paths:
+      for path in paths:
+        self._add_image(path)
+      self._commit()
+    return self.pages
+
+  def close(self):
+    if not self._file.closed:
+      self._file.close()
@@ -0,0 +1,296 @@
+import asyncio
+from pathlib import Path
+from models import Manga, MangaRequest, ChapterRequest, CharacterRequest, CharacterSheet, Panel, PanelRequest, MainRequest, MangaChapterScript, MangaResult
+from services import CharacterAssets, generate_chapters, process_chapter, script_prefix
+from scheduler import PanelScheduler, PanelKey
+from manifest import JobRecorder, load_manifest, panel_id
+from compositor import PageCompositor
+from pdf import PdfStreamWriter
+from tracing import Span, tracer
+from contextcache import CachedPrefix
+from quality import QUALITY_GATE, QualityGate
+from config import CHAPTER_LOOKAHEAD, env_flag
+
+# Stream chapter scripts and start each panel as soon as it has been written
+STREAM_SCRIPTS = env_flag("STREAM_SCRIPTS", True)
+
+class PipelineHooks:
+  """Callbacks fired while a manga is generated. All of them are no-ops here.
+
+  Hooks run on the event loop thread, so a UI can update directly from them.
+  on_character and on_panel may also be coroutines; they are awaited by the
+  task that produced the asset.
+  """
+
+  def on_stage(self, stage: str):
+    """Called with 'outline', 'characters', 'chapters', 'pdf' and 'done'."""
+
+  def on_outline(self, manga: Manga):
+    pass
+
+  def on_character(self, character: CharacterSheet, path: str | None):
+    pass
+
+  def on_chapter(self, chapter_idx: int, script: MangaChapterScript, panels: int):
+    pass
+
+  def on_panel(self, key: PanelKey, req: PanelRequest, path: str):
+    pass
+
+class RecordingHooks(PipelineHooks):
+  """Writes every finished step to the job manifest, then forwards it."""
+
+  def __init__(self, recorder: JobRecorder, hooks: PipelineHooks):
+    self.recorder = recorder
+    self.hooks = hooks
+
+  def on_stage(self, stage: str):
+    self.hooks.on_stage(stage)
+
+  def on_outline(self, manga: Manga):
+    self.hooks.on_outline(manga)
+
+  def on_character(self, character: CharacterSheet, path: str | None):
+    self.recorder.record_character(character.character_id, path)
+    return self.hooks.on_character(character, path)
+
+  def on_chapter(self, chapter_idx: int, script: MangaChapterScript, panels: int):
+    keys = [(chapter_idx, page_idx, panel_idx) for page_idx, page in enumerate(script.pages) for panel_idx in range(len(page.panels))]
+    self.recorder.record_script(chapter_idx, script, keys)
+    self.hooks.on_chapter(chapter_idx, script, panels)
+
+  def on_panel(self, key: PanelKey, req: PanelRequest, path: str):
+    self.recorder.record_panel(key, path)
+    return self.hooks.on_panel(key, req, path)
+
+class ChapterPipeline:
+  """Scripts chapters ahead of panel rendering.
+
+  Up to `lookahead` chapters are scripted or rendering at once: a chapter's
+  slot is only freed when all of its panels have rendered, so the slow
+  text-model calls run behind image rendering without racing arbitrarily far
+  ahead of it. With `stream`, each panel goes to the scheduler as soon as the
+  model has written it; otherwise when its chapter's script arrives.
+  Chapters already in `scripts` are not scripted again.
+  """
+
+  def __init__(self, manga: Manga, request: MainRequest, scheduler: PanelScheduler, lookahead: int = CHAPTER_LOOKAHEAD, hooks: PipelineHooks | None = None, scripts: dict[int, MangaChapterScript] | None = None, stream: bool = STREAM_SCRIPTS):
+    self.manga = manga
+    self.request = request
+    self.scheduler = scheduler
+    self.hooks = hooks or PipelineHooks()
+    self.scripts: dict[int, MangaChapterScript] = dict(scripts or {})
+    self._submitted = {idx: asyncio.get_running_loop().create_future() for idx in range(len(manga.chapters))}
+    self._slots = asyncio.Semaphore(max(1, lookahead))
+    self._arrived: asyncio.Queue = asyncio.Queue()
+    self._tasks: list[asyncio.Task] = []
+    self.stream = stream
+    # Panels submitted from a script stream, by chapter, before the script was complete
+    self._streamed: dict[int, dict[PanelKey, Panel]] = {}
+    # Instructions and cast are the same for every chapter: one context cache serves them all
+    self.prefix = CachedPrefix(request.model, script_prefix(manga.global_style, request.lang))
+
+  def _panel_request(self, key: PanelKey, panel: Panel) -> PanelRequest:
+    return PanelRequest(
+      manga=self.manga.title,
+      scene_description=panel.scene_description,
+      global_style=self.manga.global_style,
+      # The file name matches the manifest's key for the panel
+      id=panel_id(key),
+      model=self.request.model,
+      encoding=self.request.encoding,
+      use_cache=self.request.use_cache
+    )
+
+  async def _script(self, chapter_idx: int) -> MangaChapterScript:
+    if chapter_idx in self.scripts:
+      return self.scripts[chapter_idx]
+    streamed = self._streamed.setdefault(chapter_idx, {})
+    def on_panel(page_idx: int, panel_idx: int, panel: Panel):
+      key = (chapter_idx, page_idx, panel_idx)
+      # A retried stream writes the same panels again; the first one is already rendering
+      if key not in streamed:
+        streamed[key] = panel
+        self.scheduler.submit(key, self._panel_request(key, panel))
+    with tracer.span("chapter_script", chapter=chapter_idx):
+      script = await process_chapter(ChapterRequest(
+        chapter=self.manga.chapters[chapter_idx],
+        global_style=self.manga.global_style,
+        lang=self.request.lang,
+        model=self.request.model,
+        use_cache=self.request.use_cache
+      ), self.prefix, on_panel if self.stream else None)
+      if script is None:
+        raise ValueError(f"Failed to script chapter {chapter_idx + 1}: {self.manga.chapters[chapter_idx].chapter_title}")
+    return script
+
+  async def _produce(self):
+    for chapter_idx in range(len(self.manga.chapters)):
+      await self._slots.acquire()
+      task = asyncio.create_task(self._script(chapter_idx))
+      task.add_done_callback(lambda t, idx=chapter_idx: self._arrived.put_nowait((idx, t)))
+      self._tasks.append(task)
+
+  async def chapter(self, chapter_idx: int) -> tuple[MangaChapterScript, list[PanelKey]]:
+    """Wait until a chapter's panels have been handed to the scheduler."""
+    return await asyncio.shield(self._submitted[chapter_idx])
+
+  async def _release_when_rendered(self, keys: list[PanelKey]):
+    try:
+      await self.scheduler.wait(keys)
+    finally:
+      self._slots.release()
+
+  async def run(self) -> list[MangaChapterScript]:
+    producer = asyncio.create_task(self._produce())
+    releases = []
+    try:
+      for _ in range(len(self.manga.chapters)):
+        chapter_idx, task = await self._arrived.get()
+        script = task.result()
+        self.scripts[chapter_idx] = script
+        streamed = self._streamed.pop(chapter_idx, {})
+        keys = []
+        for page_idx, page in enumerate(script.pages):
+          for panel_idx, panel in enumerate(page.panels):
+            key = (chapter_idx, page_idx, panel_idx)
+            if key in streamed:
+              # Already rendering: keep the script in line with what is being drawn
+              page.panels[panel_idx] = streamed.pop(key)
+            else:
+              self.scheduler.submit(key, self._panel_request(key, panel))
+            keys.append(key)
+        # Streamed by an attempt that failed midway, with no place in the final script
+        for key in streamed:
+          self.scheduler.discard(key)
+        self.hooks.on_chapter(chapter_idx, script, len(keys))
+        self._submitted[chapter_idx].set_result((script, keys))
+        releases.append(asyncio.create_task(self._release_when_rendered(keys)))
+      await producer
+    except BaseException:
+      producer.cancel()
+      for task in self._tasks + releases:
+        task.cancel()
+      raise
+    finally:
+      await self.prefix.close()
+    return [self.scripts[idx] for idx in sorted(self.scripts)]
+
+async def compose_chapter(chapter_idx: int, script: MangaChapterScript, paths: dict[PanelKey, str], manga_dir: Path) -> list[str]:
+  """Tile each page's rendered panels into a page image following its layout."""
+  pages = []
+  for page_idx, page in enumerate(script.pages):
+    panels = [
+      (panel.panel_number, paths[(chapter_idx, page_idx, panel_idx)])
+      for panel_idx, panel in enumerate(page.panels)
+      if (chapter_idx, page_idx, panel_idx) in paths
+    ]
+    if panels:
+      pages.append((page.layout, panels, f"{manga_dir}/pages/{chapter_idx}_{page_idx}.jpg"))
+  return await asyncio.to_thread(PageCompositor().compose_pages, pages)
+
+async def assemble_pdf(chapters: ChapterPipeline, scheduler: PanelScheduler, writer: PdfStreamWriter, manga_dir: Path, compose: bool) -> list[str]:
+  """Append chapters to the PDF in order, each one as soon as all of its panels
+  have rendered, so the PDF grows during the run instead of at the end."""
+  pages = []
+  for chapter_idx in range(len(chapters.manga.chapters)):
+    script, keys = await chapters.chapter(chapter_idx)
+    await scheduler.wait(keys)
+    with tracer.span("pdf.chapter", chapter=chapter_idx):
+      paths = scheduler.paths()
+      if compose:
+        files = await compose_chapter(chapter_idx, script, paths, manga_dir)
+        pages.extend(files)
+      else:
+        files = [paths[key] for key in keys if key in paths]
+      await asyncio.to_thread(writer.add_images, files)
+  return pages
+
+async def generate_manga(request: MainRequest, hooks: PipelineHooks | None = None, recorder: JobRecorder | None = None) -> MangaResult:
+  """Generate a whole manga. With a `recorder` from an earlier run, the
+  outline, scripts, characters and panels it already has are reused."""
+  hooks = hooks or PipelineHooks()
+  # One trace per run: every span opened below, in this task or the ones it starts, is part of it
+  with tracer.span("manga", model=request.model, chapters=request.num_chapters, resumed=recorder is not None) as span:
+    result = await _generate_manga(request, hooks, recorder, span)
+    span.set(panels=len(result.images), pages=len(result.pages))
+  return result
+
+async def _generate_manga(request: MainRequest, hooks: PipelineHooks, recorder: JobRecorder | None, span: Span) -> MangaResult:
+  if recorder:
+    request, manga = recorder.manifest.request, recorder.manifest.manga
+    recorder.manifest.status = 'running'
+  else:
+    hooks.on_stage('outline')
+    with tracer.span("outline"):
+      manga = await generate_chapters(MangaRequest(
+        prompt=request.prompt,
+        context=request.context,
+        instructions=request.instructions,
+        num_chapters=request.num_chapters,
+        lang=request.lang,
+        model=request.model,
+        files=request.files,
+        use_cache=request.use_cache
+      ))
+    recorder = JobRecorder.create(request, manga)
+  manga_dir = recorder.path.parent
+  span.set(title=manga.title)
+  hooks.on_outline(manga)
+  recording = RecordingHooks(recorder, hooks)
+
+  # Characters render in the background; each panel only waits for its own cast
+  hooks.on_stage('characters')
+  characters = CharacterAssets(CharacterRequest(
+    manga=manga.title,
+    global_style=manga.global_style,
+    encoding=request.encoding,
+    use_cache=request.use_cache
+  ), on_character=recording.on_character, existing=recorder.completed_characters())
+  characters.start()
+
+  hooks.on_stage('chapters')
+  quality = QualityGate() if QUALITY_GATE else None
+  scheduler = PanelScheduler(max_in_flight=request.max_in_flight, on_panel=recording.on_panel, characters=characters, completed=recorder.completed_panels(), quality=quality)
+  chapters = ChapterPipeline(manga, request, scheduler, lookahead=request.chapter_lookahead, hooks=recording, scripts=recorder.manifest.scripts)
+  pdf = f"{manga_dir}/generated_manga.pdf"
+  writer = PdfStreamWriter(pdf)
+  assembler = asyncio.create_task(assemble_pdf(chapters, scheduler, writer, manga_dir, request.compose_pages))
+  try:
+    scripts = await chapters.run()
+    images = await scheduler.results()
+    hooks.on_stage('pdf')
+    # What is left of the PDF once the last panel has rendered
+    with tracer.span("pdf"):
+      pages = await assembler
+  except Exception:
+    assembler.cancel()
+    # Let panels already in flight finish so the manifest keeps as much work as possible
+    await scheduler.settle()
+    for key, error in scheduler.failures().items():
+      recorder.record_panel(key, None, str(error))
+    recorder.finish('failed')
+    raise
+  except BaseException:
+    assembler.cancel()
+    scheduler.cancel()
+    recorder.finish('failed')
+    raise
+  finally:
+    writer.close()
+    # Panels are done with the encoded character sheets
+    characters.references.clear()
+    if quality:
+      span.set(quality=quality.stats())
+  await characters.wait_for([ch.character_id for ch in manga.global_style.character_sheets])
+
+  pdf = pdf if writer.pages else None
+  recorder.finish('complete', pdf)
+
+  hooks.on_stage('done')
+  return MangaResult(manga=manga, scripts=scripts, images=images, pages=pages, pdf=pdf)
+
+async def resume_manga(manifest_path: Path, hooks: PipelineHooks | None = None) -> MangaResult:
+  """Continue an interrupted or failed job from its manifest."""
+  recorder = JobRecorder(load_manifest(manifest_path), manifest_path)
+  return await generate_manga(recorder.manifest.request, hooks, recorder)
@@ -1,4 +1,4 @@
-prompt = f"""
+script_prefix_prompt = f"""
 You are an expert manga author and storyboard artist. Your mission is to generate a complete, detailed manga chapter script based on Given chapter and character details. The script must be a single, valid JSON object that strictly adheres to the provided schema.
 
 Creative & Technical Guidelines
@@ -71,12 +71,6 @@ SFX: Sound effects should be integrated into the artwork. The position_hint coul
 - Do not generate meaningless, too short scripts
 - Scripts should be detailed, Meaningful and must follow a storyline
 
-6. Generation Task
-Now, using all the guidelines above, generate the Manga JSON for the following request.
-
-Chapter Details:
-{{chapter}}
-
 Characters Details:
 {{characters}}
 
@@ -84,6 +78,15 @@ Language [Only for Dialogues]:
 {{lang}}
 """
 
+# Only this part differs between the chapters of a manga; everything above it is a shared, cacheable prefix
+script_chapter_prompt = f"""
+6. Generation Task
+Now, using all the guidelines above, generate the Manga JSON for the following chapter.
+
+Chapter Details:
+{{chapter}}
+"""
+
 image_prompt = f"""
 Generate a single, high-impact manga panel based on the provided character reference images. The scene should be captured with a {{camera_shot}}, focusing on the {{subject}}. Their expression and body language must convey a powerful sense of {{emotion}} as they are depicted mid-{{action_description}} The setting is a rich and detailed {{environment_description}}, with lighting that enhances the mood. The overall visual treatment should be a {{art_style_description}}, incorporating stylistic elements such as {{style_tags}}. Include dialogue/caption box with the text if required and ensure the final image is rendered in a {{aspect_ratio}} aspect ratio suitable for a manga page.
 """
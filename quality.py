@@ -0,0 +1,133 @@
+import asyncio
+import math
+import os
+import re
+from typing import NamedTuple
+import numpy as np
+from PIL import Image
+from config import env_flag
+
+QUALITY_GATE = env_flag("QUALITY_GATE", True)
+# Re-renders allowed for one panel, and for all the panels of one manga
+QUALITY_RETRIES = int(os.getenv("QUALITY_RETRIES", "2"))
+QUALITY_BUDGET = int(os.getenv("QUALITY_BUDGET", "10"))
+# Greyscale standard deviation (0-255) below which a panel counts as blank
+QUALITY_MIN_CONTRAST = float(os.getenv("QUALITY_MIN_CONTRAST", "4.0"))
+# Allowed relative difference between the rendered and the requested aspect ratio
+QUALITY_ASPECT_TOLERANCE = float(os.getenv("QUALITY_ASPECT_TOLERANCE", "0.15"))
+# Panels whose 64-bit difference hashes are at most this many bits apart are duplicates
+QUALITY_DUPLICATE_DISTANCE = int(os.getenv("QUALITY_DUPLICATE_DISTANCE", "4"))
+# Issues a re-render can fix. The image call takes no aspect ratio setting, so the same prompt
+# rarely fixes one; those are only recorded unless 'aspect' is added here
+QUALITY_RERENDER = frozenset(kind.strip() for kind in os.getenv("QUALITY_RERENDER", "blank,duplicate").split(",") if kind.strip())
+# Images are checked at this size; the checks don't need full resolution
+INSPECT_DIMENSION = 256
+
+PanelKey = tuple[int, int, int]
+
+class Issue(NamedTuple):
+  kind: str
+  """'blank', 'aspect' or 'duplicate'."""
+  detail: str
+
+class Inspection(NamedTuple):
+  width: int
+  height: int
+  contrast: float
+  """Standard deviation of the greyscale pixels."""
+  dhash: int
+  """64-bit difference hash, equal for near-identical images."""
+
+def dhash(grey: Image.Image) -> int:
+  """Difference hash: one bit per horizontally adjacent pair of a 9x8 thumbnail."""
+  pixels = np.asarray(grey.resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+  bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+  return int.from_bytes(bits.tobytes(), "big")
+
+def inspect(path: str) -> Inspection:
+  with Image.open(path) as image:
+    width, height = image.size
+    # JPEGs can be decoded straight at a fraction of their size
+    image.draft("L", (INSPECT_DIMENSION, INSPECT_DIMENSION))
+    grey = image.convert("L")
+  grey.thumbnail((INSPECT_DIMENSION, INSPECT_DIMENSION))
+  contrast = float(np.asarray(grey, dtype=np.float32).std())
+  return Inspection(width, height, contrast, dhash(grey))
+
+def parse_aspect_ratio(text: str) -> float | None:
+  """Width / height of an aspect ratio like "16:9", "4/3" or "1.5"; None if there isn't one."""
+  text = text or ""
+  match = re.search(r"(\d+(?:\.\d+)?)\s*[:/x]\s*(\d+(?:\.\d+)?)", text) or re.fullmatch(r"\s*(\d+(?:\.\d+)?)()\s*", text)
+  if not match:
+    return None
+  width, height = float(match.group(1)), float(match.group(2) or 1)
+  return width / height if width > 0 and height > 0 else None
+
+class QualityGate:
+  """Flags degenerate panels of one manga so only those are rendered again.
+
+  `check` looks at a rendered panel and lists what is wrong with it: blank or
+  near-uniform, an aspect ratio other than the one its scene asked for, or a
+  duplicate of a panel on the same or an adjacent page of its chapter. The
+  caller re-renders a panel with an issue of a kind in `rerender` while
+  `allow` grants it a retry: at most `retries` per panel and `budget` per
+  manga, so a model that keeps failing costs a few calls rather than a rerun
+  of everything.
+  """
+
+  def __init__(self, retries: int = QUALITY_RETRIES, budget: int = QUALITY_BUDGET, rerender: frozenset[str] = QUALITY_RERENDER):
+    self.retries = retries
+    self.budget = budget
+    self.rerender = rerender
+    self._hashes: dict[PanelKey, int] = {}
+    self.checked = 0
+    self.flagged = 0
+    self.rerendered = 0
+
+  def issues(self, key: PanelKey, inspection: Inspection, aspect_ratio: str) -> list[Issue]:
+    issues = []
+    if inspection.contrast < QUALITY_MIN_CONTRAST:
+      issues.append(Issue('blank', f"blank (contrast {inspection.contrast:.1f})"))
+    expected = parse_aspect_ratio(aspect_ratio)
+    actual = inspection.width / inspection.height
+    if expected and abs(math.log(actual / expected)) > math.log1p(QUALITY_ASPECT_TOLERANCE):
+      issues.append(Issue('aspect', f"aspect ratio {actual:.2f} instead of {expected:.2f}"))
+    for other, other_hash in self._hashes.items():
+      if other != key and other[0] == key[0] and abs(other[1] - key[1]) <= 1:
+        distance = (inspection.dhash ^ other_hash).bit_count()
+        if distance <= QUALITY_DUPLICATE_DISTANCE:
+          issues.append(Issue('duplicate', f"duplicate of panel {other} ({distance} bits apart)"))
+          break
+    return issues
+
+  async def check(self, key: PanelKey, path: str, aspect_ratio: str) -> list[Issue]:
+    """What is wrong with the panel at `path`; empty if it passes."""
+    inspection = await asyncio.to_thread(inspect, path)
+    issues = self.issues(key, inspection, aspect_ratio)
+    # A re-render replaces the hash, so later panels are compared with what is kept. Blank
+    # panels all hash alike and are flagged anyway, so they aren't compared with others
+    if inspection.contrast >= QUALITY_MIN_CONTRAST:
+      self._hashes[key] = inspection.dhash
+    else:
+      self._hashes.pop(key, None)
+    self.checked += 1
+    if issues:
+      self.flagged += 1
+    return issues
+
+  def fixable(self, issues: list[Issue]) -> bool:
+    """Whether rendering the panel again could fix any of `issues`."""
+    return any(issue.kind in self.rerender for issue in issues)
+
+  def allow(self, attempt: int) -> bool:
+    """Whether a panel already re-rendered `attempt` times may be rendered again; spends the budget if so."""
+    if attempt >= self.retries or self.rerendered >= self.budget:
+      return False
+    self.rerendered += 1
+    return True
+
+  def forget(self, key: PanelKey):
+    self._hashes.pop(key, None)
+
+  def stats(self) -> dict:
+    return {"checked": self.checked, "flagged": self.flagged, "rerendered": self.rerendered}
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from google.genai import errors
+
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", "60"))
+RATE_LIMIT_TPM = float(os.getenv("RATE_LIMIT_TPM", "1000000"))
+RATE_MAX_CONCURRENCY = int(os.getenv("RATE_MAX_CONCURRENCY", "8"))
+# Per-model overrides, e.g. {"gemini-2.5-pro": {"rpm": 5, "tpm": 250000, "concurrency": 2}}
+RATE_LIMITS = json.loads(os.getenv("RATE_LIMITS", "{}"))
+THROTTLE_CODES = (429, 503)
+# Rough size of one image in tokens, used until the response reports real usage
+IMAGE_TOKENS = 1290
+# Throttles within this many seconds of a decrease count as the same event
+DECREASE_COOLDOWN = 5.0
+
+def is_throttle(e: BaseException) -> bool:
+  return isinstance(e, errors.APIError) and e.code in THROTTLE_CODES
+
+def estimate_tokens(prompt: str, images: int = 0) -> int:
+  return len(prompt) // 4 + images * IMAGE_TOKENS
+
+class TokenBucket:
+  """Refills `rate` tokens per minute up to `rate`.
+
+  Takes are reservations: the balance may go negative and the caller sleeps
+  until its share has refilled, so waiters are served in arrival order
+  without a lock.
+  """
+
+  def __init__(self, rate: float):
+    self.rate = rate
+    self.tokens = rate
+    self._stamp = time.monotonic()
+
+  def _refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.rate, self.tokens + (now - self._stamp) * self.rate / 60)
+    self._stamp = now
+
+  def available(self) -> float:
+    self._refill()
+    return self.tokens
+
+  def reserve(self, amount: float) -> float:
+    """Take `amount` tokens and return how long to wait before using them."""
+    self._refill()
+    self.tokens -= min(amount, self.rate)
+    return max(0.0, -self.tokens * 60 / self.rate)
+
+  def adjust(self, amount: float):
+    """Correct an earlier reservation by `amount` (positive takes more)."""
+    self._refill()
+    self.tokens -= amount
+
+  def drain(self):
+    self._refill()
+    self.tokens = min(self.tokens, 0.0)
+
+class Slot:
+  def __init__(self, limiter: "ModelLimiter", estimate: int):
+    self.limiter = limiter
+    self.estimate = estimate
+
+  def record(self, usage):
+    """Reconcile the token reservation with the response's usage metadata."""
+    total = getattr(usage, "total_token_count", None) if usage else None
+    if total:
+      self.limiter.tpm.adjust(total - self.estimate)
+      self.limiter.tokens += total - self.estimate
+
+class ModelLimiter:
+  """Request, token and concurrency limits for one model.
+
+  Requests per minute and tokens per minute are token buckets. Concurrency is
+  adjusted AIMD-style: every success adds 1/limit to the limit (about +1 per
+  round of requests) and a 429/503 halves it, so throughput settles just under
+  the quota the API is actually granting.
+  """
+
+  def __init__(self, model: str, rpm: float = RATE_LIMIT_RPM, tpm: float = RATE_LIMIT_TPM, concurrency: int = RATE_MAX_CONCURRENCY):
+    self.model = model
+    self.rpm = TokenBucket(rpm)
+    self.tpm = TokenBucket(tpm)
+    self.max_concurrency = concurrency
+    self.limit = float(concurrency)
+    self.in_flight = 0
+    self.pacing = 0
+    self.requests = 0
+    self.tokens = 0
+    self.throttled = 0
+    self._last_decrease = 0.0
+    self._waiters: deque[asyncio.Future] = deque()
+    self._loop = None
+
+  def _check_loop(self):
+    # Streamlit runs each generation in a fresh event loop; waiters from a closed one are dead
+    loop = asyncio.get_running_loop()
+    if loop is not self._loop:
+      self._loop = loop
+      self._waiters.clear()
+      self.in_flight = 0
+      self.pacing = 0
+
+  def _wake(self):
+    while self._waiters and self.in_flight < int(self.limit):
+      waiter = self._waiters.popleft()
+      if not waiter.done():
+        self.in_flight += 1
+        waiter.set_result(None)
+
+  async def _acquire(self):
+    self._check_loop()
+    if self.in_flight < int(self.limit) and not self._waiters:
+      self.in_flight += 1
+      return
+    waiter = self._loop.create_future()
+    self._waiters.append(waiter)
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if waiter.done() and not waiter.cancelled():
+        self._release()
+      elif waiter in self._waiters:
+        self._waiters.remove(waiter)
+      raise
+
+  def _release(self):
+    self.in_flight -= 1
+    self._wake()
+
+  def success(self):
+    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+    self._wake()
+
+  def backoff(self):
+    self.throttled += 1
+    now = time.monotonic()
+    if now - self._last_decrease > DECREASE_COOLDOWN:
+      self.limit = max(1.0, self.limit / 2)
+      self._last_decrease = now
+    # Let the quota window recover before the next request goes out
+    self.rpm.drain()
+
+  def failed(self, e: BaseException):
+    """Account for the error of a request sent outside `slot`, such as a hedge."""
+    if is_throttle(e):
+      self.backoff()
+
+  @asynccontextmanager
+  async def slot(self, estimate: int):
+    await self._acquire()
+    try:
+      self.pacing += 1
+      try:
+        delay = max(self.rpm.reserve(1), self.tpm.reserve(estimate))
+        if delay:
+          await asyncio.sleep(delay)
+      finally:
+        self.pacing -= 1
+      self.requests += 1
+      self.tokens += estimate
+      try:
+        yield Slot(self, estimate)
+      except BaseException as e:
+        if is_throttle(e):
+          self.backoff()
+        raise
+      self.success()
+    finally:
+      self._release()
+
+  @property
+  def congested(self) -> bool:
+    """Requests are queueing, every slot is taken or the limit is backed off after a throttle."""
+    return bool(self._waiters) or self.pacing > 0 or self.in_flight >= int(self.limit) or self.limit < self.max_concurrency
+
+  def spare(self, estimate: int) -> bool:
+    """Charge one extra request to the quota if it can go out now without waiting
+    or adding to congestion; used for hedges, which run inside an existing slot."""
+    if self.congested or self.rpm.available() < 1 or self.tpm.available() < estimate:
+      return False
+    self.rpm.reserve(1)
+    self.tpm.reserve(estimate)
+    self.requests += 1
+    self.tokens += estimate
+    return True
+
+  def stats(self) -> dict:
+    return {
+      "model": self.model,
+      "concurrency": int(self.limit),
+      "max_concurrency": self.max_concurrency,
+      "in_flight": self.in_flight,
+      "queued": len(self._waiters) + self.pacing,
+      "rpm_limit": self.rpm.rate,
+      "rpm_available": round(self.rpm.available(), 1),
+      "tpm_limit": self.tpm.rate,
+      "tpm_available": round(self.tpm.available()),
+      "requests": self.requests,
+      "tokens": self.tokens,
+      "throttled": self.throttled,
+    }
+
+class RateLimiter:
+  """Shared per-model limiters for every Gemini call in the process."""
+
+  def __init__(self, limits: dict = RATE_LIMITS):
+    self.limits = limits
+    self.models: dict[str, ModelLimiter] = {}
+
+  def model(self, model: str) -> ModelLimiter:
+    if model not in self.models:
+      self.models[model] = ModelLimiter(model, **self.limits.get(model, {}))
+    return self.models[model]
+
+  def slot(self, model: str, estimate: int):
+    return self.model(model).slot(estimate)
+
+  def snapshot(self) -> list[dict]:
+    return [limiter.stats() for limiter in self.models.values()]
+
+rate_limiter = RateLimiter()
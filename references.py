@@ -0,0 +1,58 @@
+import asyncio
+import hashlib
+import os
+from io import BytesIO
+from typing import NamedTuple
+from PIL import Image
+from google.genai import types
+from encoding import MIME_TYPES, encode
+from models import EncodingOptions
+from sharedtasks import SharedTasks
+
+# Reference images are sent at most this large; the model doesn't need full-resolution character sheets
+REFERENCE_MAX_DIMENSION = int(os.getenv("REFERENCE_MAX_DIMENSION", "1024"))
+REFERENCE_FORMAT = os.getenv("REFERENCE_FORMAT", "jpeg")
+REFERENCE_QUALITY = int(os.getenv("REFERENCE_QUALITY", "90"))
+
+class Reference(NamedTuple):
+  digest: str
+  """SHA-256 of the source file, as used in image cache keys."""
+  part: types.Part
+
+def load_reference(path: str, options: EncodingOptions) -> Reference:
+  """Read `path` once: hash it, downscale and encode it into a ready-to-send part."""
+  with open(path, "rb") as f:
+    data = f.read()
+  with Image.open(BytesIO(data)) as image:
+    encoded, ext = encode(image, options)
+  return Reference(hashlib.sha256(data).hexdigest(), types.Part.from_bytes(data=encoded, mime_type=MIME_TYPES[ext]))
+
+class ReferenceImages:
+  """The reference images of one manga, each loaded and encoded once.
+
+  Every panel of a manga sends some of the same few character sheets.
+  Entries are keyed by path and file stat, so a re-rendered sheet is loaded
+  again, and concurrent panels asking for the same sheet share one load.
+  The owner clears the cache when the manga is done.
+  """
+
+  def __init__(self, max_dimension: int = REFERENCE_MAX_DIMENSION, fmt: str = REFERENCE_FORMAT, quality: int = REFERENCE_QUALITY):
+    self.options = EncodingOptions(format=fmt, quality=quality, max_dimension=max_dimension)
+    self._entries: SharedTasks[tuple[str, int, int], Reference] = SharedTasks()
+    self.loads = 0
+    self.hits = 0
+
+  async def get(self, path: str) -> Reference:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if self._entries.started(key):
+      self.hits += 1
+    else:
+      self.loads += 1
+    return await self._entries.run(key, lambda: asyncio.to_thread(load_reference, path, self.options))
+
+  async def get_many(self, paths: list[str]) -> list[Reference]:
+    return list(await asyncio.gather(*(self.get(path) for path in paths)))
+
+  def clear(self):
+    self._entries.clear()
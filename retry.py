@@ -0,0 +1,112 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+from google.genai import errors
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from tracing import current_span
+from config import env_flag
+from stats import percentile
+
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "4"))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", "2"))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "60"))
+HEDGE_REQUESTS = env_flag("HEDGE_REQUESTS", False)
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+# Don't hedge on a latency estimate from too few calls
+HEDGE_MIN_SAMPLES = 20
+RETRYABLE_CODES = (408, 429, 500, 502, 503, 504)
+
+T = TypeVar("T")
+
+class NoImageReturned(Exception):
+  """The model answered without an image part (refusal, safety block or text only)."""
+
+  def __init__(self, reason: str | None = None, text: str | None = None):
+    self.reason = reason
+    self.text = text
+    super().__init__(f"No image returned (reason: {reason or 'unknown'}){f': {text}' if text else ''}")
+
+def is_retryable(e: BaseException) -> bool:
+  if isinstance(e, errors.APIError):
+    return e.code in RETRYABLE_CODES
+  return isinstance(e, (asyncio.TimeoutError, NoImageReturned, ConnectionError))
+
+class LatencyTracker:
+  """Sliding window of recent call latencies."""
+
+  def __init__(self, window: int = 200):
+    self.samples: deque[float] = deque(maxlen=window)
+
+  def observe(self, seconds: float):
+    self.samples.append(seconds)
+
+  def quantile(self, q: float) -> float | None:
+    if len(self.samples) < HEDGE_MIN_SAMPLES:
+      return None
+    return percentile(self.samples, q)
+
+async def retrying(call: Callable[[], Awaitable[T]], name: str = "request", attempts: int = RETRY_ATTEMPTS) -> T:
+  """Run `call` until it succeeds, retrying transient failures with jittered exponential backoff."""
+  def log(state):
+    span = current_span()
+    if span:
+      span.retries += 1
+    print(f"Retrying {name} (attempt {state.attempt_number + 1}/{attempts}) in {state.next_action.sleep:.1f}s after: {state.outcome.exception()}")
+
+  async for attempt in AsyncRetrying(
+    stop=stop_after_attempt(attempts),
+    wait=wait_random_exponential(multiplier=RETRY_BACKOFF, max=RETRY_BACKOFF_MAX),
+    retry=retry_if_exception(is_retryable),
+    before_sleep=log,
+    reraise=True,
+  ):
+    with attempt:
+      return await call()
+
+async def hedged(call: Callable[[], Awaitable[T]], tracker: LatencyTracker, quantile: float = HEDGE_QUANTILE, enabled: bool = HEDGE_REQUESTS, allow: Callable[[], bool] | None = None, on_error: Callable[[BaseException], None] | None = None) -> T:
+  """Run `call`, and if it is still going after the tracker's `quantile` latency,
+  start a duplicate and take whichever succeeds first. The other is cancelled.
+  `call` should be the request alone, without any queueing, so the tracker
+  learns the API's latency. `allow` is asked when the duplicate is due and can
+  refuse it, e.g. while the rate limiter has no spare quota. `on_error` gets
+  the error of a call that failed while the other one went on, which is
+  otherwise dropped. The current span records `hedged` and `hedge_won`."""
+  async def timed():
+    start = time.monotonic()
+    result = await call()
+    tracker.observe(time.monotonic() - start)
+    return result
+
+  threshold = tracker.quantile(quantile) if enabled else None
+  primary = asyncio.ensure_future(timed())
+  tasks = {primary}
+  try:
+    if threshold is not None:
+      done, _ = await asyncio.wait(tasks, timeout=threshold)
+      if not done and (allow is None or allow()):
+        span = current_span()
+        if span:
+          span.set(hedged=True, hedge_won=False)
+        tasks.add(asyncio.ensure_future(timed()))
+    won, failed = None, []
+    while tasks and won is None:
+      done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+      won = next((task for task in done if task.exception() is None), None)
+      failed += [task for task in done if task is not won]
+    if won is not None and won is not primary:
+      span = current_span()
+      if span:
+        span.set(hedge_won=True)
+    if on_error:
+      # With no winner the primary's error is raised; the others would be lost
+      for task in failed:
+        if won is not None or task is not primary:
+          on_error(task.exception())
+    if won is None:
+      raise primary.exception()
+    return won.result()
+  finally:
+    for task in tasks:
+      task.cancel()
@@ -0,0 +1,140 @@
+import asyncio
+import contextvars
+import time
+from typing import Awaitable, Callable
+from models import PanelRequest
+from services import CharacterAssets, process_panel
+from quality import QualityGate
+from tracing import tracer
+from config import MAX_PANELS_IN_FLIGHT
+
+PanelKey = tuple[int, int, int]
+OnPanel = Callable[[PanelKey, PanelRequest, str], Awaitable[None] | None]
+
+class PanelScheduler:
+  """Fans panel renders out under a max-in-flight limit.
+
+  Panels are submitted with a (chapter, page, panel) key as soon as their
+  chapter script is known. Rendering starts immediately, `on_panel` is called
+  as each one finishes, and `results()` returns the paths in key order no
+  matter which render finished first. With `characters`, a panel waits for its
+  own characters outside the in-flight limit, so waiting never holds a slot.
+  Panels in `completed` (key -> path) are reported without rendering again.
+  With `quality`, each render is checked and a panel with a fixable issue goes
+  back in the queue to be rendered again, within the gate's retry budget.
+  """
+
+  def __init__(self, max_in_flight: int = MAX_PANELS_IN_FLIGHT, on_panel: OnPanel | None = None, characters: CharacterAssets | None = None, completed: dict[PanelKey, str] | None = None, quality: QualityGate | None = None):
+    self.max_in_flight = max(1, max_in_flight)
+    self.on_panel = on_panel
+    self.characters = characters
+    self.completed_panels = completed or {}
+    self.quality = quality
+    self._semaphore = asyncio.Semaphore(self.max_in_flight)
+    self._tasks: dict[PanelKey, asyncio.Task] = {}
+    # Panel spans are children of the span the scheduler was made in (the manga), even
+    # when submitted from inside another one, like a chapter script that is still streaming
+    self._context = contextvars.copy_context()
+
+  def submit(self, key: PanelKey, req: PanelRequest) -> asyncio.Task:
+    if key in self._tasks:
+      raise ValueError(f"Panel {key} was already submitted")
+    task = asyncio.create_task(self._run(key, req), context=self._context.copy())
+    self._tasks[key] = task
+    return task
+
+  async def _run(self, key: PanelKey, req: PanelRequest) -> str:
+    submitted = time.monotonic()
+    with tracer.span("panel", key=list(key), panel_id=req.id) as span:
+      if key in self.completed_panels:
+        path = self.completed_panels[key]
+        span.set(resumed=True)
+      else:
+        # Queue wait: from submission until this panel holds a slot, characters included
+        if self.characters:
+          await self.characters.wait_for(req.scene_description.character_ids)
+        async with self._semaphore:
+          span.queue_wait = time.monotonic() - submitted
+          path = await process_panel(req, self.characters)
+        if self.quality:
+          path = await self._recheck(key, req, path, span)
+    if self.on_panel:
+      result = self.on_panel(key, req, path)
+      if asyncio.iscoroutine(result):
+        await result
+    return path
+
+  async def _recheck(self, key: PanelKey, req: PanelRequest, path: str, span) -> str:
+    """Render a flagged panel again, bypassing the image cache, until it passes, has
+    only issues a re-render can't fix or runs out of retries."""
+    rerenders = 0
+    while issues := await self.quality.check(key, path, req.scene_description.aspect_ratio):
+      details = '; '.join(issue.detail for issue in issues)
+      span.set(quality_issues=[issue.detail for issue in issues])
+      if not self.quality.fixable(issues):
+        print(f"Keeping panel {key}, a re-render wouldn't fix it: {details}")
+        break
+      if not self.quality.allow(rerenders):
+        print(f"Keeping panel {key} out of quality retries: {details}")
+        break
+      rerenders += 1
+      print(f"Rendering panel {key} again: {details}")
+      async with self._semaphore:
+        path = await process_panel(req, self.characters, refresh=True)
+    else:
+      span.set(quality_issues=[])
+    span.set(rerenders=rerenders)
+    return path
+
+  def discard(self, key: PanelKey):
+    """Cancel and forget a submitted panel."""
+    task = self._tasks.pop(key, None)
+    if self.quality:
+      self.quality.forget(key)
+    if task:
+      task.cancel()
+
+  @property
+  def submitted(self) -> int:
+    return len(self._tasks)
+
+  @property
+  def completed(self) -> int:
+    return sum(1 for task in self._tasks.values() if task.done())
+
+  async def wait(self, keys: list[PanelKey]):
+    """Wait for the given panels to finish, successfully or not."""
+    await asyncio.gather(*(self._tasks[key] for key in keys), return_exceptions=True)
+
+  async def settle(self):
+    """Wait for every submitted panel to finish, successfully or not."""
+    await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+  def failures(self) -> dict[PanelKey, BaseException]:
+    return {
+      key: task.exception()
+      for key, task in self._tasks.items()
+      if task.done() and not task.cancelled() and task.exception() is not None
+    }
+
+  def paths(self) -> dict[PanelKey, str]:
+    """Paths of the panels that rendered successfully so far."""
+    return {
+      key: task.result()
+      for key, task in self._tasks.items()
+      if task.done() and not task.cancelled() and task.exception() is None
+    }
+
+  async def results(self) -> list[str]:
+    """Paths in key order. A failed panel is raised only after every other
+    panel has finished, so one bad render never throws away the rest."""
+    try:
+      await self.settle()
+    except BaseException:
+      self.cancel()
+      raise
+    return [self._tasks[key].result() for key in sorted(self._tasks)]
+
+  def cancel(self):
+    for task in self._tasks.values():
+      task.cancel()
@@ -1,46 +1,114 @@
-from models import Manga, MangaRequest, ChapterRequest, CharacterRequest, PanelRequest, MangaChapterScript
-from prompts import chapter_prompt, character_prompt, prompt, image_prompt
+from models import GlobalStyle, Manga, MangaRequest, ChapterRequest, CharacterRequest, Panel, PanelRequest, MangaChapterScript, CharacterSheet
+from prompts import chapter_prompt, character_prompt, script_prefix_prompt, script_chapter_prompt, image_prompt
 from utils import clean_string, structured, generate_image
+from encoding import output_path
+from tracing import tracer
+from contextcache import CachedPrefix
+from references import ReferenceImages
 from pathlib import Path
+from pydantic import ValidationError
+from typing import Awaitable, Callable
+import asyncio
 DATA_DIR = Path("nanobanana_data")
 
 async def generate_chapters(req: MangaRequest) -> Manga:
   formatted_prompt = chapter_prompt.format(**req.model_dump())
-  result: Manga = await structured(formatted_prompt,Manga,req.model,req.files)
+  result: Manga = await structured(formatted_prompt,Manga,req.model,req.files,use_cache=req.use_cache)
   return result
 
-async def generate_characters(req: CharacterRequest):
-  for character in req.global_style.character_sheets:
-      cprompt = character_prompt.format(**{
-          'character_id': character.character_id,
-          'personality': character.personality,
-          'detailed_appearance': character.detailed_appearence,
-          'art_style_description': req.global_style.art_style_description
-      })
-      path = f'{DATA_DIR}/{await clean_string(req.manga)}/{await clean_string(character.character_id)}.png'
-      path = await generate_image(cprompt,path,[])
-
-async def process_chapter(req: ChapterRequest) -> MangaChapterScript:
+OnCharacter = Callable[[CharacterSheet, str | None], Awaitable[None] | None]
+
+class CharacterAssets:
+  """One task per character sheet, so a panel only waits for its own cast; `existing` ones are reused."""
+
+  def __init__(self, req: CharacterRequest, on_character: OnCharacter | None = None, existing: dict[str, str] | None = None):
+    self.req = req
+    self.on_character = on_character
+    self.existing = existing or {}
+    self.references = ReferenceImages()
+    self._tasks: dict[str, asyncio.Task] = {}
+
+  def start(self) -> dict[str, asyncio.Task]:
+    for character in self.req.global_style.character_sheets:
+      if character.character_id not in self._tasks:
+        self._tasks[character.character_id] = asyncio.create_task(self._render(character))
+    return self._tasks
+
+  async def _render(self, character: CharacterSheet) -> str:
+    cprompt = character_prompt.format(**{
+        'character_id': character.character_id,
+        'personality': character.personality,
+        'detailed_appearance': character.detailed_appearence,
+        'art_style_description': self.req.global_style.art_style_description
+    })
+    path = f'{DATA_DIR}/{await clean_string(self.req.manga)}/{await clean_string(character.character_id)}.png'
+    try:
+      with tracer.span("character", character_id=character.character_id) as span:
+        if character.character_id in self.existing:
+          path = self.existing[character.character_id]
+          span.set(resumed=True)
+        else:
+          path = await generate_image(cprompt,path,[],use_cache=self.req.use_cache,encoding=self.req.encoding)
+    except Exception:
+      await self._notify(character, None)
+      raise
+    await self._notify(character, path)
+    return path
+
+  async def _notify(self, character: CharacterSheet, path: str | None):
+    if self.on_character:
+      result = self.on_character(character, path)
+      if asyncio.iscoroutine(result):
+        await result
+
+  async def wait_for(self, character_ids: list[str]) -> list[str]:
+    """Paths of the requested characters, skipping unknown ids and failed renders."""
+    tasks = [self._tasks[ch] for ch in dict.fromkeys(character_ids) if ch in self._tasks]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return [path for path in results if isinstance(path, str)]
+
+def script_prefix(global_style: GlobalStyle, lang: str) -> str:
+  """The part of the chapter-script prompt shared by every chapter of a manga."""
+  characters = '\n****\n'.join([
+      f'{ch.character_id}\nPersonality:\n{ch.personality}\nAppearance:\n{ch.detailed_appearence}' 
+      for ch in global_style.character_sheets
+      ])
+  return script_prefix_prompt.format(**{
+      'characters': characters,
+      'lang': lang
+  })
+
+OnScriptPanel = Callable[[int, int, Panel], None]
+
+async def process_chapter(req: ChapterRequest, prefix: CachedPrefix | None = None, on_panel: OnScriptPanel | None = None) -> MangaChapterScript:
+  """Script one chapter, streaming each panel to on_panel(page_idx, panel_idx, panel) if given."""
   try:
-    characters = '\n****\n'.join([
-        f'{ch.character_id}\nPersonality:\n{ch.personality}\nAppearance:\n{ch.detailed_appearence}' 
-        for ch in req.global_style.character_sheets
-        ])
     chapter = f"""
     {req.chapter.chapter_title}
     {req.chapter.story}
     """
-    formatted_prompt = prompt.format(**{
-        'chapter': chapter,
-        'characters': characters,
-        'lang': req.lang
+    formatted_prompt = script_chapter_prompt.format(**{
+        'chapter': chapter
     })
-    result: MangaChapterScript = await structured(formatted_prompt,MangaChapterScript,req.model)
+    prefix = prefix or CachedPrefix(req.model, script_prefix(req.global_style, req.lang), enabled=False)
+    def on_object(path: tuple, value: dict):
+      try:
+        panel = Panel.model_validate(value)
+      except ValidationError as e:
+        # The final script is validated as a whole; a bad panel here just isn't started early
+        print(f"Skipping streamed panel {path}: {e}")
+        return
+      on_panel(path[1], path[3], panel)
+    result: MangaChapterScript = await structured(
+      formatted_prompt,MangaChapterScript,req.model,use_cache=req.use_cache,prefix=prefix,
+      on_object=on_object if on_panel else None,object_path=('pages', None, 'panels', None)
+    )
     return result
   except Exception as e:
     print(e)
 
-async def process_panel(req: PanelRequest) -> str:
+async def process_panel(req: PanelRequest, characters: CharacterAssets | None = None, refresh: bool = False) -> str:
+  """Render one panel; `refresh` skips the cached render."""
   iprompt = image_prompt.format(**{
                 'camera_shot': req.scene_description.camera_shot,
                 'subject': req.scene_description.subject,
@@ -52,6 +120,9 @@ async def process_panel(req: PanelRequest) -> str:
                 'aspect_ratio': req.scene_description.aspect_ratio
   })
   path = f'{DATA_DIR}/{await clean_string(req.manga)}/{await clean_string(req.id)}.png'
-  images = [f'{DATA_DIR}/{await clean_string(req.manga)}/{await clean_string(ch)}.png' for ch in req.scene_description.character_ids]
-  imgpath = await generate_image(iprompt,path,images)
+  if characters:
+    images = await characters.wait_for(req.scene_description.character_ids)
+  else:
+    images = [output_path(f'{DATA_DIR}/{await clean_string(req.manga)}/{await clean_string(ch)}.png', req.encoding) for ch in req.scene_description.character_ids]
+  imgpath = await generate_image(iprompt,path,images,use_cache=req.use_cache,encoding=req.encoding,references=characters.references if characters else None,refresh=refresh)
   return imgpath
@@ -0,0 +1,41 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+T = TypeVar("T")
+
+class SharedTasks(Generic[K, T]):
+  """One task per key, shared by every caller that asks for that key.
+
+  The first caller starts the task and later ones await the same task. Each
+  caller awaits it through a shield, so a cancelled caller doesn't cancel it
+  for the others. With `keep`, a task that succeeded stays to answer later
+  callers, and one that failed or was cancelled is started again. Without it,
+  the task is forgotten as soon as it finishes.
+  """
+
+  def __init__(self, keep: bool = True):
+    self.keep = keep
+    self._tasks: dict[K, asyncio.Task[T]] = {}
+
+  def started(self, key: K) -> bool:
+    """Whether a call for `key` now would share a task instead of starting one."""
+    task = self._tasks.get(key)
+    return task is not None and not (task.done() and (task.cancelled() or task.exception()))
+
+  async def run(self, key: K, start: Callable[[], Awaitable[T]]) -> T:
+    """Result of the task for `key`, started with `start()` unless one is already shared."""
+    if not self.started(key):
+      task = asyncio.ensure_future(start())
+      self._tasks[key] = task
+      if not self.keep:
+        task.add_done_callback(lambda done: self._tasks.pop(key) if self._tasks.get(key) is done else None)
+    return await asyncio.shield(self._tasks[key])
+
+  def pop(self, key: K) -> asyncio.Task[T] | None:
+    return self._tasks.pop(key, None)
+
+  def clear(self):
+    for task in self._tasks.values():
+      task.cancel()
+    self._tasks.clear()
@@ -0,0 +1,9 @@
+from typing import Collection
+
+def percentile(values: Collection[float], q: float, digits: int | None = None) -> float | None:
+  """Nearest-rank `q` quantile (0-1) of `values`, rounded to `digits` if given; None if there are none."""
+  if not values:
+    return None
+  ordered = sorted(values)
+  value = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+  return value if digits is None else round(value, digits)
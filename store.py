@@ -0,0 +1,234 @@
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from models import Manga, MangaChapterScript, MangaResult
+from services import DATA_DIR
+from db import connect, transaction
+
+STATE_DB = Path(os.getenv("STATE_DB", f"{DATA_DIR}/state.db"))
+LEGACY_STATE_FILE = Path(DATA_DIR) / "nanobanana_state.json"
+# How long cached file sizes and existence are trusted before the files are checked again
+FILE_CHECK_TTL = float(os.getenv("FILE_CHECK_TTL", "300"))
+SORTS = {'created': 'created', 'title': 'title COLLATE NOCASE', 'panels': 'panels'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mangas (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  title TEXT NOT NULL,
+  created REAL NOT NULL,
+  chapters INTEGER NOT NULL,
+  panels INTEGER NOT NULL,
+  pdf TEXT,
+  manga TEXT NOT NULL,
+  pdf_bytes INTEGER,
+  image_bytes INTEGER,
+  missing_images INTEGER,
+  checked REAL,
+  job_id INTEGER UNIQUE
+);
+CREATE TABLE IF NOT EXISTS chapters (
+  manga_id INTEGER NOT NULL REFERENCES mangas (id) ON DELETE CASCADE,
+  idx INTEGER NOT NULL,
+  title TEXT NOT NULL,
+  script TEXT NOT NULL,
+  PRIMARY KEY (manga_id, idx)
+);
+CREATE TABLE IF NOT EXISTS panels (
+  manga_id INTEGER NOT NULL REFERENCES mangas (id) ON DELETE CASCADE,
+  position INTEGER NOT NULL,
+  chapter INTEGER,
+  page INTEGER,
+  panel INTEGER,
+  path TEXT NOT NULL,
+  PRIMARY KEY (manga_id, position)
+);
+CREATE INDEX IF NOT EXISTS panels_key ON panels (manga_id, chapter, page, panel);
+CREATE INDEX IF NOT EXISTS mangas_created ON mangas (created);
+CREATE INDEX IF NOT EXISTS mangas_title ON mangas (title COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS mangas_panels ON mangas (panels);
+CREATE TABLE IF NOT EXISTS session (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+"""
+
+def panel_key(path: str) -> tuple[int | None, int | None, int | None]:
+  """(chapter, page, panel) from a panel file named like '2_0_3.jpg'."""
+  parts = os.path.splitext(os.path.basename(path))[0].split("_")
+  if len(parts) == 3 and all(part.isdigit() for part in parts):
+    return tuple(int(part) for part in parts)
+  return (None, None, None)
+
+class StateStore:
+  """Manga history and UI state in SQLite.
+
+  Every manga is one row, with its chapter scripts and panels in their own
+  tables, so saving a generation or deleting one touches only its rows, in a
+  single transaction, whatever the size of the history. Models are stored as
+  JSON through Pydantic and read back with model_validate_json.
+  """
+
+  def __init__(self, path: Path = STATE_DB):
+    self.path = Path(path)
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    with connect(self.path) as db:
+      db.executescript(SCHEMA)
+
+  def _insert_manga(self, db: sqlite3.Connection, manga: Manga, scripts: list[MangaChapterScript], images: list[str], pdf: str | None, created: float, job_id: int | None = None) -> int:
+    manga_id = db.execute(
+      "INSERT INTO mangas (title, created, chapters, panels, pdf, manga, job_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+      (manga.title, created, len(manga.chapters), len(images), pdf, manga.model_dump_json(), job_id),
+    ).lastrowid
+    db.executemany(
+      "INSERT INTO chapters (manga_id, idx, title, script) VALUES (?, ?, ?, ?)",
+      [(manga_id, idx, script.chapter_title, script.model_dump_json()) for idx, script in enumerate(scripts)],
+    )
+    db.executemany(
+      "INSERT INTO panels (manga_id, position, chapter, page, panel, path) VALUES (?, ?, ?, ?, ?, ?)",
+      [(manga_id, position, *panel_key(path), path) for position, path in enumerate(images)],
+    )
+    return manga_id
+
+  def add_manga(self, result: MangaResult, created: float | None = None, job_id: int | None = None) -> int:
+    """Save a finished manga. A manga from a job is saved once per job id; saving it again returns the existing row."""
+    with transaction(self.path) as db:
+      if job_id is not None:
+        row = db.execute("SELECT id FROM mangas WHERE job_id = ?", (job_id,)).fetchone()
+        if row:
+          return row["id"]
+      return self._insert_manga(db, result.manga, result.scripts, result.images, result.pdf, created or time.time(), job_id)
+
+  def delete_manga(self, manga_id: int):
+    with transaction(self.path) as db:
+      db.execute("DELETE FROM mangas WHERE id = ?", (manga_id,))
+
+  def images(self, manga_id: int) -> list[str]:
+    with connect(self.path) as db:
+      return [row["path"] for row in db.execute("SELECT path FROM panels WHERE manga_id = ? ORDER BY position", (manga_id,))]
+
+  def scripts(self, manga_id: int) -> list[MangaChapterScript]:
+    with connect(self.path) as db:
+      rows = db.execute("SELECT script FROM chapters WHERE manga_id = ? ORDER BY idx", (manga_id,)).fetchall()
+    return [MangaChapterScript.model_validate_json(row["script"]) for row in rows]
+
+  @staticmethod
+  def _entry(row: sqlite3.Row, images: list[str] | None = None) -> dict:
+    return {
+      'id': row["id"],
+      'title': row["title"],
+      'chapters': row["chapters"],
+      'panels': row["panels"],
+      'images': images,
+      'pdf': row["pdf"] if row["pdf_bytes"] is not None else None,
+      'pdf_bytes': row["pdf_bytes"],
+      'image_bytes': row["image_bytes"],
+      'missing_images': row["missing_images"],
+      'manga_data': Manga.model_validate_json(row["manga"]),
+      'timestamp': row["created"],
+    }
+
+  def _check_files(self, db: sqlite3.Connection, rows: list[sqlite3.Row]) -> list[sqlite3.Row]:
+    """Refresh cached file sizes of the rows whose check is older than FILE_CHECK_TTL."""
+    now = time.time()
+    stale = [row for row in rows if row["checked"] is None or now - row["checked"] > FILE_CHECK_TTL]
+    if not stale:
+      return rows
+    updates = []
+    for row in stale:
+      manga_id = row["id"]
+      pdf_bytes = os.path.getsize(row["pdf"]) if row["pdf"] and os.path.exists(row["pdf"]) else None
+      image_bytes, missing = 0, 0
+      for panel in db.execute("SELECT path FROM panels WHERE manga_id = ?", (manga_id,)):
+        try:
+          image_bytes += os.path.getsize(panel["path"])
+        except OSError:
+          missing += 1
+      updates.append((pdf_bytes, image_bytes, missing, now, manga_id))
+    db.executemany("UPDATE mangas SET pdf_bytes = ?, image_bytes = ?, missing_images = ?, checked = ? WHERE id = ?", updates)
+    placeholders = ", ".join("?" * len(rows))
+    refreshed = {row["id"]: row for row in db.execute(f"SELECT * FROM mangas WHERE id IN ({placeholders})", [row["id"] for row in rows])}
+    return [refreshed[row["id"]] for row in rows]
+
+  def page(self, search: str = "", sort: str = 'created', descending: bool = True, limit: int = 10, offset: int = 0) -> tuple[list[dict], int]:
+    """One page of gallery entries and the total number matching `search`.
+
+    Entries carry cached file sizes instead of their image lists; only the
+    rows on the page are read, and their files are re-checked at most once
+    per FILE_CHECK_TTL.
+    """
+    where, params = "", []
+    if search:
+      where = "WHERE title LIKE ? ESCAPE '\\'"
+      params.append("%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    order = f"{SORTS[sort]} {'DESC' if descending else 'ASC'}, id {'DESC' if descending else 'ASC'}"
+    with connect(self.path) as db:
+      total = db.execute(f"SELECT COUNT(*) FROM mangas {where}", params).fetchone()[0]
+      rows = db.execute(f"SELECT * FROM mangas {where} ORDER BY {order} LIMIT ? OFFSET ?", (*params, limit, offset)).fetchall()
+      rows = self._check_files(db, rows)
+    return [self._entry(row) for row in rows], total
+
+  def entry(self, manga_id: int) -> dict | None:
+    """A gallery entry with its images, for the carousel."""
+    with connect(self.path) as db:
+      row = db.execute("SELECT * FROM mangas WHERE id = ?", (manga_id,)).fetchone()
+      if row is None:
+        return None
+      row = self._check_files(db, [row])[0]
+    return self._entry(row, self.images(manga_id))
+
+  def totals(self) -> tuple[int, int]:
+    """Number of mangas and panels in the history."""
+    with connect(self.path) as db:
+      row = db.execute("SELECT COUNT(*), COALESCE(SUM(panels), 0) FROM mangas").fetchone()
+    return row[0], row[1]
+
+  def save_session(self, **values):
+    """Upsert UI state values (JSON-serialisable)."""
+    with transaction(self.path) as db:
+      db.executemany(
+        "INSERT INTO session (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+        [(key, json.dumps(value)) for key, value in values.items()],
+      )
+
+  def load_session(self) -> dict:
+    with connect(self.path) as db:
+      return {row["key"]: json.loads(row["value"]) for row in db.execute("SELECT key, value FROM session")}
+
+  def session_value(self, key: str, default=None):
+    with connect(self.path) as db:
+      row = db.execute("SELECT value FROM session WHERE key = ?", (key,)).fetchone()
+    return json.loads(row["value"]) if row else default
+
+  def clear(self):
+    with transaction(self.path) as db:
+      db.execute("DELETE FROM mangas")
+      db.execute("DELETE FROM session")
+
+  def migrate_legacy(self, path: Path = LEGACY_STATE_FILE) -> int:
+    """Import a nanobanana_state.json from before the store existed, then
+    rename it so it is only imported once. Returns the number of mangas imported."""
+    path = Path(path)
+    if not path.exists():
+      return 0
+    with open(path, "r", encoding="utf-8") as f:
+      saved = json.load(f)
+    imported = 0
+    with transaction(self.path) as db:
+      for entry in saved.get('manga_history', []):
+        if not entry.get('manga_data'):
+          print(f"Skipping legacy manga without data: {entry.get('title')}")
+          continue
+        manga = Manga.model_validate(entry['manga_data'])
+        self._insert_manga(db, manga, [], entry.get('images', []), entry.get('pdf'), entry.get('timestamp') or time.time())
+        imported += 1
+      session = {key: saved[key] for key in ('generated_images', 'generated_pdf', 'carousel_panel_index') if key in saved}
+      db.executemany(
+        "INSERT INTO session (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+        [(key, json.dumps(value)) for key, value in session.items()],
+      )
+    os.replace(path, path.with_suffix(".json.migrated"))
+    return imported
+
+state_store = StateStore()
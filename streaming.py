@@ -0,0 +1,69 @@
+import json
+
+Path = tuple[str | int, ...]
+
+class JsonObjectStream:
+  """Incremental scanner for a JSON document that arrives in chunks.
+
+  `feed` takes the next chunk and returns (path, value) for every object that
+  became complete in it and whose path matches `pattern`, a path with None
+  for "any index", e.g. ('pages', None, 'panels', None). Only matching
+  objects are decoded; the rest of the document is scanned for structure
+  and left to the final parse.
+  """
+
+  def __init__(self, pattern: tuple[str | None, ...]):
+    self.pattern = pattern
+    self.text = ""
+    self._pos = 0
+    # One frame per open container: [bracket, key or index of the current child, start offset]
+    self._stack: list[list] = []
+    self._in_string = False
+    self._escape = False
+    self._string_start = 0
+    self._expect_key = False
+    self._key: str | None = None
+
+  def _matches(self, path: Path) -> bool:
+    return len(path) == len(self.pattern) and all(want is None or want == got for want, got in zip(self.pattern, path))
+
+  def feed(self, chunk: str) -> list[tuple[Path, dict]]:
+    self.text += chunk
+    found = []
+    text, stack = self.text, self._stack
+    for pos in range(self._pos, len(text)):
+      char = text[pos]
+      if self._in_string:
+        if self._escape:
+          self._escape = False
+        elif char == "\\":
+          self._escape = True
+        elif char == '"':
+          self._in_string = False
+          if self._expect_key:
+            self._key = json.loads(text[self._string_start:pos + 1])
+        continue
+      if char == '"':
+        self._in_string = True
+        self._string_start = pos
+      elif char in "{[":
+        stack.append([char, None if char == "{" else 0, pos])
+        self._expect_key = char == "{"
+      elif char in "}]":
+        bracket, _, start = stack.pop()
+        if bracket == "{":
+          # The frame is gone, so the path is now that of its parent plus the parent's current child
+          path = tuple(frame[1] for frame in stack)
+          if self._matches(path):
+            found.append((path, json.loads(text[start:pos + 1])))
+        self._expect_key = False
+      elif char == ":":
+        stack[-1][1] = self._key
+        self._expect_key = False
+      elif char == ",":
+        if stack[-1][0] == "[":
+          stack[-1][1] += 1
+        else:
+          self._expect_key = True
+    self._pos = len(text)
+    return found
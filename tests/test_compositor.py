@@ -0,0 +1,66 @@
+import pytest
+from PIL import Image
+from compositor import PageCompositor
+from models import PageLayout, PanelPlacement
+
+def layout(rows: int, cols: int, *placements: tuple[int, int, int, int, int]) -> PageLayout:
+  return PageLayout(grid_rows=rows, grid_columns=cols, placements=[
+    PanelPlacement(panel_number=number, grid_row=row, grid_col=col, row_span=row_span, col_span=col_span)
+    for number, row, col, row_span, col_span in placements
+  ])
+
+@pytest.fixture
+def compositor() -> PageCompositor:
+  # 2x2 cells of 100x100 with a 10px gutter inside a 10px margin
+  return PageCompositor(size=(230, 230), margin=10, gutter=10, border=0, workers=1)
+
+TOP_LEFT, TOP_RIGHT = (10, 10, 110, 110), (120, 10, 220, 110)
+BOTTOM_LEFT, BOTTOM_RIGHT = (10, 120, 110, 220), (120, 120, 220, 220)
+TOP, BOTTOM = (10, 10, 220, 110), (10, 120, 220, 220)
+LEFT = (10, 10, 110, 220)
+
+@pytest.mark.parametrize("base", [0, 1])
+def test_grid(compositor, base):
+  boxes = compositor.cells(layout(2, 2,
+    (1, base, base, 1, 1), (2, base, base + 1, 1, 1),
+    (3, base + 1, base, 1, 1), (4, base + 1, base + 1, 1, 1),
+  ), [1, 2, 3, 4])
+  assert boxes == {1: TOP_LEFT, 2: TOP_RIGHT, 3: BOTTOM_LEFT, 4: BOTTOM_RIGHT}
+
+@pytest.mark.parametrize("base", [0, 1])
+def test_spans(compositor, base):
+  boxes = compositor.cells(layout(2, 2, (1, base, base, 1, 2), (2, base + 1, base, 1, 1), (3, base + 1, base + 1, 1, 1)), [1, 2, 3])
+  assert boxes == {1: TOP, 2: BOTTOM_LEFT, 3: BOTTOM_RIGHT}
+
+@pytest.mark.parametrize("base", [0, 1])
+def test_vertical_span(compositor, base):
+  boxes = compositor.cells(layout(2, 2, (1, base, base, 2, 1), (2, base, base + 1, 1, 1), (3, base + 1, base + 1, 1, 1)), [1, 2, 3])
+  assert boxes == {1: LEFT, 2: TOP_RIGHT, 3: BOTTOM_RIGHT}
+
+def test_placements_are_clamped_to_the_grid(compositor):
+  boxes = compositor.cells(layout(2, 2, (1, 0, 0, 1, 5), (2, 9, 9, 3, 3)), [1, 2])
+  assert boxes == {1: TOP, 2: BOTTOM_RIGHT}
+
+def test_unplaced_panels_fill_free_cells(compositor):
+  boxes = compositor.cells(layout(2, 2, (2, 1, 1, 1, 1)), [1, 2, 3])
+  assert boxes == {2: TOP_LEFT, 1: TOP_RIGHT, 3: BOTTOM_LEFT}
+
+def test_overflow_adds_full_width_rows(compositor):
+  boxes = compositor.cells(layout(1, 2, (1, 0, 0, 1, 1), (2, 0, 1, 1, 1)), [1, 2, 3])
+  assert boxes == {1: TOP_LEFT, 2: TOP_RIGHT, 3: BOTTOM}
+
+def test_placements_of_other_panels_are_ignored(compositor):
+  # Panel 9 isn't on the page, so its 0-based coordinates don't make the page 0-based
+  boxes = compositor.cells(layout(2, 2, (9, 0, 0, 1, 1), (1, 1, 1, 1, 1), (2, 2, 2, 1, 1)), [1, 2])
+  assert boxes == {1: TOP_LEFT, 2: BOTTOM_RIGHT}
+
+def test_compose_places_panels(compositor, tmp_path):
+  red, blue = tmp_path / "red.png", tmp_path / "blue.png"
+  Image.new("RGB", (50, 80), "red").save(red)
+  Image.new("RGB", (300, 100), "blue").save(blue)
+  out = compositor.compose(layout(2, 2, (1, 1, 1, 1, 2), (2, 2, 2, 1, 1)), [(1, str(red)), (2, str(blue))], str(tmp_path / "page.png"))
+  with Image.open(out) as page:
+    assert page.size == (230, 230)
+    assert page.getpixel((60, 60)) == (255, 0, 0)
+    assert page.getpixel((170, 170)) == (0, 0, 255)
+    assert page.getpixel((60, 170)) == (255, 255, 255)
@@ -0,0 +1,65 @@
+import pikepdf
+import pytest
+from PIL import Image
+from pdf import PdfStreamWriter
+
+def make_image(path, size: tuple[int, int], mode: str = "RGB", fmt: str | None = None) -> str:
+  image = Image.new(mode, size, "white" if mode != "L" else 255)
+  image.paste("red" if mode != "L" else 0, (0, 0, size[0] // 2, size[1] // 2))
+  image.save(path, format=fmt)
+  return str(path)
+
+def read_pages(path) -> list[tuple[float, float, int, int]]:
+  """(page width, page height, image width, image height) of every page, as a PDF parser sees them."""
+  with pikepdf.open(path) as pdf:
+    pages = []
+    for page in pdf.pages:
+      image = pikepdf.PdfImage(page.images["/Im0"])
+      box = [float(value) for value in page.mediabox]
+      pages.append((round(box[2], 2), round(box[3], 2), image.width, image.height))
+      # Decoding checks the stream and its filter, not just the dictionary
+      image.as_pil_image().load()
+    return pages
+
+def test_empty_document_is_readable(tmp_path):
+  out = tmp_path / "empty.pdf"
+  with PdfStreamWriter(str(out)):
+    pass
+  with pikepdf.open(out) as pdf:
+    assert len(pdf.pages) == 0
+
+def test_file_is_complete_after_every_update(tmp_path):
+  out = tmp_path / "manga.pdf"
+  sizes = [(96, 192), (192, 96), (48, 48)]
+  paths = [make_image(tmp_path / f"{i}.png", size) for i, size in enumerate(sizes)]
+  with PdfStreamWriter(str(out), dpi=96) as writer:
+    for count, path in enumerate(paths, 1):
+      assert writer.add_images([path]) == count
+      # Read back while the writer still has the file open, as the app serves it mid-run
+      assert [page[2:] for page in read_pages(out)] == sizes[:count]
+  assert read_pages(out)[0][:2] == (72.0, 144.0)
+
+def test_several_pages_in_one_update(tmp_path):
+  out = tmp_path / "manga.pdf"
+  paths = [make_image(tmp_path / f"{i}.png", (64, 32 + i)) for i in range(4)]
+  with PdfStreamWriter(str(out)) as writer:
+    writer.add_images(paths[:1])
+    writer.add_images(paths[1:] + [str(tmp_path / "missing.png")])
+  assert [page[3] for page in read_pages(out)] == [32, 33, 34, 35]
+  with pikepdf.open(out) as pdf:
+    # One xref section per update, chained through /Prev
+    assert pdf.trailer.get("/Prev") is not None
+
+@pytest.mark.parametrize("mode,fmt,suffix", [
+  ("RGB", "JPEG", "jpg"),
+  ("L", "JPEG", "jpg"),
+  ("RGBA", "PNG", "png"),
+  ("L", "PNG", "png"),
+  ("RGB", "WEBP", "webp"),
+])
+def test_image_formats(tmp_path, mode, fmt, suffix):
+  out = tmp_path / "manga.pdf"
+  path = make_image(tmp_path / f"panel.{suffix}", (80, 60), mode, fmt)
+  with PdfStreamWriter(str(out)) as writer:
+    writer.add_images([path])
+  assert [page[2:] for page in read_pages(out)] == [(80, 60)]
@@ -0,0 +1,76 @@
+import asyncio
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+from quality import QUALITY_DUPLICATE_DISTANCE, QualityGate, dhash, inspect, parse_aspect_ratio
+
+def scene(seed: int, size: tuple[int, int] = (320, 240)) -> Image.Image:
+  """A random smooth greyscale picture, different for every seed."""
+  noise = np.random.default_rng(seed).integers(0, 256, (6, 8), dtype=np.uint8)
+  return Image.fromarray(noise, "L").resize(size, Image.Resampling.BICUBIC)
+
+def distance(a: Image.Image, b: Image.Image) -> int:
+  return (dhash(a) ^ dhash(b)).bit_count()
+
+def save(image: Image.Image, path) -> str:
+  image.save(path)
+  return str(path)
+
+def test_dhash_is_64_bits():
+  assert 0 <= dhash(scene(0)) < 2 ** 64
+  assert dhash(scene(0)) == dhash(scene(0))
+
+def test_near_copies_are_close():
+  image = scene(1)
+  assert distance(image, image.resize((640, 480))) <= QUALITY_DUPLICATE_DISTANCE
+  brighter = Image.eval(image, lambda value: min(255, value + 20))
+  assert distance(image, brighter) <= QUALITY_DUPLICATE_DISTANCE
+  marked = image.copy()
+  ImageDraw.Draw(marked).rectangle((0, 0, 10, 10), fill=0)
+  assert distance(image, marked) <= QUALITY_DUPLICATE_DISTANCE
+
+def test_different_scenes_are_far():
+  assert min(distance(scene(0), scene(seed)) for seed in range(1, 20)) > QUALITY_DUPLICATE_DISTANCE
+
+def test_mirrored_scene_is_not_a_duplicate():
+  image = scene(2)
+  assert distance(image, image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)) > QUALITY_DUPLICATE_DISTANCE
+
+@pytest.mark.parametrize("text,ratio", [("16:9", 16 / 9), ("4/3", 4 / 3), ("2x3", 2 / 3), ("1.5", 1.5), ("wide 21:9 shot", 21 / 9), ("", None), ("wide", None), ("0:1", None)])
+def test_parse_aspect_ratio(text, ratio):
+  assert parse_aspect_ratio(text) == (pytest.approx(ratio) if ratio else None)
+
+def test_duplicates_only_within_a_page_of_each_other(tmp_path):
+  gate = QualityGate()
+  check = lambda key, path, ratio: asyncio.run(gate.check(key, path, ratio))
+  first = save(scene(3), tmp_path / "a.png")
+  copy = save(scene(3).resize((400, 300)), tmp_path / "b.png")
+  assert check((0, 0, 0), first, "4:3") == []
+  assert [issue.kind for issue in check((0, 1, 0), copy, "4:3")] == ['duplicate']
+  # Two pages away, or in another chapter, a repeat is fine
+  assert check((0, 3, 0), first, "4:3") == []
+  assert check((1, 0, 0), first, "4:3") == []
+
+def test_blank_and_aspect(tmp_path):
+  gate = QualityGate()
+  check = lambda key, path, ratio: asyncio.run(gate.check(key, path, ratio))
+  blank = save(Image.new("L", (320, 240), 128), tmp_path / "blank.png")
+  issues = check((0, 0, 0), blank, "16:9")
+  assert [issue.kind for issue in issues] == ['blank', 'aspect']
+  assert gate.fixable(issues)
+  assert not gate.fixable([issue for issue in issues if issue.kind == 'aspect'])
+  # Blank panels aren't kept to be compared, so a second one is flagged as blank only
+  assert [issue.kind for issue in check((0, 0, 1), blank, "4:3")] == ['blank']
+
+def test_retries_and_budget():
+  gate = QualityGate(retries=2, budget=3)
+  assert gate.allow(0) and gate.allow(1)
+  assert not gate.allow(2)
+  assert gate.allow(0)
+  assert not gate.allow(0)
+  assert gate.stats()["rerendered"] == 3
+
+def test_inspect(tmp_path):
+  inspection = inspect(save(scene(4, (800, 600)), tmp_path / "scene.jpg"))
+  assert (inspection.width, inspection.height) == (800, 600)
+  assert inspection.contrast > 4
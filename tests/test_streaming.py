@@ -0,0 +1,63 @@
+import json
+import pytest
+from streaming import JsonObjectStream
+
+PATTERN = ('pages', None, 'panels', None)
+
+SCRIPT = {
+  "chapter_title": "A \"quoted\" {title} with [brackets]",
+  "pages": [
+    {
+      "page_number": 1,
+      "panels": [
+        {"panel_number": 1, "dialogue": "She said: \"wait, {no} [stop]\"\\", "tags": ["a", "b"]},
+        {"panel_number": 2, "dialogue": "Line one\nline two\té☃", "nested": {"panels": [{"x": 1}]}},
+      ],
+    },
+    {"page_number": 2, "panels": []},
+    {"page_number": 3, "panels": [{"panel_number": 1, "dialogue": "\\\"}]"}]},
+  ],
+}
+
+def expected() -> list[tuple[tuple, dict]]:
+  return [
+    (('pages', page_idx, 'panels', panel_idx), panel)
+    for page_idx, page in enumerate(SCRIPT["pages"])
+    for panel_idx, panel in enumerate(page["panels"])
+  ]
+
+def stream(chunks: list[str]) -> list[tuple[tuple, dict]]:
+  parser = JsonObjectStream(PATTERN)
+  found = []
+  for chunk in chunks:
+    found += parser.feed(chunk)
+  return found
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_whole_document(indent):
+  assert stream([json.dumps(SCRIPT, indent=indent)]) == expected()
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_every_chunk_size(size):
+  text = json.dumps(SCRIPT)
+  assert stream([text[i:i + size] for i in range(0, len(text), size)]) == expected()
+
+def test_split_at_every_offset():
+  # Covers splits inside keys, inside strings and between a backslash and the character it escapes
+  text = json.dumps(SCRIPT, ensure_ascii=False)
+  for cut in range(1, len(text)):
+    assert stream([text[:cut], text[cut:]]) == expected(), cut
+
+def test_split_between_backslash_and_quote():
+  text = json.dumps({"pages": [{"panels": [{"text": 'a\\"}'}]}]})
+  cut = text.index('\\"') + 1
+  assert stream([text[:cut], text[cut:]]) == [(('pages', 0, 'panels', 0), {"text": 'a\\"}'})]
+
+def test_object_reported_once_when_it_closes():
+  parser = JsonObjectStream(PATTERN)
+  assert parser.feed('{"pages": [{"panels": [{"n": 1}, {"n": "2') == [(('pages', 0, 'panels', 0), {"n": 1})]
+  assert parser.feed('"}') == [(('pages', 0, 'panels', 1), {"n": "2"})]
+  assert parser.feed(']}]}') == []
+
+def test_objects_off_the_pattern_are_ignored():
+  assert stream([json.dumps({"panels": [{"n": 1}], "pages": [{"other": [{"n": 2}]}]})]) == []
@@ -0,0 +1,42 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from cache import CACHE_DIR, content_key
+from atomic import atomic_path
+
+THUMB_DIR = CACHE_DIR / "thumbs"
+# Longest side in pixels of each derivative
+SIZES = {'thumb': 384, 'preview': 1080}
+THUMB_QUALITY = 82
+
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbs")
+
+def thumbnail(path: str, size: str = 'thumb') -> str:
+  """Path of a downscaled JPEG of `path`, generated on first use.
+
+  Derivatives are keyed by source path, mtime and size, so a regenerated panel
+  gets a fresh one. If the source is missing, `path` itself is returned.
+  """
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    return path
+  key = content_key(os.path.abspath(path), str(stat.st_mtime_ns), size)
+  out = THUMB_DIR / key[:2] / f"{key}.jpg"
+  if out.exists():
+    return str(out)
+  limit = SIZES[size]
+  out.parent.mkdir(parents=True, exist_ok=True)
+  with Image.open(path) as image:
+    image.draft("RGB", (limit, limit))
+    image = image.convert("RGB")
+    image.thumbnail((limit, limit), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    # The prefetch pool and the script thread can generate the same derivative at once
+    with atomic_path(out) as tmp:
+      image.save(tmp, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+  return str(out)
+
+def prefetch(paths: list[str], size: str = 'preview'):
+  """Generate derivatives in the background so they are ready when shown."""
+  for path in paths:
+    _prefetch_pool.submit(thumbnail, path, size)
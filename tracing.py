@@ -0,0 +1,317 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from config import env_flag
+from stats import percentile
+
+TRACE_ENABLED = env_flag("TRACE_ENABLED", True)
+TRACE_FILE = Path(os.getenv("TRACE_FILE", "nanobanana_data/traces.jsonl"))
+# The trace file is rotated to traces.jsonl.1 past this size
+TRACE_MAX_MB = float(os.getenv("TRACE_MAX_MB", "50"))
+# Port of the Prometheus /metrics endpoint served by workers and batch runs; 0 turns it off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+FLUSH_EVERY = 100
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf"))
+TOKEN_FIELDS = {'prompt': 'prompt_token_count', 'output': 'candidates_token_count', 'cached': 'cached_content_token_count', 'total': 'total_token_count'}
+
+class Span:
+  """One timed step of a manga run.
+
+  Besides wall time a span carries the time spent queued (rate limiter,
+  panel slots), retries, bytes sent and received and token usage. Retries,
+  bytes and tokens of a finished span are added to its parent, so a panel
+  span totals the model calls made for it.
+  """
+
+  def __init__(self, name: str, parent: "Span | None" = None, **attrs):
+    self.id = uuid.uuid4().hex[:16]
+    self.parent = parent
+    self.trace = parent.trace if parent else self.id
+    self.name = name
+    self.attrs = attrs
+    self.start = time.time()
+    self._started = time.monotonic()
+    self.duration: float | None = None
+    self.queue_wait = 0.0
+    self.retries = 0
+    self.request_bytes = 0
+    self.response_bytes = 0
+    self.tokens = dict.fromkeys(TOKEN_FIELDS, 0)
+    self.status = 'ok'
+    self.error: str | None = None
+
+  def set(self, **attrs):
+    self.attrs.update(attrs)
+
+  def record_usage(self, usage):
+    """Add a response's usage_metadata."""
+    if usage is None:
+      return
+    for key, field in TOKEN_FIELDS.items():
+      self.tokens[key] += getattr(usage, field, None) or 0
+
+  def _finish(self):
+    self.duration = time.monotonic() - self._started
+    if self.parent and self.parent.duration is None:
+      self.parent.retries += self.retries
+      self.parent.request_bytes += self.request_bytes
+      self.parent.response_bytes += self.response_bytes
+      for key, count in self.tokens.items():
+        self.parent.tokens[key] += count
+
+  def to_dict(self) -> dict:
+    return {
+      'trace': self.trace,
+      'id': self.id,
+      'parent': self.parent.id if self.parent else None,
+      'name': self.name,
+      'start': self.start,
+      'duration': self.duration,
+      'queue_wait': round(self.queue_wait, 6),
+      'retries': self.retries,
+      'request_bytes': self.request_bytes,
+      'response_bytes': self.response_bytes,
+      'tokens': self.tokens,
+      'status': self.status,
+      'error': self.error,
+      'pid': os.getpid(),
+      'attrs': self.attrs,
+    }
+
+_current: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+def current_span() -> Span | None:
+  """The innermost open span of this task. Tasks inherit it from the code that created them."""
+  return _current.get()
+
+class Metrics:
+  """Prometheus counters and histograms over finished spans."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.buckets: dict[tuple, list[int]] = defaultdict(lambda: [0] * len(BUCKETS))
+    self.sums: dict[tuple, float] = defaultdict(float)
+    self.counts: dict[tuple, int] = defaultdict(int)
+    self.queue: dict[str, float] = defaultdict(float)
+    self.retries: dict[str, int] = defaultdict(int)
+    self.bytes: dict[tuple, int] = defaultdict(int)
+    self.tokens: dict[tuple, int] = defaultdict(int)
+    self.hedges: dict[tuple, int] = defaultdict(int)
+
+  def observe(self, span: dict):
+    name, duration = span['name'], span['duration'] or 0.0
+    labels = (name, span['status'])
+    with self._lock:
+      buckets = self.buckets[labels]
+      for i, bound in enumerate(BUCKETS):
+        if duration <= bound:
+          buckets[i] += 1
+      self.sums[labels] += duration
+      self.counts[labels] += 1
+      self.queue[name] += span['queue_wait']
+      # Children roll up into their parents, so count only the model calls to avoid double counting
+      if name.startswith('model.') or name == 'upload':
+        self.retries[name] += span['retries']
+        self.bytes[(name, 'request')] += span['request_bytes']
+        self.bytes[(name, 'response')] += span['response_bytes']
+        for kind, count in span['tokens'].items():
+          self.tokens[(name, kind)] += count
+        if span['attrs'].get('hedged'):
+          self.hedges[(name, str(span['attrs'].get('hedge_won', False)).lower())] += 1
+
+  def render(self) -> str:
+    lines = [
+      "# HELP nanobanana_span_seconds Wall time of pipeline steps.",
+      "# TYPE nanobanana_span_seconds histogram",
+    ]
+    with self._lock:
+      for (name, status), buckets in sorted(self.buckets.items()):
+        labels = f'name="{name}",status="{status}"'
+        for bound, count in zip(BUCKETS, buckets):
+          le = "+Inf" if bound == float("inf") else f"{bound:g}"
+          lines.append(f'nanobanana_span_seconds_bucket{{{labels},le="{le}"}} {count}')
+        lines.append(f"nanobanana_span_seconds_sum{{{labels}}} {self.sums[(name, status)]:.6f}")
+        lines.append(f"nanobanana_span_seconds_count{{{labels}}} {self.counts[(name, status)]}")
+      lines += ["# HELP nanobanana_queue_seconds_total Time spent waiting for rate limits and panel slots.", "# TYPE nanobanana_queue_seconds_total counter"]
+      lines += [f'nanobanana_queue_seconds_total{{name="{name}"}} {seconds:.6f}' for name, seconds in sorted(self.queue.items())]
+      lines += ["# HELP nanobanana_retries_total Retried API calls.", "# TYPE nanobanana_retries_total counter"]
+      lines += [f'nanobanana_retries_total{{name="{name}"}} {count}' for name, count in sorted(self.retries.items())]
+      lines += ["# HELP nanobanana_bytes_total Bytes sent to and received from the API.", "# TYPE nanobanana_bytes_total counter"]
+      lines += [f'nanobanana_bytes_total{{name="{name}",direction="{direction}"}} {count}' for (name, direction), count in sorted(self.bytes.items())]
+      lines += ["# HELP nanobanana_tokens_total Tokens reported in usage_metadata.", "# TYPE nanobanana_tokens_total counter"]
+      lines += [f'nanobanana_tokens_total{{name="{name}",kind="{kind}"}} {count}' for (name, kind), count in sorted(self.tokens.items())]
+      lines += ["# HELP nanobanana_hedges_total Duplicate requests sent for stragglers, by whether the duplicate returned first.", "# TYPE nanobanana_hedges_total counter"]
+      lines += [f'nanobanana_hedges_total{{name="{name}",won="{won}"}} {count}' for (name, won), count in sorted(self.hedges.items())]
+    return "\n".join(lines) + "\n"
+
+class Tracer:
+  """Records a span tree per manga run and appends finished spans to a JSONL file.
+
+  Spans are opened with `span()` as a context manager; the current span
+  lives in a ContextVar, so spans opened in tasks created inside another
+  span become its children. Finished spans are buffered and written when
+  their run's root span ends, so worker processes and the UI can share one
+  file.
+  """
+
+  def __init__(self, path: Path = TRACE_FILE, enabled: bool = TRACE_ENABLED):
+    self.path = Path(path)
+    self.enabled = enabled
+    self.metrics = Metrics()
+    self._buffer: list[dict] = []
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def span(self, name: str, **attrs):
+    span = Span(name, _current.get(), **attrs)
+    token = _current.set(span)
+    try:
+      yield span
+    except BaseException as e:
+      span.status = 'cancelled' if isinstance(e, (asyncio.CancelledError, KeyboardInterrupt)) else 'error'
+      span.error = f"{type(e).__name__}: {e}"
+      raise
+    finally:
+      _current.reset(token)
+      span._finish()
+      self._record(span)
+
+  def _record(self, span: Span):
+    if not self.enabled:
+      return
+    data = span.to_dict()
+    self.metrics.observe(data)
+    with self._lock:
+      self._buffer.append(data)
+      if span.parent is None or len(self._buffer) >= FLUSH_EVERY:
+        self._flush()
+
+  def _flush(self):
+    lines, self._buffer = self._buffer, []
+    if not lines:
+      return
+    try:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      if self.path.exists() and self.path.stat().st_size > TRACE_MAX_MB * 1024 * 1024:
+        os.replace(self.path, self.path.with_suffix(".jsonl.1"))
+      # One append per batch keeps lines from different processes whole
+      with open(self.path, "a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(line, default=str) + "\n" for line in lines))
+    except OSError as e:
+      print(f"Could not write traces: {e}")
+
+  def flush(self):
+    with self._lock:
+      self._flush()
+
+def load_traces(path: Path = TRACE_FILE, limit: int = 20, max_bytes: int = 16 * 1024 * 1024) -> list[list[dict]]:
+  """The spans of the `limit` most recent finished runs, newest first, read from the end of the trace file."""
+  path = Path(path)
+  if not path.exists():
+    return []
+  with open(path, "rb") as f:
+    f.seek(max(0, path.stat().st_size - max_bytes))
+    data = f.read().decode("utf-8", errors="replace").splitlines()
+  traces: dict[str, list[dict]] = defaultdict(list)
+  roots: dict[str, dict] = {}
+  for line in data:
+    try:
+      span = json.loads(line)
+    except ValueError:
+      # The first line may be cut in half by the seek
+      continue
+    traces[span['trace']].append(span)
+    if span['parent'] is None:
+      roots[span['trace']] = span
+  recent = sorted(roots.values(), key=lambda root: root['start'], reverse=True)[:limit]
+  return [traces[root['trace']] for root in recent]
+
+def stage_stats(traces: list[list[dict]]) -> list[dict]:
+  """Per span name: count, p50/p95/max wall time, mean queue wait, retries and tokens. Slowest p95 first."""
+  spans: dict[str, list[dict]] = defaultdict(list)
+  for trace in traces:
+    for span in trace:
+      if span['duration'] is not None:
+        spans[span['name']].append(span)
+  stats = []
+  for name, group in spans.items():
+    durations = [span['duration'] for span in group]
+    stats.append({
+      'stage': name,
+      'count': len(group),
+      'p50 (s)': percentile(durations, 0.5, 3),
+      'p95 (s)': percentile(durations, 0.95, 3),
+      'max (s)': round(max(durations), 3),
+      'mean queue (s)': round(sum(span['queue_wait'] for span in group) / len(group), 3),
+      'retries': sum(span['retries'] for span in group),
+      'errors': sum(span['status'] == 'error' for span in group),
+      'tokens': sum(span['tokens']['total'] for span in group),
+    })
+  return sorted(stats, key=lambda row: row['p95 (s)'], reverse=True)
+
+def follow(path: Path, metrics: Metrics, poll: float = 1.0):
+  """Feed spans appended to `path` by other processes into `metrics`, forever."""
+  position = Path(path).stat().st_size if Path(path).exists() else 0
+  while True:
+    try:
+      size = Path(path).stat().st_size
+    except FileNotFoundError:
+      size = 0
+    if size < position:
+      # Rotated
+      position = 0
+    if size > position:
+      with open(path, "rb") as f:
+        f.seek(position)
+        chunk = f.read(size - position)
+      # Leave a half-written last line for the next round
+      complete = chunk[:chunk.rfind(b"\n") + 1]
+      position += len(complete)
+      for line in complete.decode("utf-8", errors="replace").splitlines():
+        try:
+          metrics.observe(json.loads(line))
+        except (ValueError, KeyError):
+          pass
+    time.sleep(poll)
+
+def serve_metrics(port: int = METRICS_PORT, metrics: Metrics | None = None, trace_file: Path | None = None) -> ThreadingHTTPServer | None:
+  """Serve Prometheus text on http://0.0.0.0:`port`/metrics from a daemon thread.
+
+  Without `metrics`, spans written to `trace_file` by other processes (the
+  worker pool) are followed instead of this process's own.
+  """
+  if not port:
+    return None
+  if metrics is None:
+    metrics = Metrics()
+    threading.Thread(target=follow, args=(trace_file or TRACE_FILE, metrics), daemon=True).start()
+
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split("?")[0] != "/metrics":
+        self.send_error(404)
+        return
+      body = metrics.render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  print(f"Serving metrics on http://0.0.0.0:{port}/metrics")
+  return server
+
+tracer = Tracer()
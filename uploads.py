@@ -0,0 +1,85 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from google.genai import types
+from gemini import client
+from cache import CACHE_DIR, file_sha256
+from atomic import atomic_write
+from sharedtasks import SharedTasks
+from tracing import tracer
+
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "600"))
+UPLOAD_POLL_INITIAL = 0.5
+UPLOAD_POLL_MAX = 8.0
+# Don't hand out a handle that could expire while the request using it is still running
+EXPIRY_MARGIN = timedelta(minutes=30)
+
+class UploadManager:
+  """Uploads context files to the Files API once per content hash.
+
+  Remote handles are remembered by SHA-256 (in memory and in an index file) and
+  reused until they come close to expiring, so the same course material is
+  only sent once however many mangas are generated from it. Concurrent
+  requests for the same content share a single upload.
+  """
+
+  def __init__(self, index_path: Path = CACHE_DIR / "uploads.json"):
+    self.index_path = Path(index_path)
+    self._handles: dict[str, types.File] = self._load()
+    self._pending: SharedTasks[str, types.File] = SharedTasks(keep=False)
+
+  def _load(self) -> dict[str, types.File]:
+    try:
+      with open(self.index_path, "r", encoding="utf-8") as f:
+        return {digest: types.File.model_validate(handle) for digest, handle in json.load(f).items()}
+    except (FileNotFoundError, ValueError):
+      return {}
+
+  def _save(self):
+    atomic_write(self.index_path, json.dumps({digest: handle.model_dump(mode="json", exclude_none=True) for digest, handle in self._handles.items()}, indent=2))
+
+  @staticmethod
+  def _valid(handle: types.File) -> bool:
+    if handle.state != types.FileState.ACTIVE or handle.expiration_time is None:
+      return False
+    return handle.expiration_time - EXPIRY_MARGIN > datetime.now(timezone.utc)
+
+  async def get(self, path: str) -> types.File:
+    digest = await asyncio.to_thread(file_sha256, path)
+    handle = self._handles.get(digest)
+    if handle and self._valid(handle):
+      return handle
+    return await self._pending.run(digest, lambda: self._upload(digest, path))
+
+  async def get_many(self, paths: list[str]) -> list[types.File]:
+    return list(await asyncio.gather(*(self.get(path) for path in paths)))
+
+  async def _upload(self, digest: str, path: str) -> types.File:
+    with tracer.span("upload", file=os.path.basename(path)) as span:
+      span.request_bytes = os.path.getsize(path)
+      handle = await client.aio.files.upload(file=path)
+      # Time the Files API spends processing the file before it can be used
+      processing = time.monotonic()
+      handle = await self._wait_until_active(handle)
+      span.set(processing_seconds=round(time.monotonic() - processing, 3))
+    self._handles[digest] = handle
+    self._save()
+    return handle
+
+  async def _wait_until_active(self, handle: types.File) -> types.File:
+    deadline = time.monotonic() + UPLOAD_TIMEOUT
+    delay = UPLOAD_POLL_INITIAL
+    while handle.state != types.FileState.ACTIVE:
+      if handle.state == types.FileState.FAILED:
+        raise Exception(f"File {handle.name} failed to upload: {handle.error}")
+      if time.monotonic() > deadline:
+        raise TimeoutError(f"File {handle.name} was not processed within {UPLOAD_TIMEOUT}s")
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, UPLOAD_POLL_MAX)
+      handle = await client.aio.files.get(name=handle.name)
+    return handle
+
+uploads = UploadManager()
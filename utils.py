@@ -1,71 +1,189 @@
 import asyncio
-import img2pdf
-from PIL import Image
 from gemini import client
-from pydantic import BaseModel
-from io import BytesIO
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from google.genai import types
+from typing import Callable
+from cache import image_cache, response_cache
+from uploads import uploads
+from ratelimit import rate_limiter, estimate_tokens
+from retry import LatencyTracker, NoImageReturned, hedged, retrying
+from encoding import encode_to_file, output_path
+from models import EncodingOptions
+from tracing import tracer
+from contextcache import CachedPrefix
+from references import ReferenceImages
+from streaming import JsonObjectStream
 import os
+import time
 
-async def upload_and_wait_for_file(file:str):
+STRUCTURED_TIMEOUT = float(os.getenv("STRUCTURED_TIMEOUT", "300"))
+# A streamed response may take as long as it needs, but gives up after this long without a chunk
+STREAM_IDLE_TIMEOUT = float(os.getenv("STREAM_IDLE_TIMEOUT", "60"))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "180"))
+IMAGE_MODEL = os.getenv("IMAGE_MODEL", "gemini-2.5-flash-image-preview")
+
+image_latency = LatencyTracker()
+
+async def stream_response(model:str, contents:list, config:dict, schema, parser:JsonObjectStream, on_object:Callable[[tuple, dict], None], idle_timeout:float=STREAM_IDLE_TIMEOUT) -> types.GenerateContentResponse:
+  """Stream a structured response, calling `on_object` for each object `parser`
+  matches as soon as it is complete. Returns the whole response, with `parsed`
+  set to the validated `schema` object, or None if the text doesn't validate.
+  Raises TimeoutError if no chunk arrives for `idle_timeout` seconds."""
+  chunks, usage, finish_reason = [], None, None
+  stream = aiter(await asyncio.wait_for(client.aio.models.generate_content_stream(model=model, contents=contents, config=config), idle_timeout))
+  while True:
+    try:
+      chunk = await asyncio.wait_for(anext(stream), idle_timeout)
+    except StopAsyncIteration:
+      break
+    text = chunk.text
+    if text:
+      chunks.append(text)
+      for path, value in parser.feed(text):
+        on_object(path, value)
+    usage = chunk.usage_metadata or usage
+    if chunk.candidates and chunk.candidates[0].finish_reason:
+      finish_reason = chunk.candidates[0].finish_reason
+  text = "".join(chunks)
   try:
-    file = await client.aio.files.upload(file=file)
-    while file.state!="ACTIVE":
-      if file.state=="FAILED":
-        raise Exception(f"File {file.name} failed to upload")
-      await asyncio.sleep(0.4)
-    return file
-  except Exception as e:
+    parsed = TypeAdapter(schema).validate_json(text)
+  except ValidationError as e:
     print(e)
-    raise e
+    parsed = None
+  return types.GenerateContentResponse(
+    candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]), finish_reason=finish_reason)],
+    usage_metadata=usage,
+    parsed=parsed,
+  )
 
-async def structured(prompt:str, schema:BaseModel | list[BaseModel],model:str='gemini-2.5-pro',files:list[str]=[]):
+async def structured(prompt:str, schema:BaseModel | list[BaseModel],model:str='gemini-2.5-pro',files:list[str]=[],timeout:float=STRUCTURED_TIMEOUT,use_cache:bool=True,prefix:CachedPrefix | None=None,on_object:Callable[[tuple, dict], None] | None=None,object_path:tuple | None=None):
+  """Generate a `schema` object. With a `prefix`, the prompt is the prefix followed by
+  `prompt`, and the prefix comes from its context cache when it has one.
+
+  With `on_object`, the response is streamed and every object at `object_path`
+  (None for any index, e.g. ('pages', None, 'panels', None)) is passed to it as
+  a dict as soon as it is complete. A retried call streams again from the
+  start, so the callback may see the same path more than once."""
   try:
-    files = [await upload_and_wait_for_file(file) for file in files if os.path.exists(file)] if files else []
-    response = client.models.generate_content(
-      model=model,
-      contents=[*files,prompt] if files else [prompt],
-      config={
-          "response_mime_type": "application/json",
-          "response_schema": schema,
-          "max_output_tokens": 60000
-      },
-    )
-    return response.parsed
+    with tracer.span("model.structured", model=model, schema=getattr(schema, "__name__", str(schema)), stream=on_object is not None) as span:
+      full_prompt = prefix.text + prompt if prefix else prompt
+      files = [file for file in files if os.path.exists(file)] if files else []
+      key = await asyncio.to_thread(response_cache.key, full_prompt, schema, model, files) if use_cache else None
+      if key:
+        cached = await asyncio.to_thread(response_cache.get, key, schema)
+        if cached is not None:
+          span.set(cache="hit")
+          return cached
+      files = await uploads.get_many(files) if files else []
+      started = time.monotonic()
+      def streamed(path: tuple, value: dict):
+        if 'first_object_seconds' not in span.attrs:
+          span.set(first_object_seconds=round(time.monotonic() - started, 3))
+        on_object(path, value)
+      async def call(cached_content: str | None):
+        queued = time.monotonic()
+        text = prompt if cached_content else full_prompt
+        config = {
+            "response_mime_type": "application/json",
+            "response_schema": schema,
+            "max_output_tokens": 60000
+        }
+        if cached_content:
+          config["cached_content"] = cached_content
+        async with rate_limiter.slot(model, estimate_tokens(full_prompt)) as slot:
+          span.queue_wait += time.monotonic() - queued
+          span.request_bytes += len(text.encode("utf-8"))
+          contents = [*files,text] if files else [text]
+          if on_object:
+            # A long script streams for as long as chunks keep coming
+            response = await stream_response(model, contents, config, schema, JsonObjectStream(object_path), streamed)
+          else:
+            response = await asyncio.wait_for(client.aio.models.generate_content(
+              model=model,
+              contents=contents,
+              config=config,
+            ), timeout)
+          slot.record(response.usage_metadata)
+        span.record_usage(response.usage_metadata)
+        span.response_bytes += len((response.text or "").encode("utf-8"))
+        return response
+      async def attempt():
+        cached_content = await prefix.handle() if prefix else None
+        span.set(context_cache=cached_content is not None)
+        try:
+          return await call(cached_content)
+        except Exception as e:
+          if cached_content and prefix.stale(e):
+            return await call(None)
+          raise
+      response = await retrying(attempt, name=f"{model} structured call")
+      if key and response.parsed is not None:
+        await asyncio.to_thread(response_cache.put, key, schema, response.parsed)
+      return response.parsed
   except Exception as e:
     print(e)
     raise e
 
-async def generate_image(prompt:str,path:str,images:list[str]) -> str:
+def image_data(response) -> bytes:
+  """Bytes of the first image part of a response, or NoImageReturned."""
+  candidate = response.candidates[0] if response.candidates else None
+  text = []
+  for part in (candidate.content.parts or []) if candidate and candidate.content else []:
+    if part.inline_data is not None and part.inline_data.data:
+      return part.inline_data.data
+    if part.text is not None:
+      print(part.text)
+      text.append(part.text)
+  if candidate and candidate.finish_reason:
+    reason = candidate.finish_reason
+  else:
+    feedback = response.prompt_feedback
+    reason = feedback.block_reason if feedback else None
+  raise NoImageReturned(str(reason) if reason else None, " ".join(text) or None)
+
+async def generate_image(prompt:str,path:str,images:list[str],timeout:float=IMAGE_TIMEOUT,use_cache:bool=True,encoding:EncodingOptions=EncodingOptions(),references:ReferenceImages | None=None,refresh:bool=False) -> str:
+  """Render `prompt` with `images` as references. Pass the manga's shared
+  `references` so each reference is read and encoded once per manga.
+  `refresh` skips the cached render but still caches the new one."""
   try:
-    contents = [prompt]
-    for img in images:
-      if os.path.exists(img):
-        contents.insert(0,Image.open(img))
-    print(contents)
-    response = client.models.generate_content(
-      model="gemini-2.5-flash-image-preview",
-      contents=contents
-    )
-    for part in response.candidates[0].content.parts:
-      if part.text is not None:
-          print(part.text)
-      elif part.inline_data is not None:
-          image = Image.open(BytesIO(part.inline_data.data))
-          image.save(path)
-    return path
+    with tracer.span("model.image", model=IMAGE_MODEL, path=path, references=len(images)) as span:
+      images = [img for img in images if os.path.exists(img)]
+      path = output_path(path, encoding)
+      refs = await (references or ReferenceImages()).get_many(images)
+      key = image_cache.digest_key(prompt, IMAGE_MODEL, [ref.digest for ref in refs], encoding.model_dump_json()) if use_cache else None
+      if key and not refresh and await asyncio.to_thread(image_cache.get, key, path):
+        span.set(cache="hit")
+        return path
+      contents = [*(ref.part for ref in refs), prompt]
+      request_bytes = len(prompt.encode("utf-8")) + sum(len(ref.part.inline_data.data) for ref in refs)
+      estimate = estimate_tokens(prompt, len(images) + 1)
+      limiter = rate_limiter.model(IMAGE_MODEL)
+      async def call():
+        response = await asyncio.wait_for(client.aio.models.generate_content(
+          model=IMAGE_MODEL,
+          contents=contents
+        ), timeout)
+        return response, image_data(response)
+      async def attempt():
+        queued = time.monotonic()
+        async with limiter.slot(estimate) as slot:
+          span.queue_wait += time.monotonic() - queued
+          span.request_bytes += request_bytes
+          # Time and hedge the request alone: a wait for the limiter is not a straggler
+          response, data = await hedged(call, image_latency, allow=lambda: limiter.spare(estimate), on_error=limiter.failed)
+          slot.record(response.usage_metadata)
+        span.record_usage(response.usage_metadata)
+        span.response_bytes += len(data)
+        return data
+      # Retry transient failures; within each try, hedge a straggler past the p95 latency
+      data = await retrying(attempt, name=f"image {os.path.basename(path)}")
+      path = await asyncio.to_thread(encode_to_file, data, path, encoding)
+      if key:
+        await asyncio.to_thread(image_cache.put, key, path)
+      return path
   except Exception as e:
     print(e)
     raise e
 
-async def get_pdf(image_paths:list[str],pdf_path:str):
-    try:
-        pdf_bytes = img2pdf.convert(image_paths)
-        with open(pdf_path, "wb") as f:
-            f.write(pdf_bytes)
-        print(f"Successfully converted {image_paths} to {pdf_path}")
-        return pdf_path
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
 async def clean_string(string:str):
   return string.replace("/", "_")
\ No newline at end of file
@@ -0,0 +1,225 @@
+"""Worker pool that runs queued manga generation jobs.
+
+  python worker.py --workers 2
+
+Each worker process claims one job at a time from the job queue, runs the
+pipeline and reports progress back through the queue, so generation keeps
+going whatever happens to the browser session that asked for it. The UI
+starts a pool on demand when WORKER_AUTOSTART is on.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from models import CharacterSheet, MainRequest, Manga, MangaChapterScript
+from pipeline import PipelineHooks, generate_manga, resume_manga
+from manifest import manifest_path
+from scheduler import PanelKey
+from jobqueue import JobQueue, job_queue
+from store import state_store
+from ratelimit import rate_limiter
+from services import DATA_DIR
+from tracing import METRICS_PORT, serve_metrics
+from config import env_flag
+
+WORKERS = int(os.getenv("WORKERS", "2"))
+WORKER_AUTOSTART = env_flag("WORKER_AUTOSTART", True)
+WORKER_POLL = float(os.getenv("WORKER_POLL", "1"))
+HEARTBEAT_INTERVAL = 5.0
+WORKER_LOG = Path(DATA_DIR) / "worker.log"
+
+class QueueHooks(PipelineHooks):
+  """Reports pipeline progress to the job queue.
+
+  Hooks run on the worker's event loop, so they only buffer their events. A
+  writer task stores them in batches from a thread, and a locked database
+  holds up the progress reports rather than every panel in flight.
+  """
+
+  STAGES = {'outline': 0.05, 'characters': 0.15, 'chapters': 0.2, 'pdf': 0.9, 'done': 1.0}
+
+  def __init__(self, queue: JobQueue, job_id: int):
+    self.queue = queue
+    self.job_id = job_id
+    self.panels_done = 0
+    self.panels_total = 0
+    self._pending: list[tuple[str, dict, dict]] = []
+    self._wakeup = asyncio.Event()
+    self._closed = False
+    self._writer: asyncio.Task | None = None
+
+  def start(self):
+    self._writer = asyncio.create_task(self._write())
+
+  async def close(self):
+    """Store what is still buffered and stop the writer."""
+    self._closed = True
+    self._wakeup.set()
+    if self._writer:
+      await self._writer
+
+  async def _write(self):
+    while True:
+      await self._wakeup.wait()
+      self._wakeup.clear()
+      events, self._pending = self._pending, []
+      if events:
+        try:
+          await asyncio.to_thread(self.queue.add_events, self.job_id, events)
+        except Exception as e:
+          print(f"Could not record {len(events)} events of job {self.job_id}: {e}", flush=True)
+      if self._closed and not self._pending:
+        return
+
+  def _add(self, kind: str, data: dict, **fields):
+    self._pending.append((kind, data, fields))
+    self._wakeup.set()
+
+  def on_stage(self, stage: str):
+    self._add('stage', {'stage': stage}, stage=stage, progress=self.STAGES[stage])
+
+  def on_outline(self, manga: Manga):
+    self._add('outline', {'manga': manga.model_dump(mode='json')}, title=manga.title, manifest=str(manifest_path(manga.title)))
+
+  def on_character(self, character: CharacterSheet, path: str | None):
+    self._add('character', {'character_id': character.character_id, 'path': path})
+
+  def on_chapter(self, chapter_idx: int, script: MangaChapterScript, panels: int):
+    self.panels_total += panels
+    self._add('chapter', {'chapter': chapter_idx, 'title': script.chapter_title, 'panels': panels}, panels_total=self.panels_total)
+
+  def on_panel(self, key: PanelKey, req, path: str):
+    self.panels_done += 1
+    progress = 0.2 + 0.7 * self.panels_done / max(self.panels_total, 1)
+    self._add('panel', {'key': list(key), 'path': path}, panels_done=self.panels_done, progress=min(progress, 0.9))
+
+async def run_job(queue: JobQueue, job, worker: str):
+  hooks = QueueHooks(queue, job.id)
+  hooks.start()
+  if job.kind == 'resume':
+    task = asyncio.create_task(resume_manga(Path(job.payload), hooks))
+  else:
+    task = asyncio.create_task(generate_manga(MainRequest.model_validate_json(job.payload), hooks))
+  # Heartbeat while the job runs; stop it if the UI asked for a cancel
+  try:
+    while not task.done():
+      await asyncio.wait({task}, timeout=HEARTBEAT_INTERVAL)
+      if not task.done():
+        await asyncio.to_thread(queue.worker_heartbeat, worker, job.id, rate_limiter.snapshot())
+        if await asyncio.to_thread(queue.heartbeat, job.id):
+          task.cancel()
+  except asyncio.CancelledError:
+    # The worker is shutting down: stop the job and hand it back to the queue
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await hooks.close()
+    queue.release(job.id)
+    print(f"[{worker}] job {job.id} returned to the queue", flush=True)
+    raise
+  await hooks.close()
+  try:
+    result = task.result()
+    # Saved here rather than by the UI, so the manga reaches the history with no session watching;
+    # keyed on the job, so a job finished again after a crash isn't saved twice
+    state_store.add_manga(result, job_id=job.id)
+    queue.finish(job.id, result)
+    print(f"[{worker}] job {job.id} complete", flush=True)
+  except asyncio.CancelledError:
+    queue.fail(job.id, "Cancelled", status='cancelled')
+    print(f"[{worker}] job {job.id} cancelled", flush=True)
+  except Exception as e:
+    queue.fail(job.id, f"{type(e).__name__}: {e}")
+    print(f"[{worker}] job {job.id} failed: {e}", flush=True)
+
+async def work(worker: str, queue: JobQueue):
+  # The pool stops workers with SIGTERM; cancel so the current job is handed back
+  asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+  queue.register_worker(worker)
+  last_beat = 0.0
+  try:
+    while True:
+      if time.monotonic() - last_beat > HEARTBEAT_INTERVAL:
+        queue.requeue_stale()
+        queue.worker_heartbeat(worker, rate_limits=rate_limiter.snapshot())
+        last_beat = time.monotonic()
+      job = queue.claim(worker)
+      if job is None:
+        await asyncio.sleep(WORKER_POLL)
+        continue
+      print(f"[{worker}] running job {job.id} ({job.kind})", flush=True)
+      await run_job(queue, job, worker)
+      last_beat = 0.0
+  finally:
+    queue.remove_worker(worker)
+
+def run_worker(index: int):
+  worker = f"{socket.gethostname()}-{os.getpid()}-{index}"
+  # Ctrl+C reaches the whole process group; only the pool should act on it
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  try:
+    asyncio.run(work(worker, JobQueue()))
+  except asyncio.CancelledError:
+    pass
+
+def run_pool(workers: int):
+  """Run `workers` worker processes, restarting any that die, until interrupted."""
+  context = multiprocessing.get_context("spawn")
+  processes = {}
+  signal.signal(signal.SIGTERM, signal.default_int_handler)
+  try:
+    while True:
+      for index in range(workers):
+        if index not in processes or not processes[index].is_alive():
+          processes[index] = context.Process(target=run_worker, args=(index,), daemon=True)
+          processes[index].start()
+      time.sleep(HEARTBEAT_INTERVAL)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    # Workers hand their jobs back on SIGTERM; don't let a second Ctrl+C cut that short
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes.values():
+      process.terminate()
+    for process in processes.values():
+      process.join(timeout=30)
+
+_spawn_lock = threading.Lock()
+_spawned: subprocess.Popen | None = None
+
+def ensure_workers(workers: int = WORKERS) -> bool:
+  """Start a worker pool in the background if none is alive. Returns True if one was started."""
+  global _spawned
+  if not WORKER_AUTOSTART:
+    return False
+  with _spawn_lock:
+    if job_queue.live_workers() or (_spawned and _spawned.poll() is None):
+      return False
+    WORKER_LOG.parent.mkdir(parents=True, exist_ok=True)
+    with open(WORKER_LOG, "a") as log:
+      _spawned = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--workers", str(workers)],
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+      )
+    return True
+
+def main():
+  parser = argparse.ArgumentParser(description="Run queued manga generation jobs.")
+  parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes, each running one job at a time")
+  parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="serve Prometheus metrics of all workers on this port (0: off)")
+  args = parser.parse_args()
+  print(f"Starting {args.workers} workers on {job_queue.path}", flush=True)
+  # Workers write their spans to the trace file; the pool follows it and serves the totals
+  serve_metrics(args.metrics_port)
+  run_pool(args.workers)
+
+if __name__ == "__main__":
+  main()